@@ -2,15 +2,8 @@ import configparser
 import os
 
 from dependency_injector import containers, providers
-from pymongo import MongoClient
 
-from app.src.services import db_service
-from app.src.services import logging_service
-from app.src.services import crossref_service
-from app.src.services import email_service
-from app.src.services import parse_service
-from app.src.services import search_DOI_service
-from app.src.services import semantic_search_service
+from app.src.shared.lazy_import import lazy_class
 
 
 class Container(containers.DeclarativeContainer):
@@ -23,7 +16,7 @@ class Container(containers.DeclarativeContainer):
     # Gateways
 
     database_client = providers.Singleton(
-        MongoClient,
+        lazy_class("pymongo.MongoClient"),
         config.database.host,
         raw_config.getint('database', 'port')
     )
@@ -31,40 +24,156 @@ class Container(containers.DeclarativeContainer):
     # Services
 
     db_service = providers.Factory(
-        db_service.DBService,
+        lazy_class("app.src.services.db_service.DBService"),
         client=database_client,
     )
 
-    logging_service = providers.Factory(
-        logging_service.LoggingService
+    logging_service = providers.Singleton(
+        lazy_class("app.src.services.logging_service.LoggingService")
     )
 
     email_service = providers.Factory(
-        email_service.EmailService,
+        lazy_class("app.src.services.email_service.EmailService"),
         db_service=db_service,
         logging_service=logging_service,
     )
 
+    archive_service = providers.Factory(
+        lazy_class("app.src.services.archive_service.ArchiveService"),
+        db_service=db_service,
+        logging_service=logging_service,
+        workers=raw_config.getint('archive', 'workers'),
+        batch_size=raw_config.getint('archive', 'batch_size'),
+    )
+
     parse_service = providers.Factory(
-        parse_service.ParseService,
+        lazy_class("app.src.services.parse_service.ParseService"),
         db_service=db_service,
         logging_service=logging_service,
     )
 
     search_DOI_service = providers.Factory(
-        search_DOI_service.SearchDOIService,
+        lazy_class("app.src.services.search_DOI_service.SearchDOIService"),
         db_service=db_service,
         logging_service=logging_service,
+        crossref_api_url=config.crossref.api_url,
+        crossref_rows=raw_config.getint('crossref', 'rows'),
+        title_similarity_threshold=raw_config.getfloat('crossref', 'title_similarity_threshold'),
+        title_miss_ttl_days=raw_config.getint('crossref', 'title_miss_ttl_days'),
+        max_attempts=raw_config.getint('retry', 'max_attempts'),
+        retry_base_delay_seconds=raw_config.getint('retry', 'base_delay_seconds'),
+        retry_max_delay_seconds=raw_config.getint('retry', 'max_delay_seconds'),
+        negative_cache_ttl_hours=raw_config.getint('retry', 'negative_cache_ttl_hours'),
+        workers=raw_config.getint('search_doi', 'workers'),
+        lease_seconds=raw_config.getint('search_doi', 'lease_seconds'),
+        request_wait_seconds=config.search_doi.request_wait_seconds.as_float(),
+        browser=config.search_doi.browser,
     )
 
     crossref_service = providers.Factory(
-        crossref_service.CrossrefService,
+        lazy_class("app.src.services.crossref_service.CrossrefService"),
+        db_service=db_service,
+        logging_service=logging_service,
+        crossref_api_url=config.crossref.api_url,
+        concurrency=raw_config.getint('crossref', 'concurrency'),
+        batch_size=raw_config.getint('crossref', 'batch_size'),
+        cache_ttl_days=raw_config.getint('crossref', 'cache_ttl_days'),
+        memory_budget_mb=raw_config.getint('memory', 'batch_budget_mb'),
+    )
+
+    local_semantic_search_service = providers.Factory(
+        lazy_class("app.src.services.semantic_search_service.SemanticSearchService"),
+        db_service=db_service,
+        logging_service=logging_service,
+        backend=config.semantic_search.backend,
+        chroma_path=config.semantic_search.chroma_path,
+        collection_name=config.semantic_search.collection_name,
+        hnsw_construction_ef=raw_config.getint('semantic_search', 'hnsw_construction_ef'),
+        hnsw_search_ef=raw_config.getint('semantic_search', 'hnsw_search_ef'),
+        hnsw_m=raw_config.getint('semantic_search', 'hnsw_m'),
+        n_results=raw_config.getint('semantic_search', 'n_results'),
+        numpy_path=config.semantic_search.numpy_path,
+        numpy_quantization=config.semantic_search.numpy_quantization,
+        id_field=config.semantic_search.id_field,
+        sync_interval_hours=raw_config.getint('semantic_search', 'sync_interval_hours'),
+        batch_size=raw_config.getint('semantic_search', 'batch_size'),
+        ingest_batch_size=raw_config.getint('semantic_search', 'ingest_batch_size'),
+        embedding_model=config.semantic_search.embedding_model,
+        embedding_cache_path=config.semantic_search.embedding_cache_path,
+        embedding_cache_size=raw_config.getint('semantic_search', 'embedding_cache_size'),
+        embedding_cache_dtype=config.semantic_search.embedding_cache_dtype,
+        memory_budget_mb=raw_config.getint('memory', 'batch_budget_mb'),
+    )
+
+    remote_semantic_search_service = providers.Factory(
+        lazy_class("app.src.services.semantic_search_server.RemoteSemanticSearchService"),
+        db_service=db_service,
+        logging_service=logging_service,
+        host=config.semantic_search.server_host,
+        port=raw_config.getint('semantic_search', 'server_port'),
+        batch_size=raw_config.getint('semantic_search', 'batch_size'),
+        memory_budget_mb=raw_config.getint('memory', 'batch_budget_mb'),
+    )
+
+    # local: every process loads the model and the index, remote: the processes share the semantic search server
+    semantic_search_service = providers.Selector(
+        config.semantic_search.mode,
+        local=local_semantic_search_service,
+        remote=remote_semantic_search_service,
+    )
+
+    semantic_search_server = providers.Factory(
+        lazy_class("app.src.services.semantic_search_server.SemanticSearchServer"),
+        semantic_search_service=local_semantic_search_service,
+        host=config.semantic_search.server_host,
+        port=raw_config.getint('semantic_search', 'server_port'),
+        max_batch_size=raw_config.getint('semantic_search', 'server_max_batch_size'),
+    )
+
+    export_service = providers.Factory(
+        lazy_class("app.src.services.export_service.ExportService"),
+        db_service=db_service,
+        logging_service=logging_service,
+        batch_size=raw_config.getint('export', 'batch_size'),
+    )
+
+    query_service = providers.Factory(
+        lazy_class("app.src.services.query_service.QueryService"),
         db_service=db_service,
         logging_service=logging_service,
+        cache_ttl_seconds=raw_config.getint('api', 'cache_ttl_seconds'),
+        cache_max_entries=raw_config.getint('api', 'cache_max_entries'),
+        page_size=raw_config.getint('api', 'page_size'),
+        max_page_size=raw_config.getint('api', 'max_page_size'),
     )
 
-    semantic_search_service = providers.Factory(
-        semantic_search_service.SemanticSearchService,
+    status_service = providers.Factory(
+        lazy_class("app.src.services.status_service.StatusService"),
         db_service=db_service,
         logging_service=logging_service,
-    )
\ No newline at end of file
+    )
+
+    reprocess_service = providers.Factory(
+        lazy_class("app.src.services.reprocess_service.ReprocessService"),
+        db_service=db_service,
+        logging_service=logging_service,
+        workers=raw_config.getint('reprocess', 'workers'),
+        chunk_size=raw_config.getint('reprocess', 'chunk_size'),
+        semantic_search_mode=config.semantic_search.mode,
+    )
+
+    pipeline_supervisor = providers.Factory(
+        lazy_class("app.src.services.pipeline_supervisor.PipelineSupervisor"),
+        logging_service=logging_service,
+        workers=providers.Dict(
+            unread_emails=raw_config.getint('pipeline', 'unread_emails_workers'),
+            email_body=raw_config.getint('pipeline', 'email_body_workers'),
+            search_doi=raw_config.getint('pipeline', 'search_doi_workers'),
+            crossref=raw_config.getint('pipeline', 'crossref_workers'),
+            semantic_search=raw_config.getint('pipeline', 'semantic_search_workers'),
+        ),
+        idle_backoff_min_seconds=raw_config.getint('pipeline', 'idle_backoff_min_seconds'),
+        idle_backoff_max_seconds=raw_config.getint('pipeline', 'idle_backoff_max_seconds'),
+        restart_delay_seconds=raw_config.getint('pipeline', 'restart_delay_seconds'),
+        shutdown_timeout_seconds=raw_config.getint('pipeline', 'shutdown_timeout_seconds'),
+    )
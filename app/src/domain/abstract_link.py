@@ -12,6 +12,9 @@ CONTENT_TYPE_PDF = os.getenv('CONTENT_TYPE_PDF')
 
 
 class AbstractLink(Entity, ABC):
+    __slots__ = ("url", "location_replace_url", "response_code", "response_type", "is_accepted_type", "doi",
+                 "log_message", "is_doi_success", "is_processed")
+
     def __init__(self, url="", location_replace_url="", response_code=0, response_type="", is_accepted_type=False,
                  doi="", log_message="", is_doi_success=False, is_processed=False):
         super().__init__()
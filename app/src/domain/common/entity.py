@@ -2,9 +2,13 @@ from abc import ABC  # Abstract Base Class
 from datetime import datetime, timezone
 
 class Entity(ABC):
+    # the domain objects use slots, the stages create them for every item they handle
+    __slots__ = ("created_at", "updated_at")
+
     def __init__(self):
-        self.created_at = datetime.now(timezone.utc)
-        self.updated_at = datetime.now(timezone.utc)
+        now = datetime.now(timezone.utc)
+        self.created_at = now
+        self.updated_at = now
 
     def get_created_at_formatted(self):
         return self.created_at.strftime("%Y-%m-%dT%H:%M:%SZ")
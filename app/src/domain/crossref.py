@@ -1,6 +1,9 @@
 from app.src.domain.common.entity import Entity
 
 class Crossref(Entity):
+    __slots__ = ("response_code", "is_valid_response", "title", "author", "year", "publisher", "log_message", "doi_url",
+                 "api_url")
+
     def __init__(self, response_code=0, is_valid_response=False, title="", author="", year=0, publisher="", log_message="", doi_url="",
                  api_url=""):
         super().__init__()
@@ -10,11 +10,15 @@ load_dotenv()
 SENDER = os.getenv('SENDER')
 
 class Email(Entity):
-    def __init__(self, sender, datetime_obj, subject, body):
+    __slots__ = ("sender", "datetime", "subject", "message_id", "body", "log_message", "is_processed", "is_spam")
+
+    # body is None when the email was loaded without its body
+    def __init__(self, sender, datetime_obj, subject, body=None, message_id=None):
         self.sender = sender
         self.datetime = datetime_obj
         self.subject = subject
-        self.body = EmailBody(body=body)
+        self.message_id = message_id
+        self.body = EmailBody(body=body) if body is not None else None
         self.log_message = ''
         self.is_processed = False
         self.is_spam = False
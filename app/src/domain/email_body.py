@@ -2,6 +2,8 @@ from app.src.domain.common.entity import Entity
 
 
 class EmailBody(Entity):
+    __slots__ = ("text_html", "log_message", "is_parsed", "is_google_scholar_format")
+
     def __init__(self, body, log_message="", is_parsed=False, is_google_scholar_format=False):
         self.text_html = body
         self.log_message = log_message
@@ -3,6 +3,9 @@ from app.src.domain.link import Link
 
 
 class SearchResult(Entity):
+    __slots__ = ("title", "author", "publisher", "date", "text", "link", "media_type", "log_message", "is_processed",
+                 "score")
+
     def __init__(self, title, author, publisher, date, text, link, media_type = ""):
         self.title = title
         self.author = author
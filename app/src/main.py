@@ -1,25 +1,84 @@
+import inspect
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+from time import perf_counter
+from typing import TYPE_CHECKING, Callable
+
 import click
 from dependency_injector.wiring import Provide, inject
-from requests import HTTPError, Timeout
 
 from app.src.app_containers import Container
-from app.src.services.crossref_service import CrossrefService
-from app.src.services.email_service import EmailService
-from app.src.services.parse_service import ParseService
-from app.src.services.search_DOI_service import SearchDOIService
-from app.src.services.semantic_search_service import SemanticSearchService
+from app.src.services.pipeline_supervisor import get_worker_metrics_port, in_partition, run_stage_loop, \
+    stop_requested
+from app.src.shared.helper import printable_date_time_now
+from app.src.shared.metrics import metrics
+from app.src.shared.profiling import PROFILE_MODES, profiler
+from app.src.shared.tracing import STATUS_CODE_ERROR, get_trace_filenames, read_spans, tracer
+
+# the services are only imported by the commands that get them injected, see app_containers
+if TYPE_CHECKING:
+    from app.src.services.archive_service import ArchiveService
+    from app.src.services.crossref_service import CrossrefService
+    from app.src.services.email_service import EmailService
+    from app.src.services.export_service import ExportService
+    from app.src.services.parse_service import ParseService
+    from app.src.services.pipeline_supervisor import PipelineSupervisor
+    from app.src.services.query_service import QueryService
+    from app.src.services.reprocess_service import ReprocessService
+    from app.src.services.search_DOI_service import SearchDOIService
+    from app.src.services.semantic_search_server import SemanticSearchServer
+    from app.src.services.semantic_search_service import SemanticSearchService
+    from app.src.services.status_service import StatusService
 
 
 @click.group()
-def cli():
+@click.option('--metrics-port', type=int, envvar='METRICS_PORT',
+              help='Serve the metrics in the Prometheus format on this port while the command runs.')
+@click.option('--metrics-dir', envvar='METRICS_DIR', default='metrics', show_default=True,
+              help='Directory the metrics of the command are written to when it ends (<command>.prom), empty to disable.')
+@click.option('--trace-dir', envvar='TRACE_DIR', default='traces', show_default=True,
+              help='Directory the trace spans are written to as OTLP JSON lines, empty to disable.')
+@click.option('--profile', type=click.Choice(PROFILE_MODES), envvar='PROFILE',
+              help='Profile the command with cProfile (pstats file) or by sampling the stacks (collapsed stacks).')
+@click.option('--profile-dir', envvar='PROFILE_DIR', default='profiles', show_default=True,
+              help='Directory the profile is written to, named after the command and the time it ends.')
+@click.option('--profile-items', type=int, envvar='PROFILE_ITEMS',
+              help='Stop profiling once the stage has handled this many items.')
+@click.option('--profile-interval-ms', default=5.0, show_default=True, help='Sampling interval.')
+@click.pass_context
+def cli(ctx, metrics_port, metrics_dir, trace_dir, profile, profile_dir, profile_items, profile_interval_ms):
     # create group for all the commands so you can
     # run them from the __name__ == "__main__" block
-    pass
+    if metrics_port:
+        metrics.serve(metrics_port)
+    if metrics_dir:
+        ctx.call_on_close(lambda: dump_metrics(metrics_dir, ctx.invoked_subcommand))
+    if trace_dir and ctx.invoked_subcommand != "trace-summary":
+        tracer.configure(os.path.join(trace_dir, f"{ctx.invoked_subcommand}.jsonl"))
+    if profile:
+        start_profiler(profile, profile_dir, ctx.invoked_subcommand, profile_items, profile_interval_ms)
+        ctx.call_on_close(stop_profiler)
+
+def start_profiler(profile, profile_dir, name, profile_items, profile_interval_ms):
+    profiler.start(profile, os.path.join(profile_dir, name), profile_items, profile_interval_ms / 1000)
+
+def stop_profiler():
+    profiler.stop()
+    if profiler.filename:
+        click.echo(f'profile written to {profiler.filename}', err=True)
+
+# one file per command, overwritten by its next run, like the files of a node exporter textfile collector
+def dump_metrics(metrics_dir, command):
+    metrics.dump(os.path.join(metrics_dir, f"{command}.prom"))
 
 @cli.command()
 @inject
 def process_unread_emails(
-        email_service: EmailService = Provide[Container.email_service],
+        email_service: 'EmailService' = Provide[Container.email_service],
 ):    #python -m app.src.main process-unread-emails
     """
         Connects to inbox and gathers unread emails, store contents
@@ -32,30 +91,120 @@ def process_unread_emails(
         if not unread_email_ids:
             email_service.log('No new unread emails to process.')
             mailbox.close()
-            exit()
+            return 0
 
+        email_service.create_message_id_index()
+        processed = 0
         for email_id in unread_email_ids:
+            if stop_requested.is_set():
+                break
+            processed += 1
+            metrics.count_item("email", "processed")
+            profiler.count_items()
             email_data = email_service.fetch_email_content(mailbox, email_id)
             dict_current_email = email_service.parse_email(email_data)
+            if dict_current_email['current_email'].is_spam:
+                metrics.count_item("email", "failed", "spam")
+            else:
+                metrics.count_item("email", "succeeded")
             email_service.move_email(dict_current_email['current_email'], mailbox, email_id)
 
         mailbox.expunge()
         mailbox.close()
         mailbox.logout()
+        return processed
     except ConnectionError as error:
-        email_service.log('Connection error: {}'.format(error))
+        email_service.log('Connection error: %s', error)
+        return 0
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--format', 'archive_format', type=click.Choice(['auto', 'mbox', 'maildir', 'msg']), default='auto',
+              show_default=True, help='auto: a Maildir for a directory with cur, new and tmp, .msg files for another '
+                                      'directory or a .msg file, mbox otherwise.')
+@click.option('--workers', type=int, help='Worker processes parsing the messages, workers in the archive section of '
+                                          'config.ini by default.')
+@inject
+def import_archive(
+        path, archive_format, workers,
+        archive_service: 'ArchiveService' = Provide[Container.archive_service],
+        email_service: 'EmailService' = Provide[Container.email_service],
+):  #python -m app.src.main import-archive alerts.mbox
+    """
+        Stores the alerts of an mbox file, a Maildir or a directory of .msg
+        files like process-unread-emails does, without the mail server. The
+        emails already stored (the same Message-ID) are skipped.
+        """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    email_service.create_message_id_index()
+    workers = workers or archive_service.workers
+    read = inserted = duplicates = failed = 0
+    # spawned workers don't inherit the parent's mongo connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_import_archive_worker) as executor:
+        # one batch at a time, so the archive is never read into memory as a whole
+        for items in batched(archive_service.iter_archive(path, archive_format), archive_service.batch_size):
+            posts = [post for post in executor.map(import_archive_worker, items,
+                                                   chunksize=max(1, len(items) // (workers * 4)))
+                     if post is not None]
+            batch_inserted, batch_duplicates = archive_service.store_emails(posts)
+            read += len(items)
+            inserted += batch_inserted
+            duplicates += batch_duplicates
+            failed += len(items) - len(posts)
+            profiler.count_items(len(items))
+            metrics.count_item("email", "processed", amount=len(items))
+            metrics.count_item("email", "succeeded", amount=batch_inserted)
+            metrics.count_item("email", "failed", "duplicate", amount=batch_duplicates)
+            metrics.count_item("email", "failed", "unreadable", amount=len(items) - len(posts))
+            click.echo(f'{read} read, {inserted} inserted, {duplicates} already stored, {failed} unreadable', err=True)
+    return inserted
+
+def init_import_archive_worker():
+    container = Container()
+    container.wire(modules=[__name__])
+
+# parses one archived message with the rules of process-unread-emails, None when it can't be read
+@inject
+def import_archive_worker(
+        item,
+        archive_service: 'ArchiveService' = Provide[Container.archive_service],
+        email_service: 'EmailService' = Provide[Container.email_service],
+):
+    from extract_msg.exceptions import ExMsgBaseException
+
+    kind, value = item
+    try:
+        current_email = email_service.read_email(archive_service.read_message(kind, value))
+    # a damaged .msg file, or a message without the headers of an alert
+    except (TypeError, ValueError, LookupError, UnicodeError, AttributeError, ExMsgBaseException) as error:
+        email_service.logging_service.logger.warning('import archive: unreadable message %s: %s',
+                                                     value if kind == "msg" else value[:80], error)
+        return None
+    return email_service.get_email_post(current_email)
 
 @cli.command()
 @inject
 def process_email_body(
-        email_service: EmailService = Provide[Container.email_service],
-        parse_service: ParseService = Provide[Container.parse_service],
+        partition=None,
+        email_service: 'EmailService' = Provide[Container.email_service],
+        parse_service: 'ParseService' = Provide[Container.parse_service],
 ):  #python -m app.src.main process-email-body
+    processed = 0
     try:
         unprocessed_email_body_ids = parse_service.get_unprocessed_ids()
         for email_id in unprocessed_email_body_ids:
-            email_body = parse_service.get_body(email_id['_id'])
+            if stop_requested.is_set():
+                break
+            if not in_partition(email_id['_id'], partition):
+                continue
+            processed += 1
+            metrics.count_item("email_body", "processed")
+            profiler.count_items()
             try:
+                email_body = parse_service.get_body(email_id['_id'])
                 parse_service.parse_body(email_id['_id'], email_body)
                 # flag the email as processed
                 email_update_where = {
@@ -66,14 +215,13 @@ def process_email_body(
                 email_update_what = {
                     "updated_at": current_email.get_updated_at_formatted(),
                     "is_processed": current_email.is_processed,
-                    "body": {
-                        "text_html": email_body.text_html,
-                        "is_parsed": email_body.is_parsed,
-                        "is_google_scholar_format": email_body.is_google_scholar_format,
-                        "log_message": email_body.log_message,
-                    }
+                    # the body text is unchanged, it isn't sent back
+                    "body.is_parsed": email_body.is_parsed,
+                    "body.is_google_scholar_format": email_body.is_google_scholar_format,
+                    "body.log_message": email_body.log_message,
                 }
                 email_service.update_email(email_update_what, email_update_where)
+                metrics.count_item("email_body", "succeeded")
             except IndexError as error:
                 index, log_message, is_parsed, is_google_scholar_format = error.args
                 email_update_where = {
@@ -84,127 +232,884 @@ def process_email_body(
                 email_update_what = {
                     "updated_at": current_email.get_updated_at_formatted(),
                     "is_processed": current_email.is_processed,
-                    "body": {
-                        "text_html": email_body.text_html,
-                        "is_parsed": is_parsed,
-                        "is_google_scholar_format": is_google_scholar_format,
-                        "log_message": log_message,
-                    }
+                    "body.is_parsed": is_parsed,
+                    "body.is_google_scholar_format": is_google_scholar_format,
+                    "body.log_message": log_message,
                 }
                 email_service.update_email(email_update_what, email_update_where)
+                metrics.count_item("email_body", "failed", "google_scholar_format")
+            except ConnectionError:
+                raise
+            except Exception as error:
+                # flagged as not parsed, so the next pass doesn't stop on the same email again
+                fail_email_body(email_service, email_id['_id'], error)
     except ConnectionError as error:
-        print(error)
+        email_service.logging_service.logger.error('process-email-body: %s', error)
     except TypeError as error:
-        print(error)
+        email_service.logging_service.logger.error('process-email-body: %s', error)
+    return processed
+
+def fail_email_body(email_service: 'EmailService', email_id, error):
+    email_service.logging_service.logger.exception('email: %s can not be parsed: %s', email_id, error)
+    email_update_where = {
+        "_id": email_id,
+    }
+    email_update_what = {
+        "updated_at": printable_date_time_now(),
+        "is_processed": True,
+        "body.is_parsed": False,
+        "body.log_message": f"{type(error).__name__}: {error}",
+    }
+    email_service.update_email(email_update_what, email_update_where)
+    metrics.count_item("email_body", "failed", type(error).__name__)
 
 
 @cli.command()
 @inject
 def process_search_doi(
-        parse_service: ParseService = Provide[Container.parse_service],
-        search_doi_service: SearchDOIService = Provide[Container.search_DOI_service],
+        parse_service: 'ParseService' = Provide[Container.parse_service],
+        search_doi_service: 'SearchDOIService' = Provide[Container.search_DOI_service],
 ):  #python -m app.src.main process-search-doi
+    processed = 0
     try:
-        unprocessed_search_result_ids = search_doi_service.get_unprocessed_ids()
-        for search_result_id in unprocessed_search_result_ids:
-            link_and_media_type_and_title = search_doi_service.get_link_and_media_type_and_title(search_result_id['_id'])
-            link = link_and_media_type_and_title['link']
-            search_doi_service.set_link(link)
-            print(link.url)
-            print("initial state: " + search_doi_service.current_state.to_string())
-            print("link doi is None: " + str(not link.doi))
-            print("processing finished: " + str(search_doi_service.processing_finished()))
-            try:
-                while not link.doi and not search_doi_service.processing_finished():
-                    print("next step: " + search_doi_service.current_state.to_string())
-                    link = search_doi_service.next_step(link_and_media_type_and_title)
-                # update the link
-                search_doi_service.update_link_content(search_result_id['_id'])
-                # flag the search result as processed
-                search_result_update_where = {
-                    "_id": search_result_id['_id'],
-                }
-                current_search_result = parse_service.get_current_search_result(search_result_id['_id'])
-                current_search_result.is_processed = True
-                search_result_update_what = {
-                    "updated_at": current_search_result.get_updated_at_formatted(),
-                    "is_processed": current_search_result.is_processed,
-                }
-                parse_service.update_search_result(search_result_update_what, search_result_update_where)
-                # reset the state for the next search result
-                search_doi_service.reset_state()
-            except HTTPError as error:
-                print(error)
-            except Timeout as error:
-                print(error)
+        # every worker claims search results until there are none left
+        with ThreadPoolExecutor(max_workers=search_doi_service.workers) as executor:
+            workers = [executor.submit(search_doi_worker, parse_service, search_doi_service)
+                       for _ in range(search_doi_service.workers)]
+            for worker in workers:
+                processed += worker.result()
     except ConnectionError as error:
-        print(error)
+        search_doi_service.logging_service.logger.error('process-search-doi: %s', error)
+    return processed
+
+def search_doi_worker(parse_service: 'ParseService', search_doi_service: 'SearchDOIService'):
+    processed = 0
+    while not stop_requested.is_set():
+        search_result_id = search_doi_service.claim_unprocessed_id()
+        if search_result_id is None:
+            break
+        try:
+            process_search_result_doi(parse_service, search_doi_service, search_result_id)
+        except Exception as error:
+            # a browser or parsing error: counted as a failed attempt and the lease is released, the worker goes on
+            # with the next search result
+            search_doi_service.logging_service.logger.exception('search result: %s: %s', search_result_id, error)
+            search_doi_service.register_failure(search_result_id, error)
+            metrics.count_item("search_doi", "failed", type(error).__name__)
+        processed += 1
+    return processed
+
+def process_search_result_doi(parse_service: 'ParseService', search_doi_service: 'SearchDOIService', search_result_id):
+    from httpx import HTTPError
+
+    with tracer.span("search_result", {"search_result.id": str(search_result_id)}) as span:
+        metrics.count_item("search_doi", "processed")
+        profiler.count_items()
+        search_doi_context = search_doi_service.get_context(search_result_id)
+        link = search_doi_context.get_link()
+        logger = search_doi_service.logging_service.logger
+        span.set_attribute("url.full", link.url)
+        logger.debug('%s initial state: %s, link doi is None: %s, processing finished: %s', link.url,
+                     search_doi_context.current_state.to_string(), not link.doi,
+                     search_doi_context.processing_finished())
+        try:
+            while not link.doi and not search_doi_context.processing_finished():
+                logger.debug('%s next step: %s', link.url, search_doi_context.current_state.to_string())
+                link = search_doi_service.next_step(search_doi_context)
+            # update the link
+            search_doi_service.update_link_content(search_doi_context)
+            # flag the search result as processed
+            search_result_update_where = {
+                "_id": search_result_id,
+            }
+            current_search_result = parse_service.get_current_search_result(search_result_id)
+            current_search_result.is_processed = True
+            search_result_update_what = {
+                "updated_at": current_search_result.get_updated_at_formatted(),
+                "is_processed": current_search_result.is_processed,
+            }
+            parse_service.update_search_result(search_result_update_what, search_result_update_where)
+            if link.doi:
+                metrics.count_item("search_doi", "succeeded")
+                span.set_attribute("search_doi.outcome", "succeeded")
+            else:
+                metrics.count_item("search_doi", "failed", "doi_not_found")
+                span.set_attribute("search_doi.outcome", "doi_not_found")
+        except HTTPError as error:
+            logger.error('%s: %s', link.url, error)
+            search_doi_service.register_failure(search_result_id, error,
+                                                search_doi_service.get_requested_url(search_doi_context))
+            metrics.count_item("search_doi", "failed", type(error).__name__)
+            span.set_error(error)
+        except ConnectionError as error:
+            # the url is in the negative cache, the search result waits until it expires
+            logger.error('%s: %s', link.url, error)
+            search_doi_service.register_failure(search_result_id, error)
+            metrics.count_item("search_doi", "failed", "negative_cache")
+            span.set_error(error)
 
 @cli.command()
 @inject
 def process_crossref(
-        parse_service: ParseService = Provide[Container.parse_service],
-        crossref_service: CrossrefService = Provide[Container.crossref_service],
+        partition=None,
+        parse_service: 'ParseService' = Provide[Container.parse_service],
+        crossref_service: 'CrossrefService' = Provide[Container.crossref_service],
 ):  #python -m app.src.main process-crossref
-    unprocessed_link_ids = crossref_service.get_unprocessed_ids()
-    for link_id in unprocessed_link_ids:
-        link = crossref_service.get_link(link_id['_id'])
-        crossref_service.get_crossref(link_id['_id'], link)
-        # update the link
-        # flag the search result as processed
-        search_result_update_where = {
-            "_id": link_id['_id'],
-        }
-        current_search_result = parse_service.get_current_search_result(link_id['_id'])
-        current_search_result.link.is_processed = True
-        search_result_update_what = {
-            "link": {
-                "url": link.url,
-                "location_replace_url": link.location_replace_url,
-                "response_code": link.response_code,
-                "response_type": link.response_type,
-                "is_accepted_type": link.is_accepted_type,
-                "DOI": link.doi,
-                "log_message": link.log_message,
-                "is_DOI_success": link.is_doi_success,
-                "is_processed": current_search_result.link.is_processed
-            },
-        }
-        parse_service.update_search_result(search_result_update_what, search_result_update_where)
+    processed = 0
+    unprocessed_link_ids = (link_id for link_id in crossref_service.get_unprocessed_ids()
+                            if in_partition(link_id['_id'], partition))
+    for link_ids in batched(unprocessed_link_ids, crossref_service.batch_size):
+        if stop_requested.is_set():
+            break
+        processed += len(link_ids)
+        try:
+            links = [(link_id['_id'], crossref_service.get_link(link_id['_id'])) for link_id in link_ids]
+            retry_ids = crossref_service.get_crossref_batch(links)
+        except ConnectionError:
+            raise
+        except Exception as error:
+            # a search result breaks the batch, they are looked up one by one so only that one fails
+            crossref_service.logging_service.logger.warning('crossref batch failed, one by one: %s', error)
+            links, retry_ids = get_crossref_one_by_one(crossref_service, [link_id['_id'] for link_id in link_ids])
+        profiler.count_items(len(link_ids))
+        for link_id, link in links:
+            if link_id in retry_ids:
+                continue
+            try:
+                store_crossref_processed(parse_service, link_id, link)
+            except ConnectionError:
+                raise
+            except Exception as error:
+                fail_crossref(crossref_service, link_id, error)
+    return processed
+
+def get_crossref_one_by_one(crossref_service: 'CrossrefService', link_ids):
+    links = []
+    retry_ids = set()
+    for link_id in link_ids:
+        try:
+            link = crossref_service.get_link(link_id)
+            retry_ids |= crossref_service.get_crossref_batch([(link_id, link)])
+            links.append((link_id, link))
+        except ConnectionError:
+            raise
+        except Exception as error:
+            fail_crossref(crossref_service, link_id, error)
+    return links, retry_ids
+
+# the search result is done with the crossref stage, with the error in its crossref document
+def fail_crossref(crossref_service: 'CrossrefService', link_id, error):
+    crossref_service.logging_service.logger.exception('crossref for search result: %s failed: %s', link_id, error)
+    crossref_service.store_crossref_failure(link_id, error)
+    metrics.count_item("crossref", "failed", type(error).__name__)
+
+def store_crossref_processed(parse_service: 'ParseService', link_id, link):
+    # update the link
+    # flag the search result as processed
+    search_result_update_where = {
+        "_id": link_id,
+    }
+    current_search_result = parse_service.get_current_search_result(link_id)
+    current_search_result.link.is_processed = True
+    search_result_update_what = {
+        "updated_at": current_search_result.get_updated_at_formatted(),
+        "link": {
+            "url": link.url,
+            "location_replace_url": link.location_replace_url,
+            "response_code": link.response_code,
+            "response_type": link.response_type,
+            "is_accepted_type": link.is_accepted_type,
+            "DOI": link.doi,
+            "log_message": link.log_message,
+            "is_DOI_success": link.is_doi_success,
+            "is_processed": current_search_result.link.is_processed
+        },
+    }
+    parse_service.update_search_result(search_result_update_what, search_result_update_where)
 
 @cli.command()
 @inject
 def process_semantic_search(
-        semantic_search_service: SemanticSearchService = Provide[Container.semantic_search_service],
-        parse_service: ParseService = Provide[Container.parse_service],
+        partition=None,
+        semantic_search_service: 'SemanticSearchService' = Provide[Container.semantic_search_service],
 ):  #python -m app.src.main process-semantic-search
-    unprocessed_ids = semantic_search_service.get_unprocessed_ids()
-    for search_result_id in unprocessed_ids:
-        search_result_title = semantic_search_service.get_title(search_result_id['_id'])
-        score = semantic_search_service.do_semantic_search(search_result_title)
-        # add the distance to the search result
-        search_result_update_where = {
-            "_id": search_result_id['_id'],
-        }
-        current_link = semantic_search_service.get_current_link(search_result_id['_id'])
-        current_link.is_processed = True
-        current_search_result = parse_service.get_current_search_result(search_result_id['_id'])
-        current_search_result.score = score
-        search_result_update_what = {
-            "link": {
-                "url": current_link.url,
-                "location_replace_url": current_link.location_replace_url,
-                "response_code": current_link.response_code,
-                "response_type": current_link.response_type,
-                "is_accepted_type": current_link.is_accepted_type,
-                "DOI": current_link.doi,
-                "log_message": current_link.log_message,
-                "is_DOI_success": current_link.is_doi_success,
-                "is_processed": current_link.is_processed
-            },
-            "score": current_search_result.score,
-        }
-        parse_service.update_search_result(search_result_update_what, search_result_update_where)
+    processed = 0
+    unprocessed_ids = (search_result_id for search_result_id in semantic_search_service.get_unprocessed_ids()
+                       if in_partition(search_result_id['_id'], partition))
+    for search_result_ids in batched(unprocessed_ids, semantic_search_service.batch_size):
+        if stop_requested.is_set():
+            break
+        processed += len(search_result_ids)
+        start = perf_counter()
+        search_result_ids = [search_result_id['_id'] for search_result_id in search_result_ids]
+        try:
+            score_search_results(semantic_search_service, search_result_ids)
+        except ConnectionError:
+            raise
+        except Exception as error:
+            # a search result breaks the batch, they are scored one by one so only that one fails
+            semantic_search_service.logging_service.logger.warning('semantic search batch failed, one by one: %s',
+                                                                   error)
+            for search_result_id in search_result_ids:
+                try:
+                    score_search_results(semantic_search_service, [search_result_id])
+                except ConnectionError:
+                    raise
+                except Exception as error:
+                    semantic_search_service.logging_service.logger.exception(
+                        'semantic search for search result: %s failed: %s', search_result_id, error)
+                    semantic_search_service.fail_search_result(search_result_id, error)
+                    metrics.count_item("semantic_search", "failed", type(error).__name__)
+        semantic_search_service.logging_service.logger.debug('semantic search: %d titles, %.1f titles/s',
+                                                             len(search_result_ids),
+                                                             len(search_result_ids) / (perf_counter() - start))
+    return processed
+
+def score_search_results(semantic_search_service: 'SemanticSearchService', search_result_ids):
+    titles = semantic_search_service.get_titles(search_result_ids)
+    scores = semantic_search_service.do_semantic_search_batch(list(titles.values()))
+    # add the distances to the search results
+    semantic_search_service.update_scores(dict(zip(titles.keys(), scores)))
+    metrics.count_item("semantic_search", "processed", amount=len(titles))
+    profiler.count_items(len(titles))
+    unscored = scores.count(None)
+    metrics.count_item("semantic_search", "succeeded", amount=len(titles) - unscored)
+    if unscored:
+        metrics.count_item("semantic_search", "failed", "empty_index", amount=unscored)
+
+@cli.command()
+@click.pass_context
+@inject
+def run_pipeline(
+        ctx,
+        pipeline_supervisor: 'PipelineSupervisor' = Provide[Container.pipeline_supervisor],
+):  #python -m app.src.main run-pipeline
+    """
+        Runs every stage continuously in its own worker processes until
+        SIGTERM or SIGINT, the worker counts are set in the pipeline section
+        of config.ini.
+        """
+    # the workers get the options of the cli group and the worker counts, for their metrics ports
+    pipeline_supervisor.run(run_pipeline_worker, ctx.parent.params, pipeline_supervisor.workers)
+
+# the stages of run-pipeline, the ones without claims split the _id's over their workers
+PIPELINE_STAGES = {
+    "unread_emails": lambda partition: process_unread_emails.callback(),
+    "email_body": lambda partition: process_email_body.callback(partition),
+    "search_doi": lambda partition: process_search_doi.callback(),
+    "crossref": lambda partition: process_crossref.callback(partition),
+    "semantic_search": lambda partition: process_semantic_search.callback(partition),
+}
+
+def run_pipeline_worker(stage, worker_index, worker_count, idle_backoff_min_seconds, idle_backoff_max_seconds,
+                        options, workers):
+    name = f"run-pipeline-{stage}-{worker_index}"
+    metrics_dir = options['metrics_dir']
+    # a spawned worker starts without the container of the parent process
+    if options['trace_dir']:
+        tracer.configure(os.path.join(options['trace_dir'], f"{name}.jsonl"))
+    if options['profile']:
+        start_profiler(options['profile'], options['profile_dir'], name, options['profile_items'],
+                       options['profile_interval_ms'])
+    container = Container()
+    container.init_resources()
+    container.wire(modules=[__name__])
+    if options['metrics_port']:
+        # the registry of a spawned worker is its own, the supervisor's endpoint doesn't see it
+        metrics.serve(get_worker_metrics_port(options['metrics_port'], workers, stage, worker_index))
+    partition = (worker_index, worker_count)
+    after_pass = None
+    if metrics_dir:
+        # every worker keeps its own metrics file up to date
+        after_pass = lambda: metrics.dump(os.path.join(metrics_dir, f"{name}.prom"))
+    run_stage_loop(lambda: PIPELINE_STAGES[stage](partition), idle_backoff_min_seconds, idle_backoff_max_seconds,
+                   after_pass)
+    stop_profiler()
+
+@cli.command()
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'export_format', type=click.Choice(['auto', 'csv', 'parquet']), default='auto',
+              show_default=True, help='auto: parquet for a .parquet file, csv otherwise.')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='Only the alerts sent on or after this day.')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help='Only the alerts sent on or before this day.')
+@click.option('--subject', help='Only the alerts with a subject matching this regular expression.')
+@click.option('--min-score', type=float, help='Only the search results with at least this semantic search score.')
+@click.option('--max-score', type=float, help='Only the search results with at most this semantic search score.')
+@inject
+def export(
+        output, export_format, since, until, subject, min_score, max_score,
+        export_service: 'ExportService' = Provide[Container.export_service],
+):  #python -m app.src.main export results.parquet --since 2025-01-01
+    """
+        Writes the search results with their alert and Crossref metadata to a
+        CSV or Parquet file, joined by MongoDB and written in batches.
+        """
+    filters = {
+        "since": since.strftime('%Y-%m-%d') if since else None,
+        "until": until.strftime('%Y-%m-%d') if until else None,
+        "subject": subject,
+        "min_score": min_score,
+        "max_score": max_score,
+    }
+    export_service.create_indexes()
+    rows = export_service.export(output, filters, export_format)
+    click.echo(f'{rows} search results written to {output}')
+
+# the stages a reprocess can start from, see reprocess_service
+REPROCESS_STAGES = ("email_body", "search_doi", "crossref", "semantic_search")
+
+@cli.command()
+@click.option('--stage', required=True, type=click.Choice(REPROCESS_STAGES),
+              help='The stage to run again, the later stages that depend on it run again as well.')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='Only the alerts sent on or after this day.')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help='Only the alerts sent on or before this day.')
+@click.option('--subject', help='Only the alerts with a subject matching this regular expression.')
+@click.option('--log-message', help='Only the emails or search results with a log message or last error of the stage '
+                                    'matching this regular expression.')
+@click.option('--workers', type=int, help='Worker processes per stage, workers in the reprocess section of config.ini '
+                                          'by default.')
+@click.option('--restart', is_flag=True,
+              help='Reset again instead of continuing the unfinished reprocess with the same stage and filters.')
+@click.option('--dry-run', is_flag=True, help='Only count the emails or search results that would be reset.')
+@click.pass_context
+@inject
+def reprocess(
+        ctx, stage, since, until, subject, log_message, workers, restart, dry_run,
+        reprocess_service: 'ReprocessService' = Provide[Container.reprocess_service],
+):  #python -m app.src.main reprocess --stage search_doi --since 2025-01-01 --log-message "status code"
+    """
+        Resets the emails or search results matching the filters to the state
+        before the stage, in bulk, and runs that stage and the stages after it
+        in worker processes until they are done. Running the same reprocess
+        again continues where an interrupted one stopped.
+        """
+    from app.src.services.reprocess_service import AFFECTED_STAGES
+
+    filters = {
+        "since": since.strftime('%Y-%m-%d') if since else None,
+        "until": until.strftime('%Y-%m-%d') if until else None,
+        "subject": subject,
+        "log_message": log_message,
+    }
+    if dry_run:
+        click.echo(f'{reprocess_service.count_affected(stage, filters)} '
+                   f'{"emails" if stage == "email_body" else "search results"} would be reset')
+        return
+    job = reprocess_service.start_job(stage, filters, restart)
+    click.echo(f'reprocess {job["_id"]}')
+    if job['status'] == "resetting":
+        reprocess_service.reset(job)
+        click.echo(f'reset {job["reset"]["emails"]} emails and {job["reset"]["search_results"]} search results')
+    workers = workers or reprocess_service.workers
+    for affected_stage in AFFECTED_STAGES[stage]:
+        if affected_stage in job['stages_done']:
+            click.echo(f'{affected_stage}: already done')
+            continue
+        try:
+            processed = run_reprocess_stage(reprocess_service, affected_stage,
+                                            reprocess_service.get_workers(affected_stage, workers), ctx.parent.params)
+        except Exception as error:
+            reprocess_service.fail_job(job, affected_stage, error)
+            raise click.ClickException(f'{affected_stage} failed: {error!r}, run the same command again to continue '
+                                       f'from this stage')
+        if stop_requested.is_set():
+            click.echo('interrupted, run the same command again to continue')
+            return
+        reprocess_service.finish_stage(job, affected_stage, processed)
+        click.echo(f'{affected_stage}: {processed} items, {reprocess_service.count_remaining(affected_stage)} '
+                   f'left for a later attempt')
+    reprocess_service.finish_job(job)
+
+def run_reprocess_stage(reprocess_service: 'ReprocessService', stage, workers, options):
+    import multiprocessing
+    import signal
+    from concurrent.futures import ProcessPoolExecutor, wait
+
+    # spawned workers don't inherit the parent's mongo and http connections
+    context = multiprocessing.get_context("spawn")
+    stopping = context.Event()
+
+    def request_stop(signum, frame):
+        stop_requested.set()
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    total = reprocess_service.count_remaining(stage)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_reprocess_worker,
+                             initargs=(stopping, options)) as executor, \
+            click.progressbar(length=total, label=stage) as progress:
+        futures = [executor.submit(reprocess_worker, stage, worker_index, workers, options['metrics_dir'])
+                   for worker_index in range(workers)]
+        shown = 0
+        pending = futures
+        while pending:
+            finished, pending = wait(pending, timeout=1)
+            done = min(total, max(0, total - reprocess_service.count_remaining(stage)))
+            progress.update(done - shown)
+            shown = done
+    # every worker has finished, the first error of a worker fails the stage
+    return sum(future.result() for future in futures)
+
+def init_reprocess_worker(stopping, options):
+    import signal
+    import threading
+
+    # the parent decides when to stop, the workers finish their current item then
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threading.Thread(target=lambda: stopping.wait() and stop_requested.set(), name="stop-watcher",
+                     daemon=True).start()
+    name = f"reprocess-{os.getpid()}"
+    if options['trace_dir']:
+        tracer.configure(os.path.join(options['trace_dir'], f"{name}.jsonl"))
+    container = Container()
+    container.init_resources()
+    container.wire(modules=[__name__])
+
+# runs the stage in a worker process until it finds nothing left, failed items wait for their retry
+def reprocess_worker(stage, worker_index, worker_count, metrics_dir):
+    processed = 0
+    partition = (worker_index, worker_count)
+    while not stop_requested.is_set() and (items := PIPELINE_STAGES[stage](partition)):
+        processed += items
+    if metrics_dir:
+        metrics.dump(os.path.join(metrics_dir, f"reprocess-{stage}-{worker_index}.prom"))
+    return processed
+
+@cli.command()
+@click.option('--top', default=10, show_default=True, help='Number of rows per table.')
+@click.pass_context
+def trace_summary(ctx, top):  #python -m app.src.main trace-summary
+    """
+        Summarizes the spans in the trace directory: the stages and hosts
+        that took the most time and the slowest search results.
+        """
+    stages = {}
+    hosts = {}
+    search_results = []
+    for name, duration, attributes, status_code in read_spans(get_trace_filenames(ctx.parent.params['trace_dir'])):
+        stages.setdefault(name, []).append(duration)
+        if "server.address" in attributes:
+            host = hosts.setdefault(attributes["server.address"], {"durations": [], "bytes": 0, "errors": 0})
+            host["durations"].append(duration)
+            host["bytes"] += attributes.get("http.response.body.size") or 0
+            host["errors"] += status_code == STATUS_CODE_ERROR or "error.type" in attributes
+        if name == "search_result":
+            search_results.append((duration, str(attributes.get("search_result.id")),
+                                   attributes.get("search_doi.outcome", "error")))
+    click.echo(f"{'span':<32} {'count':>7} {'total s':>10} {'p50 s':>8} {'p99 s':>8} {'max s':>8}")
+    for name, durations in sorted(stages.items(), key=lambda item: -sum(item[1]))[:top]:
+        durations.sort()
+        click.echo(f"{name:<32} {len(durations):>7} {sum(durations):>10.1f} {percentile(durations, 50):>8.3f} "
+                   f"{percentile(durations, 99):>8.3f} {durations[-1]:>8.3f}")
+    click.echo(f"\n{'host':<32} {'requests':>8} {'total s':>10} {'p99 s':>8} {'MiB':>8} {'errors':>7}")
+    for host, totals in sorted(hosts.items(), key=lambda item: -sum(item[1]["durations"]))[:top]:
+        durations = sorted(totals["durations"])
+        click.echo(f"{host:<32} {len(durations):>8} {sum(durations):>10.1f} {percentile(durations, 99):>8.3f} "
+                   f"{totals['bytes'] / 2 ** 20:>8.1f} {totals['errors']:>7}")
+    click.echo(f"\n{'search result':<32} {'s':>8} outcome")
+    for duration, search_result_id, outcome in sorted(search_results, reverse=True)[:top]:
+        click.echo(f"{search_result_id:<32} {duration:>8.1f} {outcome}")
+
+def percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+@cli.command()
+@inject
+def serve_semantic_search(
+        semantic_search_server_provider: Callable[[], 'SemanticSearchServer'] =
+        Provide[Container.semantic_search_server.provider],
+):  #python -m app.src.main serve-semantic-search
+    """
+        Loads the embedding model and the IMIS index once and answers the
+        semantic searches of every process started with mode=remote.
+        """
+    from app.src.services.semantic_search_server import get_authkey
+
+    # checked before the model and the index are loaded
+    try:
+        get_authkey()
+    except RuntimeError as error:
+        raise click.ClickException(str(error))
+    semantic_search_server = semantic_search_server_provider()
+    try:
+        semantic_search_server.serve_forever()
+    except KeyboardInterrupt:
+        semantic_search_server.close()
+
+@cli.command()
+@click.option('--json', 'as_json', is_flag=True, help='Print the status as JSON.')
+@inject
+def status(
+        as_json,
+        status_service: 'StatusService' = Provide[Container.status_service],
+):  #python -m app.src.main status
+    """
+        Shows the pending, in progress, failed and done items of every stage,
+        the age of the oldest pending item and the items done in the last hour.
+        """
+    import json
+
+    status_service.create_indexes()
+    pipeline_status = status_service.get_status()
+    if as_json:
+        click.echo(json.dumps(pipeline_status, indent=2))
+        return
+    columns = ("pending", "in_progress", "failed", "done", "oldest_pending_age_seconds", "done_last_hour")
+    click.echo(f'{"stage":<16}' + "".join(f'{column:>{len(column) + 2}}' for column in columns))
+    for stage, counts in pipeline_status["stages"].items():
+        click.echo(f'{stage:<16}' + "".join(f'{"-" if counts[column] is None else counts[column]:>{len(column) + 2}}'
+                                            for column in columns))
+    waiting_retry = pipeline_status["stages"]["search_doi"]["waiting_retry"]
+    click.echo(f'{waiting_retry} pending search_doi items are waiting for their next attempt')
+
+@cli.command()
+@click.option('--host', help='Host to listen on, host in the api section of config.ini by default.')
+@click.option('--port', type=int, help='Port to listen on, port in the api section of config.ini by default.')
+@inject
+def serve_api(
+        host, port,
+        query_service: 'QueryService' = Provide[Container.query_service],
+        status_service: 'StatusService' = Provide[Container.status_service],
+        config: dict = Provide[Container.config.api],
+):  #python -m app.src.main serve-api
+    """
+        Serves the enriched search results over HTTP (FastAPI), see /docs.
+        """
+    import uvicorn
+
+    from app.src.services.query_api import create_app
+
+    query_service.create_indexes()
+    status_service.create_indexes()
+    uvicorn.run(create_app(query_service, status_service), host=host or config['host'], port=port or int(config['port']),
+                log_config=None)
+
+@cli.command()
+@click.option('--batch-sizes', default='1,8,32,128', show_default=True, help='Comma separated batch sizes to compare.')
+@click.option('--limit', default=512, show_default=True, help='Number of search result titles to score.')
+@inject
+def benchmark_semantic_search(
+        batch_sizes,
+        limit,
+        semantic_search_service: 'SemanticSearchService' = Provide[Container.local_semantic_search_service],
+):  #python -m app.src.main benchmark-semantic-search
+    """
+        Scores search result titles with different batch sizes and reports
+        the throughput in titles per second, nothing is written.
+        """
+    titles = semantic_search_service.get_sample_titles(limit)
+    if not titles:
+        click.echo('No search results to score.')
+        return
+    # load the embedding model before measuring
+    semantic_search_service.do_semantic_search_batch(titles[:1])
+    for batch_size in [int(batch_size) for batch_size in batch_sizes.split(',')]:
+        start = perf_counter()
+        for batch in batched(titles, batch_size):
+            semantic_search_service.do_semantic_search_batch(list(batch))
+        elapsed = perf_counter() - start
+        click.echo(f'batch size {batch_size}: {len(titles) / elapsed:.1f} titles/s ({len(titles)} titles in {elapsed:.2f}s)')
+
+@cli.command()
+@click.option('--limit', default=512, show_default=True, help='Number of search result titles to query.')
+@inject
+def benchmark_similarity(
+        limit,
+        semantic_search_service: 'SemanticSearchService' = Provide[Container.local_semantic_search_service],
+):  #python -m app.src.main benchmark-similarity
+    """
+        Builds every similarity backend from the IMIS catalogue in a temporary
+        directory and reports build time, query latency, the growth of the
+        resident memory and how often the top-1 result agrees with the exact search.
+        """
+    from app.src.services.similarity_backend import get_similarity_backend
+
+    corpus = get_benchmark_corpus(semantic_search_service, limit)
+    if corpus is None:
+        click.echo('No search results to query.')
+        return
+    exact_top = None
+    for backend, quantization in (("numpy", "none"), ("numpy", "int8"), ("chroma", "none")):
+        top = benchmark_backend(f'{backend} ({quantization})', corpus, exact_top,
+                                lambda path: get_similarity_backend(backend, path, "benchmark", None, quantization))
+        if exact_top is None:
+            exact_top = top
+
+@cli.command()
+@click.option('--parameters', default='16:100:10,16:100:100,32:200:100,32:200:400', show_default=True,
+              help='Comma separated M:construction_ef:search_ef sets to compare.')
+@click.option('--limit', default=512, show_default=True, help='Number of search result titles to query.')
+@inject
+def benchmark_hnsw(
+        parameters,
+        limit,
+        semantic_search_service: 'SemanticSearchService' = Provide[Container.local_semantic_search_service],
+):  #python -m app.src.main benchmark-hnsw
+    """
+        Builds the Chroma HNSW index over the IMIS catalogue for every parameter
+        set and reports build time, query latency, the growth of the resident
+        memory and the recall@1 against the exact NumPy search.
+        """
+    from app.src.services.similarity_backend import get_similarity_backend
+
+    corpus = get_benchmark_corpus(semantic_search_service, limit)
+    if corpus is None:
+        click.echo('No search results to query.')
+        return
+    exact_top = benchmark_backend('exact', corpus, None,
+                                  lambda path: get_similarity_backend("numpy", path, "benchmark", None, "none"))
+    for parameter_set in parameters.split(','):
+        m, construction_ef, search_ef = (int(value) for value in parameter_set.split(':'))
+        benchmark_backend(f'M={m} construction_ef={construction_ef} search_ef={search_ef}', corpus, exact_top,
+                          lambda path: get_similarity_backend("chroma", path, "benchmark", None, "none",
+                                                              construction_ef, search_ef, m))
+
+def get_benchmark_corpus(semantic_search_service, limit):
+    from app.src.services.semantic_search_service import get_imis_publications
+
+    # both the catalogue and the queries are embedded once, only the backends are measured
+    titles = semantic_search_service.get_sample_titles(limit)
+    if not titles:
+        return None
+    documents = [publication['StandardTitle'] for publication in get_imis_publications()
+                 if publication.get('StandardTitle')]
+    ids = [str(i) for i in range(len(documents))]
+    embeddings = semantic_search_service.embedding_function(documents)
+    queries = semantic_search_service.embed_titles(titles)
+    return ids, documents, embeddings, queries
+
+# builds a backend in a temporary directory, queries it title by title and returns the top-1 ids
+def benchmark_backend(name, corpus, exact_top, create_backend):
+    ids, documents, embeddings, queries = corpus
+    with tempfile.TemporaryDirectory() as path:
+        rss_before = get_rss()
+        start = perf_counter()
+        similarity_backend = create_backend(path)
+        batch_size = similarity_backend.max_batch_size or len(ids)
+        for i in range(0, len(ids), batch_size):
+            batch = slice(i, i + batch_size)
+            similarity_backend.upsert(ids[batch], documents[batch], embeddings[batch], ids[batch])
+        similarity_backend.flush()
+        build_seconds = perf_counter() - start
+        latencies = []
+        top = []
+        for query in queries:
+            start = perf_counter()
+            result_ids, distances = similarity_backend.query([query], 1)
+            latencies.append(perf_counter() - start)
+            top.append(result_ids[0][0])
+        rss_growth = get_rss() - rss_before
+    latencies.sort()
+    recall = sum(a == b for a, b in zip(top, exact_top or top)) / len(top)
+    click.echo(f'{name}: build {build_seconds:.2f}s, '
+               f'p50 {latencies[len(latencies) // 2] * 1000:.2f}ms, '
+               f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms, '
+               f'rss +{rss_growth / 2 ** 20:.1f}MiB, recall@1 {recall:.1%}')
+    return top
+
+@cli.command()
+@click.option('--commands', default='', help='Comma separated commands to measure, all commands when empty.')
+@click.option('--max-ms', type=float, help='Exit with status 1 when the imports of a command take longer.')
+def benchmark_startup(commands, max_ms):  #python -m app.src.main benchmark-startup
+    """
+        Starts a fresh interpreter per command with -X importtime, imports
+        what the command gets injected and reports the import time and the
+        heaviest top level imports.
+        """
+    too_slow = []
+    for command in commands.split(',') if commands else sorted(cli.commands):
+        start = perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_BENCHMARK, command],
+                                capture_output=True, text=True)
+        wall_ms = (perf_counter() - start) * 1000
+        if result.returncode != 0:
+            errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+            click.echo(f'{command}: failed\n' + "\n".join(errors))
+            continue
+        import_times = parse_import_time(result.stderr)
+        total_ms = sum(cumulative for name, cumulative in import_times) / 1000
+        heaviest = ", ".join(f'{name} {cumulative / 1000:.0f}ms'
+                             for name, cumulative in sorted(import_times, key=lambda item: -item[1])[:3])
+        click.echo(f'{command}: imports {total_ms:.0f}ms, interpreter {wall_ms:.0f}ms ({heaviest})')
+        if max_ms is not None and total_ms > max_ms:
+            too_slow.append(command)
+    if too_slow:
+        click.echo(f'slower than {max_ms:.0f}ms: {", ".join(too_slow)}')
+        sys.exit(1)
+
+@cli.command()
+@click.option('--items', default=1000, show_default=True, help='Number of objects to create per domain class.')
+@click.option('--max-kb', type=float, help='Exit with status 1 when 1000 objects of a class take more.')
+def benchmark_memory(items, max_kb):  #python -m app.src.main benchmark-memory
+    """
+        Creates the domain objects the stages create for every item under
+        tracemalloc and reports the peak memory per 1000 objects, the strings
+        they point to are created beforehand and not counted.
+        """
+    from app.src.shared.memory_budget import get_domain_object_factories, peak_kb_per_1000
+
+    too_large = []
+    for name, create in get_domain_object_factories().items():
+        peak_kb = peak_kb_per_1000(create, items)
+        click.echo(f'{name}: {peak_kb:.1f} KiB per 1000 objects')
+        if max_kb is not None and peak_kb > max_kb:
+            too_large.append(name)
+    if too_large:
+        click.echo(f'more than {max_kb:.0f} KiB per 1000 objects: {", ".join(too_large)}')
+        sys.exit(1)
+
+@cli.command()
+@click.option('--emails', default=20, show_default=True, help='Number of synthetic Google Scholar alerts.')
+@click.option('--results-per-email', default=10, show_default=True, help='Search results per alert.')
+@click.option('--catalogue-size', default=1000, show_default=True,
+              help='Unrelated titles in the synthetic IMIS catalogue.')
+@click.option('--latency-ms', default=20.0, show_default=True, help='Latency of every synthetic HTTP answer.')
+@click.option('--error-rate', default=0.0, show_default=True, help='Fraction of the synthetic HTTP answers that fail.')
+@click.option('--database', type=click.Choice(['mongod', 'mongomock']), default='mongod', show_default=True,
+              help='mongod: the benchmark_pipeline database of the configured MongoDB, dropped first, '
+                   'mongomock: in memory with one DOI worker, it isn\'t thread-safe (and it can\'t do the bulk '
+                   'writes of the semantic search with pymongo 4.11).')
+@click.option('--stages', default=','.join(PIPELINE_STAGES), show_default=True, help='Comma separated stages to run.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the synthetic data and of the errors.')
+@click.option('--output', help='Write the results as JSON to this file.')
+@click.option('--baseline', help='Compare the throughput with the JSON results of an earlier run.')
+def benchmark_pipeline(emails, results_per_email, catalogue_size, latency_ms, error_rate, database, stages, seed,
+                       output, baseline):  #python -m app.src.main benchmark-pipeline
+    """
+        Runs the stages from process-unread-emails to process-semantic-search
+        on synthetic alerts, with a local stand-in for the IMAP server and for
+        Scholar, the publishers, Crossref and IMIS, and reports the items per
+        second, the step latency percentiles and the peak RSS.
+        """
+    import json
+    import resource
+
+    from dependency_injector import providers
+
+    from app.src.shared.metrics import STEP_DURATION
+
+    # the services read these when they are imported, so they are set before the first one is
+    imported = [name for name in ("app.src.services.db_service", "app.src.domain.email",
+                                  "app.src.services.semantic_search_service") if name in sys.modules]
+    if imported:
+        raise click.ClickException(f'{", ".join(imported)} was imported before the benchmark could configure it')
+    sender = "Google Scholar Alerts <scholaralerts-noreply@google.com>"
+    os.environ.update(DATABASE="benchmark_pipeline", COLLECTION_EMAILS="emails",
+                      COLLECTION_SEARCH_RESULTS="search_results", COLLECTION_CROSSREF="crossref",
+                      SENDER="scholaralerts-noreply@google.com")
+
+    from app.src.services import synthetic_pipeline
+
+    container = Container()
+    if database == "mongomock":
+        try:
+            import mongomock
+        except ImportError:
+            raise click.ClickException("mongomock is not installed, pip install mongomock or use --database mongod")
+        container.database_client.override(providers.Singleton(mongomock.MongoClient))
+        # two threads could claim the same search result
+        container.search_DOI_service.add_kwargs(workers=1)
+    else:
+        container.database_client().drop_database("benchmark_pipeline")
+
+    publications = synthetic_pipeline.generate_publications(emails * results_per_email, seed)
+    catalogue = synthetic_pipeline.generate_catalogue(publications, catalogue_size,
+                                                      container.config.semantic_search.id_field(), seed)
+    server = synthetic_pipeline.SyntheticWebServer(publications, catalogue, latency_ms / 1000, error_rate,
+                                                   seed).start()
+    mailbox = synthetic_pipeline.SyntheticMailbox(
+        synthetic_pipeline.generate_alert_emails(publications, results_per_email, server.url, sender))
+    os.environ["IMIS"] = f"{server.url}/imis"
+    container.email_service.override(providers.Factory(synthetic_pipeline.SyntheticEmailService,
+                                                       db_service=container.db_service,
+                                                       logging_service=container.logging_service,
+                                                       mailbox=mailbox))
+    container.config.crossref.api_url.from_value(server.url)
+    container.config.search_doi.request_wait_seconds.from_value(0)
+    container.config.search_doi.browser.from_value("none")
+    container.config.semantic_search.mode.from_value("local")
+    results = {"parameters": {"emails": emails, "results_per_email": results_per_email,
+                              "catalogue_size": catalogue_size, "latency_ms": latency_ms, "error_rate": error_rate,
+                              "database": database},
+               "stages": {}, "steps": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        # a fresh similarity index and embedding cache
+        for path in ("chroma_path", "numpy_path", "embedding_cache_path"):
+            container.config.semantic_search[path].from_value(os.path.join(directory, path))
+        container.wire(modules=[__name__])
+        try:
+            for stage in stages.split(","):
+                start = perf_counter()
+                processed = 0
+                # a stage that finds nothing left is done, failed items wait for their retry
+                while items := PIPELINE_STAGES[stage](None):
+                    processed += items
+                seconds = perf_counter() - start
+                results["stages"][stage] = {"items": processed, "seconds": seconds,
+                                            "items_per_second": processed / seconds}
+                click.echo(f'{stage}: {processed} items in {seconds:.2f}s, {processed / seconds:.1f} items/s')
+        finally:
+            container.unwire()
+            server.close()
+    for labels in sorted(metrics.histogram_labels(STEP_DURATION), key=lambda labels: tuple(labels.values())):
+        step = f'{labels["stage"]}/{labels["step"]}'
+        results["steps"][step] = {f"p{round(q * 100)}_ms": metrics.quantile(STEP_DURATION, q, **labels) * 1000
+                                  for q in (0.5, 0.95, 0.99)}
+        click.echo(f'{step}: ' + ", ".join(f'{name} {value:.1f}' for name, value in results["steps"][step].items()))
+    # kilobytes on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    click.echo(f'peak RSS {results["peak_rss_mb"]:.0f} MiB')
+    if baseline:
+        with open(baseline, encoding="utf-8") as baseline_file:
+            baseline_results = json.load(baseline_file)
+        for stage, result in results["stages"].items():
+            before = baseline_results["stages"].get(stage, {}).get("items_per_second")
+            if before:
+                click.echo(f'{stage}: {result["items_per_second"] / before - 1:+.1%} items/s against the baseline')
+    if output:
+        with open(output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+
+# imports the main module and the modules of the services a command gets injected, without creating them
+STARTUP_BENCHMARK = """
+import importlib, sys
+from app.src import main
+for module_name in main.get_command_modules(sys.argv[1]):
+    importlib.import_module(module_name)
+"""
+
+def get_command_modules(command):
+    module_names = set()
+    for parameter in inspect.signature(cli.commands[command].callback).parameters.values():
+        provider = getattr(parameter.default, 'provider', None)
+        if provider is None:
+            continue
+        for dependency in (provider, *provider.traverse()):
+            # configuration options answer every attribute, only the lazy classes have a module name string
+            module_name = getattr(getattr(dependency, 'provides', None), 'module_name', None)
+            if isinstance(module_name, str):
+                module_names.add(module_name)
+    return sorted(module_names)
+
+# (name, cumulative microseconds) of the top level imports in the -X importtime output
+def parse_import_time(output):
+    import_times = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            import_times.append((name.strip(), int(cumulative)))
+    return import_times
+
+def get_rss():
+    # resident memory in bytes, 0 where /proc isn't available
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
 
 
 if __name__ == '__main__':
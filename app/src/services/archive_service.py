@@ -0,0 +1,82 @@
+import mailbox
+import os
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+from app.src.services.db_service import DBService
+from app.src.services.logging_service import LoggingService
+
+ARCHIVE_FORMATS = ("auto", "mbox", "maildir", "msg")
+
+
+class ArchiveService:
+    # reads the alerts of an mbox file, a Maildir or a directory of Outlook .msg files, the messages are parsed by
+    # worker processes in batches of batch_size and inserted together, an email that is already stored is skipped
+    def __init__(self, db_service: DBService, logging_service: LoggingService, workers: int, batch_size: int):
+        self.db_service = db_service
+        self.logging_service = logging_service
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def get_format(self, path):
+        if os.path.isdir(path):
+            if all(os.path.isdir(os.path.join(path, sub_dir)) for sub_dir in ("cur", "new", "tmp")):
+                return "maildir"
+            return "msg"
+        if path.lower().endswith(".msg"):
+            return "msg"
+        return "mbox"
+
+    # (kind, value): ("bytes", the raw message) or ("msg", the filename of a .msg file), one at a time
+    def iter_archive(self, path, archive_format="auto"):
+        if archive_format == "auto":
+            archive_format = self.get_format(path)
+        self.logging_service.logger.info('import archive: reading %s as %s', path, archive_format)
+        match archive_format:
+            case "mbox" | "maildir":
+                archive = mailbox.mbox(path, create=False) if archive_format == "mbox" \
+                    else mailbox.Maildir(path, factory=None, create=False)
+                try:
+                    for key in archive.iterkeys():
+                        yield "bytes", archive.get_bytes(key)
+                finally:
+                    archive.close()
+            case "msg" if os.path.isfile(path):
+                yield "msg", path
+            case "msg":
+                for directory, sub_dirs, filenames in os.walk(path):
+                    sub_dirs.sort()
+                    for filename in sorted(filenames):
+                        if filename.lower().endswith(".msg"):
+                            yield "msg", os.path.join(directory, filename)
+
+    def read_message(self, kind, value):
+        if kind == "msg":
+            return read_msg_file(value)
+        return message_from_bytes(value)
+
+    # returns (inserted, duplicates)
+    def store_emails(self, posts):
+        self.db_service.set_collection("emails")
+        return self.db_service.insert_many_skip_duplicates(posts)
+
+
+# an Outlook message as an email message with the headers and the html body the email service reads
+def read_msg_file(filename):
+    import extract_msg
+
+    msg = extract_msg.openMsg(filename)
+    try:
+        email_message = EmailMessage()
+        email_message["From"] = msg.sender or ""
+        email_message["Subject"] = msg.subject or ""
+        if msg.date is not None:
+            email_message["Date"] = format_datetime(msg.date)
+        if msg.messageId:
+            email_message["Message-ID"] = msg.messageId
+        html_body = msg.htmlBody
+        email_message.set_content(html_body.decode("utf-8", errors="replace") if html_body else "", subtype="html")
+        return email_message
+    finally:
+        msg.close()
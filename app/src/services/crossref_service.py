@@ -1,19 +1,34 @@
-import json
-import re
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-import crossref_commons.retrieval
 from bson import ObjectId
+from dotenv import load_dotenv
+from httpx import HTTPError
 
 from app.src.domain.crossref import Crossref
 from app.src.domain.link import Link
 from app.src.services.db_service import DBService
 from app.src.services.logging_service import LoggingService
+from app.src.shared.helper import as_utc, get_crossref_client, get_crossref_work, normalize_doi, \
+    printable_date_time_now
+from app.src.shared.memory_budget import batch_size_within_budget
+from app.src.shared.metrics import metrics
+
+load_dotenv()
+CROSSREF_MAILTO = os.getenv('CROSSREF_MAILTO')
 
 
 class CrossrefService:
-    def __init__(self, db_service: DBService, logging_service: LoggingService):
+    def __init__(self, db_service: DBService, logging_service: LoggingService, crossref_api_url: str,
+                 concurrency: int, batch_size: int, cache_ttl_days: int, memory_budget_mb: int):
         self.db_service = db_service
         self.logging_service = logging_service
+        self.crossref_api_url = crossref_api_url
+        self.concurrency = concurrency
+        self.batch_size = batch_size_within_budget("crossref", batch_size, memory_budget_mb)
+        self.cache_ttl_days = cache_ttl_days
+        self.is_cache_indexed = False
 
     # query all the unprocessed _id's
     def get_unprocessed_ids(self):
@@ -40,15 +55,61 @@ class CrossrefService:
         return link_object
 
     def get_crossref(self, link_id, link):
+        self.get_crossref_batch([(link_id, link)])
+
+    # links is a list of (search result _id, Link), every DOI is looked up once for the whole batch, returns the _id's
+    # of the links whose lookup failed with a rate limit, server or network error: they are left for the next run.
+    # An expired cache entry is looked up again, it is kept when Crossref can't be reached
+    def get_crossref_batch(self, links):
+        self.ensure_cache_indexes()
+        dois = list(dict.fromkeys(normalize_doi(link.doi) for link_id, link in links))
+        cached = self.get_cached_crossref(dois)
+        now = datetime.now(timezone.utc)
+        missing = [doi for doi in dois if doi not in cached or as_utc(cached[doi]['expires_at']) <= now]
+        self.logging_service.logger.debug('crossref batch: %d links, %d DOIs, %d cached', len(links), len(dois),
+                                          len(dois) - len(missing))
+
+        if missing:
+            client = get_crossref_client(CROSSREF_MAILTO, self.concurrency)
+            try:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    crossref_objects = list(executor.map(lambda doi: self.fetch_crossref(client, doi), missing))
+            finally:
+                client.close()
+            for doi, crossref_object in zip(missing, crossref_objects):
+                if doi in cached and not is_final_response(crossref_object.response_code):
+                    self.logging_service.logger.debug('crossref: %s kept the expired cache entry, %s', doi,
+                                                      crossref_object.log_message)
+                    continue
+                cached[doi] = self.cache_crossref(doi, crossref_object)
+
+        retry_ids = set()
+        for link_id, link in links:
+            cache_entry = cached[normalize_doi(link.doi)]
+            metrics.count_item("crossref", "processed")
+            if cache_entry['log_message'] == "Crossref retrieved successfully.":
+                metrics.count_item("crossref", "succeeded")
+            else:
+                metrics.count_item("crossref", "failed", cache_entry['log_message'].split(':')[0])
+            if not is_final_response(cache_entry.get('response_code')):
+                retry_ids.add(link_id)
+                self.logging_service.logger.debug('crossref for search result: %s left for the next run', link_id)
+                continue
+            self.store_crossref(link_id, cache_entry)
+            self.logging_service.logger.debug('crossref for search result: %s parsed and stored in database', link_id)
+        return retry_ids
+
+    def fetch_crossref(self, client, doi):
         try:
-            response = crossref_commons.retrieval.get_publication_as_json(link.doi)
-            #self.logging_service.logger.debug(json.dumps(response))
+            with metrics.time_step("crossref", "fetch"):
+                response = get_crossref_work(client, self.crossref_api_url, doi)
             #title
             title = response.get('title')
-            if title is not None:
+            if title:
                 title = title[0]
-                self.logging_service.logger.debug('title: ' + title)
+                self.logging_service.logger.debug('title: %s', title)
             else:
+                title = None
                 self.logging_service.logger.debug('title is None')
             #author
             all_author_string = ''
@@ -60,7 +121,7 @@ class CrossrefService:
                     author_string = f"{given} {family}, "
                     all_author_string += author_string
             all_author_string = all_author_string.rstrip(", ")
-            self.logging_service.logger.debug('author: ' + all_author_string)
+            self.logging_service.logger.debug('author: %s', all_author_string)
             #year
             year = response.get('published')
             if year is not None:
@@ -68,42 +129,121 @@ class CrossrefService:
                 year = year[0]
                 year = year[0]
                 year = int(year)
-                self.logging_service.logger.debug('year: ' + str(year))
+                self.logging_service.logger.debug('year: %s', year)
             else:
                 self.logging_service.logger.debug('year is None')
             #publisher
             publisher = response.get('publisher')
             if publisher is not None:
-                self.logging_service.logger.debug('publisher: ' + publisher)
+                self.logging_service.logger.debug('publisher: %s', publisher)
             else:
                 self.logging_service.logger.debug('publisher is None')
             log_message = "Crossref retrieved successfully."
-            crossref_object = Crossref(200, True, title, all_author_string, year, publisher, log_message, "https://doi.org/" + link.doi)
-            self.store_crossref(link_id, crossref_object)
+            return Crossref(200, True, title, all_author_string, year, publisher, log_message, "https://doi.org/" + doi,
+                            f"{self.crossref_api_url}/works/{doi}")
         except ValueError as e:
-            crossref_object = Crossref(response_code=404, log_message='ValueError: ' + str(e), doi_url="https://doi.org/" + link.doi)
-            self.logging_service.logger.error('ValueError: ' + str(e))
-            self.store_crossref(link_id, crossref_object)
+            self.logging_service.logger.error('ValueError: %s', e)
+            return Crossref(response_code=404, log_message='ValueError: ' + str(e), doi_url="https://doi.org/" + doi)
         except ConnectionError as e:
-            all_numbers = re.findall(r'\d+', str(e))
-            crossref_object = Crossref(response_code=all_numbers[0], log_message='ConnectionError: ' + str(e), doi_url="https://doi.org/" + link.doi)
-            self.logging_service.logger.error('ConnectionError: ' + str(e))
-            self.store_crossref(link_id, crossref_object)
-            self.logging_service.logger.debug(
-                f'crossref for search result: {link_id} parsed and stored in database')
-
-    def store_crossref(self, link_id, crossref: Crossref):
+            self.logging_service.logger.error('ConnectionError: %s', e)
+            # 0 like a Crossref that was never reached when the error has no status code
+            return Crossref(response_code=getattr(e, 'status_code', 0), log_message='ConnectionError: ' + str(e),
+                            doi_url="https://doi.org/" + doi)
+        except HTTPError as e:
+            # timeouts and refused connections, response_code 0 like a Crossref that was never reached
+            self.logging_service.logger.error('HTTPError: %s', e)
+            return Crossref(response_code=0, log_message=f'HTTPError: {type(e).__name__}: {e}',
+                            doi_url="https://doi.org/" + doi)
+
+    def ensure_cache_indexes(self):
+        if self.is_cache_indexed:
+            return
+        self.db_service.set_collection("crossref_cache")
+        self.db_service.create_index("DOI", unique=True)
+        # the crossref documents of the search results point to the cache entries, they are kept for good: expires_at
+        # only says when an entry is looked up again. The TTL index of the first version deleted them
+        self.db_service.drop_index_if_exists("expires_at_1")
+        self.is_cache_indexed = True
+
+    # returns a dict DOI -> cache entry for the DOIs that are cached, expired or not
+    def get_cached_crossref(self, dois):
+        where = {"DOI": {"$in": dois}}
+        what = {"DOI": 1, "response_code": 1, "log_message": 1, "expires_at": 1}
+        self.db_service.set_collection("crossref_cache")
+        cache_cursor = self.db_service.select_what_where(what, where)
+        cached = {entry['DOI']: entry for entry in cache_cursor}
+        cache_cursor.close()
+        return cached
+
+    # only successful or not found responses are cached, the search results of the other errors are left unprocessed
+    # and looked up again by the next run. A refresh updates the entry in place, it keeps its _id
+    def cache_crossref(self, doi, crossref: Crossref):
+        cache_entry = {
+            "DOI": doi,
+            "response_code": crossref.response_code,
+            "log_message": crossref.log_message,
+        }
+        if not is_final_response(crossref.response_code):
+            return cache_entry
+        cache_update_where = {
+            "DOI": doi,
+        }
+        cache_update_what = {
+            "created_at": crossref.get_created_at_formatted(),
+            "updated_at": crossref.get_updated_at_formatted(),
+            "expires_at": crossref.created_at + timedelta(days=self.cache_ttl_days),
+            "response_code": crossref.response_code,
+            "is_valid_response": crossref.is_valid_response,
+            "title": crossref.title,
+            "author": crossref.author,
+            "publisher": crossref.publisher,
+            "year": crossref.year,
+            "doi_url": crossref.doi_url,
+            "api_url": crossref.api_url,
+            "log_message": crossref.log_message,
+        }
+        self.db_service.set_collection("crossref_cache")
+        return self.db_service.upsert_and_select_one(cache_update_what, cache_update_where)
+
+    # the crossref document of a search result points to the cache entry of its DOI, the metadata is only in the cache
+    def store_crossref(self, link_id, cache_entry):
+        current_datetime = printable_date_time_now()
         post = {
-                "created_at": crossref.get_created_at_formatted(),
-                "updated_at": crossref.get_updated_at_formatted(),
+                "created_at": current_datetime,
+                "updated_at": current_datetime,
                 "search_result": ObjectId(link_id),
-                "title": crossref.title,
-                "author": crossref.author,
-                "publisher": crossref.publisher,
-                "year": crossref.year,
-                "doi_url": crossref.doi_url,
-                "api_url": crossref.api_url,
-                "log_message": crossref.log_message,
+                "crossref_cache": cache_entry.get('_id'),
+                "doi_url": "https://doi.org/" + cache_entry['DOI'],
+                "log_message": cache_entry['log_message'],
             }
         self.db_service.set_collection("crossref")
-        post_id = self.db_service.insert_one(post)
\ No newline at end of file
+        post_id = self.db_service.insert_one(post)
+
+    # a search result the crossref stage can't handle: its crossref document holds the error and its link is
+    # flagged as processed, so the next pass doesn't stop on it again
+    def store_crossref_failure(self, link_id, error):
+        current_datetime = printable_date_time_now()
+        post = {
+                "created_at": current_datetime,
+                "updated_at": current_datetime,
+                "search_result": ObjectId(link_id),
+                "crossref_cache": None,
+                "doi_url": None,
+                "log_message": f"{type(error).__name__}: {error}",
+            }
+        self.db_service.set_collection("crossref")
+        self.db_service.insert_one(post)
+        search_result_update_where = {
+            "_id": ObjectId(link_id),
+        }
+        search_result_update_what = {
+            "updated_at": current_datetime,
+            "link.is_processed": True,
+        }
+        self.db_service.set_collection("search_results")
+        self.db_service.update_one_what_where(search_result_update_what, search_result_update_where)
+
+
+# 200 and 404 are the answer for the DOI, 429, 5xx and network errors may go away on the next run
+def is_final_response(response_code):
+    return response_code in (200, 404)
@@ -1,19 +1,42 @@
 import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.src.shared.metrics import MONGO_DURATION, metrics
+from app.src.shared.tracing import SPAN_KIND_CLIENT, tracer
 
 load_dotenv()
 DATABASE = os.getenv('DATABASE')
 COLLECTION_EMAILS = os.getenv('COLLECTION_EMAILS')
 COLLECTION_SEARCH_RESULTS = os.getenv('COLLECTION_SEARCH_RESULTS')
 COLLECTION_CROSSREF = os.getenv('COLLECTION_CROSSREF')
+COLLECTION_CROSSREF_TITLE_CACHE = os.getenv('COLLECTION_CROSSREF_TITLE_CACHE', 'crossref_title_cache')
+COLLECTION_CROSSREF_CACHE = os.getenv('COLLECTION_CROSSREF_CACHE', 'crossref_cache')
+COLLECTION_FAILED_URLS = os.getenv('COLLECTION_FAILED_URLS', 'failed_urls')
+COLLECTION_REPROCESS_JOBS = os.getenv('COLLECTION_REPROCESS_JOBS', 'reprocess_jobs')
+DUPLICATE_KEY_ERROR = 11000
 
 class DBService:
     def __init__(self, client: MongoClient):
         self.client = client
         self.db = self.client[DATABASE]
-        self.collection = self.db[COLLECTION_EMAILS]
+        # the current collection is kept per thread so the service can be shared by worker threads
+        self.local = threading.local()
+
+    @property
+    def collection(self):
+        if not hasattr(self.local, 'collection'):
+            self.local.collection = self.db[COLLECTION_EMAILS]
+        return self.local.collection
+
+    @collection.setter
+    def collection(self, collection):
+        self.local.collection = collection
 
     def set_collection(self, collection):
         match collection:
@@ -23,21 +46,115 @@ class DBService:
                 self.collection = self.db[COLLECTION_SEARCH_RESULTS]
             case 'crossref':
                 self.collection = self.db[COLLECTION_CROSSREF]
+            case 'crossref_title_cache':
+                self.collection = self.db[COLLECTION_CROSSREF_TITLE_CACHE]
+            case 'crossref_cache':
+                self.collection = self.db[COLLECTION_CROSSREF_CACHE]
+            case 'failed_urls':
+                self.collection = self.db[COLLECTION_FAILED_URLS]
+            case 'reprocess_jobs':
+                self.collection = self.db[COLLECTION_REPROCESS_JOBS]
 
     def insert_one(self, document):
-        document_id = self.collection.insert_one(document).inserted_id
+        with self.timed("insert_one"):
+            document_id = self.collection.insert_one(document).inserted_id
         return document_id
 
+    # the documents that would break a unique index are skipped, returns (inserted, duplicates)
+    def insert_many_skip_duplicates(self, documents):
+        if not documents:
+            return 0, 0
+        with self.timed("insert_many"):
+            try:
+                inserted = len(self.collection.insert_many(documents, ordered=False).inserted_ids)
+                return inserted, 0
+            except BulkWriteError as error:
+                errors = error.details.get('writeErrors', [])
+                if any(write_error['code'] != DUPLICATE_KEY_ERROR for write_error in errors):
+                    raise
+                return error.details['nInserted'], len(errors)
+
     def select_one(self, document_id):
-        document = self.collection.find_one({'_id': document_id})
+        with self.timed("find_one"):
+            document = self.collection.find_one({'_id': document_id})
         return document
 
     def select_what_where(self, what, where):
-        result = self.collection.find(where, what)
+        # only the creation of the cursor, the batches are fetched while iterating
+        with self.timed("find"):
+            result = self.collection.find(where, what)
+        return result
+
+    def aggregate(self, pipeline, **kwargs):
+        # only the creation of the cursor, like select_what_where
+        with self.timed("aggregate"):
+            result = self.collection.aggregate(pipeline, **kwargs)
         return result
 
     def update_one_what_where(self, what, where):
-        for k, v in what.items():
-            result = self.collection.update_one(where, {'$set': {k: v}})
+        with self.timed("update_one"):
+            for k, v in what.items():
+                result = self.collection.update_one(where, {'$set': {k: v}})
+
+    # updates is a list of (what, where), sent to mongo in one round trip
+    def bulk_update_what_where(self, updates):
+        if not updates:
+            return None
+        with self.timed("bulk_write"):
+            result = self.collection.bulk_write([UpdateOne(where, {'$set': what}) for what, where in updates],
+                                                ordered=False)
+        return result
+
+    # update is a complete update document ($set, $unset, ...) applied to every document matching where
+    def update_many_where(self, update, where):
+        with self.timed("update_many"):
+            result = self.collection.update_many(where, update)
+        return result
 
+    def delete_many_where(self, where):
+        with self.timed("delete_many"):
+            result = self.collection.delete_many(where)
+        return result
+
+    def count_where(self, where):
+        with self.timed("count_documents"):
+            count = self.collection.count_documents(where)
+        return count
+
+    def upsert_one_what_where(self, what, where):
+        with self.timed("upsert_one"):
+            result = self.collection.update_one(where, {'$set': what}, upsert=True)
+        return result
+
+    def upsert_and_select_one(self, what, where):
+        with self.timed("find_one_and_update"):
+            document = self.collection.find_one_and_update(where, {'$set': what}, upsert=True,
+                                                           return_document=ReturnDocument.AFTER)
+        return document
+
+    def create_index(self, keys, **kwargs):
+        with self.timed("create_index"):
+            index_name = self.collection.create_index(keys, **kwargs)
+        return index_name
+
+    def drop_index_if_exists(self, index_name):
+        with self.timed("drop_index"):
+            if index_name in self.collection.index_information():
+                self.collection.drop_index(index_name)
+
+    # atomically take a lease on one document matching where, expired leases can be taken again
+    def claim_one(self, what, where, lease_field, lease_seconds):
+        now = datetime.now(timezone.utc)
+        where = {"$and": [where, {"$or": [{lease_field: None}, {lease_field: {"$lte": now}}]}]}
+        with self.timed("claim_one"):
+            document = self.collection.find_one_and_update(
+                where, {'$set': {lease_field: now + timedelta(seconds=lease_seconds)}}, projection=what)
+        return document
 
+    @contextmanager
+    def timed(self, operation):
+        collection = self.collection.name
+        attributes = {"db.system": "mongodb", "db.operation.name": operation, "db.collection.name": collection}
+        with tracer.span(f"mongo {operation}", attributes, SPAN_KIND_CLIENT), \
+                metrics.time(MONGO_DURATION, operation=operation, collection=collection):
+            yield
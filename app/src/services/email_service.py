@@ -1,16 +1,20 @@
 import email
+import hashlib
 import imaplib
 import os
 import re
 from datetime import datetime, timezone
 from email.header import make_header, decode_header
+from email.utils import parseaddr, parsedate_to_datetime
 
 from dotenv import load_dotenv
+from pymongo.errors import DuplicateKeyError
 
 from app.src.domain.email import Email
 from app.src.services.db_service import DBService
 from app.src.services.logging_service import LoggingService
 from app.src.shared.helper import escape_double_quotes, printable_date_time_now
+from app.src.shared.metrics import metrics
 
 load_dotenv()
 MAIL_SERVER = os.getenv('MAIL_SERVER')
@@ -37,7 +41,7 @@ class EmailService:
         try:
             mail_host.select('inbox')
         except imaplib.IMAP4.error:
-            print('Could not select inbox')
+            self.logging_service.logger.error('Could not select inbox')
             return []
         _, unread = mail_host.search(None, '(UNSEEN)')
         unread_email_ids = unread[0].split()
@@ -45,12 +49,19 @@ class EmailService:
 
     def fetch_email_content(self, mailbox, email_id):
         """Fetches the content of the emails from within the inbox for each email ID."""
-        _, data = mailbox.fetch(email_id, '(RFC822)')
+        with metrics.time_step("email", "imap_fetch"):
+            _, data = mailbox.fetch(email_id, '(RFC822)')
         raw_email = data[0][1]
         return email.message_from_bytes(raw_email)
 
     def parse_email(self, email_message):
         """Parses for relevant information being sought from each email."""
+        current_email = self.read_email(email_message)
+        db_email_id = self.store_email_content(current_email)
+        self.logging_service.logger.debug('email id: %s parsed and stored in database', db_email_id)
+        return {'current_email': current_email, 'db_email_id': db_email_id}
+
+    def read_email(self, email_message):
         sender = str(make_header(decode_header(email_message['From'])))
         subject = str(make_header(decode_header(email_message['Subject'])))
         datetime_str = email_message['Date']
@@ -64,22 +75,39 @@ class EmailService:
                     break
         else:
             email_body = email_message.get_payload(decode=True).decode()
-        current_email = Email(sender, date_sent, subject, email_body)
+        current_email = Email(sender, date_sent, subject, email_body, get_message_id(email_message))
         current_email.check_spam()
-        db_email_id = self.store_email_content(current_email)
-        self.logging_service.logger.debug(f'email id: {db_email_id} parsed and stored in database')
-        return {'current_email': current_email, 'db_email_id': db_email_id}
+        return current_email
+
+    # an email read from the inbox and from an archive is stored once
+    def create_message_id_index(self):
+        # the emails stored before the Message-ID was kept don't have one
+        self.db_service.set_collection("emails")
+        self.db_service.create_index("message_id", unique=True,
+                                     partialFilterExpression={"message_id": {"$type": "string"}})
 
+    # None when the email was already stored, by an archive import
     def store_email_content(self, current_email: Email):
+        post = self.get_email_post(current_email)
+        self.db_service.set_collection("emails")
+        try:
+            post_id = self.db_service.insert_one(post)
+        except DuplicateKeyError:
+            self.logging_service.logger.debug('email %s is already stored', current_email.message_id)
+            return None
+        return post_id
+
+    def get_email_post(self, current_email: Email):
         current_email.log_message = "Email read successfully."
         if current_email.is_spam:
             current_email.log_message = "Email is spam."
-        post = {
+        return {
             "created_at": current_email.get_created_at_formatted(),
             "updated_at": current_email.get_updated_at_formatted(),
             "sender": current_email.sender,
             "date_time": current_email.get_datetime_formatted(),
             "subject": escape_double_quotes(current_email.subject),
+            "message_id": current_email.message_id,
             "body": {
                 "text_html": escape_double_quotes(current_email.body.text_html),
             },
@@ -87,9 +115,6 @@ class EmailService:
             "is_spam": current_email.is_spam,
             "log_message": current_email.log_message,
         }
-        self.db_service.set_collection("emails")
-        post_id = self.db_service.insert_one(post)
-        return post_id
 
     def update_email(self, email_update_what, email_update_where):
         self.db_service.set_collection("emails")
@@ -112,12 +137,39 @@ class EmailService:
         mailbox.copy(email_id, mailboxname)
         mailbox.store(email_id, '+FLAGS', r'(\Deleted)')
 
-    def get_current_email(self, email_id):
+    # the body is only loaded when it's asked for, flagging an email doesn't need it
+    def get_current_email(self, email_id, with_body=False):
+        where = {"_id": email_id}
+        what = None if with_body else {"body": 0}
         self.db_service.set_collection("emails")
-        result = self.db_service.select_one(email_id)
+        email_cursor = self.db_service.select_what_where(what, where)
+        result = email_cursor.next()
+        email_cursor.close()
         date_sent = datetime.strptime(result['date_time'], "%Y-%m-%dT%H:%M:%SZ")
-        current_email = Email(result['sender'], date_sent, result['subject'], result['body']['text_html'])
+        body = result['body']['text_html'] if with_body else None
+        current_email = Email(result['sender'], date_sent, result['subject'], body)
         return current_email
 
-    def log(self, message):
-        self.logging_service.logger.debug(f'{printable_date_time_now()}: {message}')
+    def log(self, message, *args):
+        self.logging_service.logger.debug('%s: ' + message, printable_date_time_now(), *args)
+
+
+# the Message-ID identifies an email that is read twice (from the inbox and from an archive), an email without one
+# gets an id made from its sender, date and subject. An archive writes the headers its own way (a display name,
+# another time zone, encoded words), only the address, the UTC date and the decoded subject are hashed
+def get_message_id(email_message):
+    message_id = email_message['Message-ID']
+    if message_id:
+        return str(message_id).strip()
+    key = "\n".join((get_sender_address(email_message['From']), get_utc_date(email_message['Date']),
+                     str(make_header(decode_header(str(email_message['Subject'] or "")))).strip()))
+    return f"<{hashlib.sha1(key.encode('utf-8')).hexdigest()}@google-scholar-alert>"
+
+def get_sender_address(sender):
+    return parseaddr(str(sender or ""))[1].lower()
+
+def get_utc_date(date):
+    try:
+        return parsedate_to_datetime(str(date)).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    except (TypeError, ValueError):
+        return str(date or "").strip()
@@ -0,0 +1,171 @@
+import csv
+import os
+import re
+from itertools import batched
+
+import pyarrow
+import pyarrow.parquet
+
+from app.src.services.db_service import COLLECTION_EMAILS, DBService
+from app.src.services.logging_service import LoggingService
+from app.src.services.query_service import get_crossref_stages
+
+# the columns of an export and their parquet type, the text columns are strings whatever mongo holds
+COLUMNS = {
+    "search_result_id": "string",
+    "created_at": "string",
+    "alert": "string",
+    "alert_subject": "string",
+    "alert_date_time": "string",
+    "title": "string",
+    "author": "string",
+    "publisher": "string",
+    "year": "string",
+    "url": "string",
+    "media_type": "string",
+    "doi": "string",
+    "is_doi_success": "bool",
+    "score": "double",
+    "crossref_doi_url": "string",
+    "crossref_title": "string",
+    "crossref_author": "string",
+    "crossref_publisher": "string",
+    "crossref_year": "string",
+}
+
+
+class ExportService:
+    # the search results with their alert email and Crossref metadata, joined by mongo and written batch_size rows
+    # at a time, so an export of any size takes the same memory
+    def __init__(self, db_service: DBService, logging_service: LoggingService, batch_size: int):
+        self.db_service = db_service
+        self.logging_service = logging_service
+        self.batch_size = batch_size
+
+    def get_format(self, filename, export_format="auto"):
+        if export_format == "auto":
+            export_format = "parquet" if filename.lower().endswith(".parquet") else "csv"
+        return export_format
+
+    def create_indexes(self):
+        # the search results of the alerts, the same index as the read API's
+        self.db_service.set_collection("search_results")
+        self.db_service.create_index([("email", 1), ("created_at", -1), ("_id", -1)])
+        # the $lookup of the crossref documents of a search result
+        self.db_service.set_collection("crossref")
+        self.db_service.create_index("search_result")
+
+    def get_pipeline(self, filters):
+        search_result_where = {}
+        score = {}
+        if filters.get("min_score") is not None:
+            score["$gte"] = filters['min_score']
+        if filters.get("max_score") is not None:
+            score["$lte"] = filters['max_score']
+        if score:
+            search_result_where["score"] = score
+        alert_where = get_alert_where(filters)
+        if alert_where:
+            # the alerts first: the search results are matched on their email with its index, instead of joining
+            # every search result to its email and dropping most of them
+            search_result_where["email"] = {"$in": self.get_alert_ids(alert_where)}
+        return [
+            {"$match": search_result_where},
+            {"$lookup": {"from": COLLECTION_EMAILS, "localField": "email", "foreignField": "_id", "as": "alert"}},
+            {"$unwind": "$alert"},
+            *get_crossref_stages(),
+            {"$project": {
+                "_id": 1,
+                "created_at": 1,
+                "alert_subject": "$alert.subject",
+                "alert_date_time": "$alert.date_time",
+                "title": 1,
+                "author": 1,
+                "publisher": 1,
+                "year": 1,
+                "url": "$link.url",
+                "media_type": 1,
+                "doi": "$link.DOI",
+                "is_doi_success": "$link.is_DOI_success",
+                "score": 1,
+                "crossref_doi_url": "$crossref.doi_url",
+                "crossref_title": "$crossref.title",
+                "crossref_author": "$crossref.author",
+                "crossref_publisher": "$crossref.publisher",
+                "crossref_year": "$crossref.year",
+            }},
+        ]
+
+    def get_alert_ids(self, alert_where):
+        self.db_service.set_collection("emails")
+        return [document['_id'] for document in self.db_service.select_what_where({"_id": 1}, alert_where)]
+
+    # the rows in batches, the cursor gets a batch from mongo per round trip
+    def get_row_batches(self, filters):
+        # the pipeline reads the ids of the alerts first
+        pipeline = self.get_pipeline(filters)
+        self.db_service.set_collection("search_results")
+        cursor = self.db_service.aggregate(pipeline, batchSize=self.batch_size, allowDiskUse=True)
+        try:
+            for documents in batched(cursor, self.batch_size):
+                yield [get_row(document) for document in documents]
+        finally:
+            cursor.close()
+
+    # writes the export to filename, returns the number of rows
+    def export(self, filename, filters, export_format="auto"):
+        export_format = self.get_format(filename, export_format)
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        rows = 0
+        if export_format == "parquet":
+            schema = pyarrow.schema([(column, pyarrow.type_for_alias(column_type))
+                                     for column, column_type in COLUMNS.items()])
+            with pyarrow.parquet.ParquetWriter(filename, schema, compression="zstd") as writer:
+                for batch in self.get_row_batches(filters):
+                    writer.write_table(pyarrow.Table.from_pylist(batch, schema))
+                    rows += len(batch)
+        else:
+            with open(filename, "w", encoding="utf-8", newline="") as export_file:
+                writer = csv.DictWriter(export_file, fieldnames=list(COLUMNS))
+                writer.writeheader()
+                for batch in self.get_row_batches(filters):
+                    writer.writerows(batch)
+                    rows += len(batch)
+        self.logging_service.logger.info('export: %d rows written to %s', rows, filename)
+        return rows
+
+
+def get_alert_where(filters):
+    alert_where = {}
+    date_time = {}
+    # date_time is stored as %Y-%m-%dT%H:%M:%SZ, the strings sort like the dates
+    if filters.get("since"):
+        date_time["$gte"] = f"{filters['since']}T00:00:00Z"
+    if filters.get("until"):
+        date_time["$lte"] = f"{filters['until']}T23:59:59Z"
+    if date_time:
+        alert_where["date_time"] = date_time
+    if filters.get("subject"):
+        alert_where["subject"] = {"$regex": filters['subject'], "$options": "i"}
+    return alert_where
+
+def get_row(document):
+    row = {}
+    for column, column_type in COLUMNS.items():
+        value = document.get("_id" if column == "search_result_id" else column)
+        if isinstance(value, list) and column_type == "string":
+            value = "; ".join(str(item) for item in value)
+        elif value is not None and column_type == "string":
+            value = str(value)
+        elif value is not None and column_type == "double":
+            value = float(value)
+        row[column] = value
+    row["alert"] = get_alert(row["alert_subject"])
+    return row
+
+# the search of the alert, the text between the first double quotes of the subject
+def get_alert(subject):
+    if subject is None:
+        return None
+    match = re.search(r'"([^"]*)"', subject)
+    return match.group(1) if match is not None else subject
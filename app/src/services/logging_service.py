@@ -1,20 +1,62 @@
+import atexit
+import json
 import logging
 import os
-from logging.handlers import TimedRotatingFileHandler
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from pathlib import Path
 
 LOGGING_FILENAME = os.getenv("LOGGING_FILENAME")
 LOGGING_LEVEL = os.getenv("LOGGING_LEVEL")
+# text or json (one object per line)
+LOGGING_FORMAT = os.getenv("LOGGING_FORMAT", "text")
+
+configure_lock = threading.Lock()
+listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        # the QueueHandler has already put a traceback into the message
+        return json.dumps(entry, ensure_ascii=False)
+
+
 class LoggingService:
+    # a singleton in the container, the records are handed to a queue and written to the file by a background
+    # thread, so a log call never waits for the disk
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        configure_logging()
+
+
+def configure_logging():
+    global listener
+    with configure_lock:
+        if listener is not None:
+            return
+        level = logging.getLevelNamesMapping().get(LOGGING_LEVEL or "", logging.WARNING)
         filename = os.path.join(str(Path(__file__).parent.parent.parent.parent), 'log', LOGGING_FILENAME)
-        match LOGGING_LEVEL:
-            case "DEBUG":
-                logging.basicConfig(handlers=[TimedRotatingFileHandler(filename, when='D', interval=1)], encoding='utf-8', level=logging.DEBUG)
-            case "INFO":
-                logging.basicConfig(handlers=[TimedRotatingFileHandler(filename, when='D', interval=1)], encoding='utf-8', level=logging.INFO)
-            case "WARNING":
-                logging.basicConfig(handlers=[TimedRotatingFileHandler(filename, when='D', interval=1)], encoding='utf-8', level=logging.WARNING)
-            case "ERROR":
-                logging.basicConfig(handlers=[TimedRotatingFileHandler(filename, when='D', interval=1)], encoding='utf-8', level=logging.ERROR)
\ No newline at end of file
+        # log/ isn't in the repository
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        file_handler = TimedRotatingFileHandler(filename, when='D', interval=1, encoding='utf-8')
+        if LOGGING_FORMAT == "json":
+            file_handler.setFormatter(JsonFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        records = queue.SimpleQueue()
+        root = logging.getLogger()
+        root.handlers = [QueueHandler(records)]
+        root.setLevel(level)
+        listener = QueueListener(records, file_handler, respect_handler_level=True)
+        listener.start()
+        # the records still in the queue are written before the process exits
+        atexit.register(listener.stop)
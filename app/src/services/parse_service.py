@@ -1,6 +1,5 @@
 import re
 
-from bs4 import BeautifulSoup
 from bson import ObjectId
 
 from app.src.domain.email_body import EmailBody
@@ -8,6 +7,7 @@ from app.src.domain.search_result import SearchResult
 from app.src.services.db_service import DBService
 from app.src.services.logging_service import LoggingService
 from app.src.shared.helper import undo_escape_double_quotes
+from app.src.shared.metrics import metrics
 
 class ParseService:
     def __init__(self, db_service: DBService, logging_service: LoggingService):
@@ -50,6 +50,13 @@ class ParseService:
     """
 
     def parse_body(self, email_id, email_body):
+        with metrics.time_step("email_body", "parse"):
+            self.parse_body_content(email_id, email_body)
+
+    def parse_body_content(self, email_id, email_body):
+        # the other stages use this service without parsing html
+        from bs4 import BeautifulSoup
+
         parse_log_message = ""
         body_text = email_body.text_html
         # undo escaping the double quotes
@@ -70,13 +77,13 @@ class ParseService:
                 search_result = SearchResult(title, data["author"], data["publisher"], data["date"], snippet,
                                              data["link"], data["media_type"])
                 db_search_result_id = self.store_body_content(email_id, search_result)
-                self.logging_service.logger.debug(
-                    f'search result id: {db_search_result_id} parsed and stored in database')
+                self.logging_service.logger.debug('search result id: %s parsed and stored in database',
+                                                  db_search_result_id)
                 #self.add_to_queue(db_search_result_id)
             except IndexError as error:
                 index, log_message, is_parsed, is_google_scholar_format = error.args
                 parse_log_message += log_message + "\n"
-                self.logging_service.logger.debug('Index error: {}'.format(error))
+                self.logging_service.logger.debug('Index error: %s', error)
         email_body.is_parsed = True
         email_body.log_message = "Body successfully parsed. " + parse_log_message
 
@@ -0,0 +1,114 @@
+import multiprocessing
+import signal
+import threading
+from time import monotonic
+
+from app.src.services.logging_service import LoggingService
+from app.src.shared.metrics import WORKER_RESTARTS, metrics
+
+# set in a worker process when it has to stop, the stages check it between items
+stop_requested = threading.Event()
+
+
+class PipelineSupervisor:
+    # every stage runs in its own worker processes, a worker that dies is started again after restart_delay_seconds,
+    # on SIGTERM or SIGINT every worker is asked to finish its current item and is killed after shutdown_timeout_seconds
+    def __init__(self, logging_service: LoggingService, workers: dict, idle_backoff_min_seconds: int,
+                 idle_backoff_max_seconds: int, restart_delay_seconds: int, shutdown_timeout_seconds: int):
+        self.logging_service = logging_service
+        self.workers = workers
+        self.idle_backoff_min_seconds = idle_backoff_min_seconds
+        self.idle_backoff_max_seconds = idle_backoff_max_seconds
+        self.restart_delay_seconds = restart_delay_seconds
+        self.shutdown_timeout_seconds = shutdown_timeout_seconds
+        # spawned workers don't inherit the parent's mongo and http connections
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = {}
+        self.stopping = threading.Event()
+
+    # target(stage, worker_index, worker_count, idle_backoff_min_seconds, idle_backoff_max_seconds, *args)
+    # runs the stage until stop_requested is set
+    def run(self, target, *args):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        restarts = {}
+        for stage, worker_count in self.workers.items():
+            for worker_index in range(worker_count):
+                self.start(target, args, stage, worker_index, worker_count)
+        while not self.stopping.is_set():
+            for (stage, worker_index), process in list(self.processes.items()):
+                if process.is_alive():
+                    continue
+                restart_at = restarts.get((stage, worker_index))
+                if restart_at is None:
+                    self.logging_service.logger.error('pipeline: %s worker %d exited with code %s, restarting in %ds',
+                                                      stage, worker_index, process.exitcode,
+                                                      self.restart_delay_seconds)
+                    restarts[(stage, worker_index)] = monotonic() + self.restart_delay_seconds
+                elif monotonic() >= restart_at:
+                    del restarts[(stage, worker_index)]
+                    metrics.increment(WORKER_RESTARTS, stage=stage)
+                    self.start(target, args, stage, worker_index, self.workers[stage])
+            self.stopping.wait(1)
+        self.shutdown()
+
+    def start(self, target, args, stage, worker_index, worker_count):
+        process = self.context.Process(
+            target=target,
+            args=(stage, worker_index, worker_count, self.idle_backoff_min_seconds, self.idle_backoff_max_seconds,
+                  *args),
+            name=f"{stage}-{worker_index}"
+        )
+        process.start()
+        self.processes[(stage, worker_index)] = process
+        self.logging_service.logger.debug('pipeline: started %s worker %d (pid %d)', stage, worker_index, process.pid)
+
+    def request_stop(self, signum, frame):
+        self.stopping.set()
+
+    def shutdown(self):
+        self.logging_service.logger.debug('pipeline: stopping the workers')
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = monotonic() + self.shutdown_timeout_seconds
+        for process in self.processes.values():
+            process.join(max(0, deadline - monotonic()))
+            if process.is_alive():
+                self.logging_service.logger.error('pipeline: killing %s, it did not stop in time', process.name)
+                process.kill()
+                process.join()
+
+
+# runs inside a worker process: pass_function() processes what is there and returns how many items it handled,
+# when there was nothing the worker waits, twice as long every time up to idle_backoff_max_seconds
+def run_stage_loop(pass_function, idle_backoff_min_seconds, idle_backoff_max_seconds, after_pass=None):
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.set())
+    idle_backoff = idle_backoff_min_seconds
+    while not stop_requested.is_set():
+        processed = pass_function()
+        if after_pass is not None:
+            after_pass()
+        if processed:
+            idle_backoff = idle_backoff_min_seconds
+            continue
+        stop_requested.wait(idle_backoff)
+        idle_backoff = min(idle_backoff * 2, idle_backoff_max_seconds)
+
+# every worker has its own metrics, the supervisor serves on metrics_port and the workers on the ports after it, in
+# the order of the stages: with one worker per stage unread_emails is on metrics_port + 1, semantic_search on + 5
+def get_worker_metrics_port(metrics_port, workers, stage, worker_index):
+    offset = 1
+    for name, worker_count in workers.items():
+        if name == stage:
+            return metrics_port + offset + worker_index
+        offset += worker_count
+    raise ValueError(f"unknown stage: {stage}")
+
+# a worker of a stage without claims only takes the _id's of its own partition
+def in_partition(object_id, partition):
+    if partition is None:
+        return True
+    worker_index, worker_count = partition
+    return int(str(object_id), 16) % worker_count == worker_index
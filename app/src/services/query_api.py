@@ -0,0 +1,54 @@
+from datetime import date
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+
+from app.src.services.query_service import QueryService
+from app.src.services.status_service import StatusService
+
+
+# the read API of the enriched search results, every answer has an ETag, a client that sends it back in
+# If-None-Match gets a 304 without a body while the answer hasn't changed
+def create_app(query_service: QueryService, status_service: StatusService):
+    app = FastAPI(title="Google Scholar alert results")
+
+    def respond(request, name, parameters, compute):
+        try:
+            etag, body = query_service.get_cached(name, parameters, compute)
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        headers = {"ETag": etag, "Cache-Control": f"max-age={query_service.cache_ttl_seconds}"}
+        if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    @app.get("/search-results")
+    def list_search_results(
+            request: Request,
+            alert: Optional[str] = Query(None, description="The _id of the alert email."),
+            since: Optional[date] = Query(None, description="Only the search results stored on or after this day."),
+            until: Optional[date] = Query(None, description="Only the search results stored on or before this day."),
+            min_score: Optional[float] = Query(None, description="Only the search results with at least this score."),
+            doi_found: Optional[bool] = Query(None, description="Only the search results with or without a DOI."),
+            cursor: Optional[str] = Query(None, description="The next_cursor of the previous page."),
+            limit: Optional[int] = Query(None, ge=1, description="The page size."),
+    ):
+        parameters = {"alert": alert, "since": since and since.isoformat(), "until": until and until.isoformat(),
+                      "min_score": min_score, "doi_found": doi_found, "cursor": cursor, "limit": limit}
+        return respond(request, "search_results", parameters, query_service.list_search_results)
+
+    @app.get("/alerts/top")
+    def get_top_results_per_alert(
+            request: Request,
+            day: Optional[date] = Query(None, description="The day the search results were stored, today by default."),
+            per_alert: int = Query(5, ge=1, description="Search results per alert."),
+    ):
+        parameters = {"day": day and day.isoformat(), "per_alert": per_alert}
+        return respond(request, "top_results_per_alert", parameters, query_service.get_top_results_per_alert)
+
+    # the backlog of every stage, like the status command, computed at most once per cache_ttl_seconds
+    @app.get("/status")
+    def get_status(request: Request):
+        return respond(request, "status", {}, status_service.get_status)
+
+    return app
@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from app.src.services.db_service import COLLECTION_CROSSREF, COLLECTION_CROSSREF_CACHE, COLLECTION_EMAILS, DBService
+from app.src.services.logging_service import LoggingService
+from app.src.shared.ttl_cache import TTLCache
+
+# the fields of a search result the read API returns
+SEARCH_RESULT_FIELDS = {"created_at": 1, "email": 1, "title": 1, "author": 1, "publisher": 1, "year": 1,
+                        "link.url": 1, "link.DOI": 1, "link.is_DOI_success": 1, "media_type": 1, "score": 1}
+# the Crossref metadata of a search result the read API and the export return
+CROSSREF_FIELDS = ("doi_url", "title", "author", "publisher", "year")
+
+
+class QueryService:
+    # the read side of the enriched search results: pages in (created_at, _id) order, newest first, continued
+    # with the cursor of the last page instead of skipping, and the answers kept for cache_ttl_seconds
+    def __init__(self, db_service: DBService, logging_service: LoggingService, cache_ttl_seconds: int,
+                 cache_max_entries: int, page_size: int, max_page_size: int):
+        self.db_service = db_service
+        self.logging_service = logging_service
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.cache = TTLCache(cache_ttl_seconds, cache_max_entries)
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+    def create_indexes(self):
+        self.db_service.set_collection("search_results")
+        self.db_service.create_index([("created_at", -1), ("_id", -1)])
+        self.db_service.create_index([("email", 1), ("created_at", -1), ("_id", -1)])
+        self.db_service.set_collection("crossref")
+        self.db_service.create_index("search_result")
+
+    # (etag, json body) of an answer, from the cache when it was computed less than cache_ttl_seconds ago
+    def get_cached(self, name, parameters, compute):
+        key = (name, tuple(sorted(parameters.items())))
+
+        def compute_body():
+            body = json.dumps(compute(**parameters), default=str, ensure_ascii=False).encode("utf-8")
+            return f'"{hashlib.sha1(body).hexdigest()}"', body
+
+        return self.cache.get_or_compute(key, compute_body)
+
+    def list_search_results(self, alert=None, since=None, until=None, min_score=None, doi_found=None, cursor=None,
+                            limit=None):
+        limit = min(limit or self.page_size, self.max_page_size)
+        conditions = []
+        if alert:
+            conditions.append({"email": parse_object_id(alert)})
+        created_at = {}
+        # created_at is stored as %Y-%m-%dT%H:%M:%SZ, the strings sort like the dates
+        if since:
+            created_at["$gte"] = f"{since}T00:00:00Z"
+        if until:
+            created_at["$lte"] = f"{until}T23:59:59Z"
+        if created_at:
+            conditions.append({"created_at": created_at})
+        if min_score is not None:
+            conditions.append({"score": {"$gte": min_score}})
+        if doi_found is not None:
+            conditions.append({"link.is_DOI_success": doi_found} if doi_found
+                              else {"link.is_DOI_success": {"$ne": True}})
+        if cursor:
+            last_created_at, last_id = decode_cursor(cursor)
+            conditions.append({"$or": [{"created_at": {"$lt": last_created_at}},
+                                       {"created_at": last_created_at, "_id": {"$lt": last_id}}]})
+        where = {"$and": conditions} if conditions else {}
+        pipeline = [
+            {"$match": where},
+            {"$sort": {"created_at": -1, "_id": -1}},
+            {"$limit": limit},
+            {"$project": SEARCH_RESULT_FIELDS},
+            # the joins only run for the search results of the page
+            *get_enrichment_stages(),
+        ]
+        self.db_service.set_collection("search_results")
+        documents = list(self.db_service.aggregate(pipeline))
+        next_cursor = None
+        if len(documents) == limit:
+            next_cursor = encode_cursor(documents[-1]['created_at'], documents[-1]['_id'])
+        return {"items": [get_item(document) for document in documents], "next_cursor": next_cursor}
+
+    # the search results of one day with the highest semantic search score, per alert email
+    def get_top_results_per_alert(self, day=None, per_alert=5):
+        day = day or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        per_alert = min(per_alert, self.max_page_size)
+        pipeline = [
+            {"$match": {"created_at": {"$gte": f"{day}T00:00:00Z", "$lte": f"{day}T23:59:59Z"},
+                        "score": {"$ne": None}}},
+            {"$project": SEARCH_RESULT_FIELDS},
+            {"$sort": {"email": 1, "score": -1, "_id": 1}},
+            {"$group": {"_id": "$email", "results": {"$push": "$$ROOT"}}},
+            {"$project": {"results": {"$slice": ["$results", per_alert]}}},
+            {"$lookup": {"from": COLLECTION_EMAILS, "localField": "_id", "foreignField": "_id", "as": "alert"}},
+            {"$unwind": "$alert"},
+            {"$sort": {"alert.date_time": -1, "_id": 1}},
+        ]
+        self.db_service.set_collection("search_results")
+        alerts = []
+        for group in self.db_service.aggregate(pipeline):
+            alerts.append({
+                "id": str(group['_id']),
+                "subject": group['alert'].get('subject'),
+                "date_time": group['alert'].get('date_time'),
+                "results": [get_item(document) for document in group['results']],
+            })
+        return {"day": day, "alerts": alerts}
+
+
+# the alert email and the Crossref metadata of a search result
+def get_enrichment_stages():
+    return [
+        {"$lookup": {"from": COLLECTION_EMAILS, "localField": "email", "foreignField": "_id", "as": "alert"}},
+        {"$unwind": {"path": "$alert", "preserveNullAndEmptyArrays": True}},
+        *get_crossref_stages(),
+        {"$project": {**SEARCH_RESULT_FIELDS, "alert.subject": 1, "alert.date_time": 1,
+                      **{f"crossref.{field}": 1 for field in CROSSREF_FIELDS}}},
+    ]
+
+# the latest crossref document of a search result, a failed lookup and its retry both stored one: one row per
+# search result whatever the crossref collection holds. The metadata is in the cache entry of the DOI the document
+# points to, crossref is missing when there is no document
+def get_crossref_stages():
+    return [
+        {"$lookup": {"from": COLLECTION_CROSSREF, "localField": "_id", "foreignField": "search_result",
+                     "pipeline": [
+                         {"$sort": {"_id": -1}},
+                         {"$limit": 1},
+                         {"$lookup": {"from": COLLECTION_CROSSREF_CACHE, "localField": "crossref_cache",
+                                      "foreignField": "_id", "as": "cache"}},
+                         {"$project": {"doi_url": 1, **{field: {"$first": f"$cache.{field}"}
+                                                        for field in CROSSREF_FIELDS if field != "doi_url"}}},
+                     ],
+                     "as": "crossref"}},
+        {"$set": {"crossref": {"$first": "$crossref"}}},
+    ]
+
+def get_item(document):
+    link = document.get('link', {})
+    crossref = document.get('crossref')
+    item = {
+        "id": str(document['_id']),
+        "created_at": document.get('created_at'),
+        "title": document.get('title'),
+        "author": document.get('author'),
+        "publisher": document.get('publisher'),
+        "year": document.get('year'),
+        "url": link.get('url'),
+        "media_type": document.get('media_type'),
+        "doi": link.get('DOI'),
+        "is_doi_success": link.get('is_DOI_success'),
+        "score": document.get('score'),
+        "alert_id": str(document['email']) if document.get('email') else None,
+        "crossref": None,
+    }
+    if 'alert' in document:
+        item["alert_subject"] = document['alert'].get('subject')
+    if crossref:
+        item["crossref"] = {field: crossref.get(field) for field in CROSSREF_FIELDS}
+    return item
+
+def encode_cursor(created_at, object_id):
+    return base64.urlsafe_b64encode(f"{created_at}|{object_id}".encode("ascii")).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        created_at, object_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii").split("|")
+        return created_at, ObjectId(object_id)
+    except (ValueError, InvalidId, UnicodeError):
+        raise ValueError(f"invalid cursor: {cursor}")
+
+def parse_object_id(value):
+    try:
+        return ObjectId(value)
+    except InvalidId:
+        raise ValueError(f"invalid id: {value}")
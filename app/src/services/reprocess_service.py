@@ -0,0 +1,225 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+from itertools import batched
+
+from app.src.services.db_service import DBService
+from app.src.services.logging_service import LoggingService
+from app.src.shared.helper import printable_date_time_now
+
+# the stage a reprocess starts from and the stages that have to run again after it
+AFFECTED_STAGES = {
+    "email_body": ("email_body", "search_doi", "crossref", "semantic_search"),
+    "search_doi": ("search_doi", "crossref", "semantic_search"),
+    "crossref": ("crossref",),
+    "semantic_search": ("semantic_search",),
+}
+# the link fields the DOI stage fills in, only the url of the search result stays
+LINK_DOI_FIELDS = ("location_replace_url", "response_code", "response_type", "is_accepted_type", "DOI",
+                   "log_message", "is_DOI_success", "is_processed")
+
+
+class ReprocessService:
+    # a reprocess job resets the emails or search results matching its filters to the state before the stage it
+    # starts from, then the affected stages run again. The job is stored, running the same reprocess again
+    # continues an unfinished job instead of resetting what was already processed again
+    def __init__(self, db_service: DBService, logging_service: LoggingService, workers: int, chunk_size: int,
+                 semantic_search_mode: str):
+        self.db_service = db_service
+        self.logging_service = logging_service
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.semantic_search_mode = semantic_search_mode
+
+    def get_job_id(self, stage, filters):
+        key = json.dumps({"stage": stage, "filters": filters}, sort_keys=True)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    # the unfinished job with the same stage and filters, or a new one
+    def start_job(self, stage, filters, restart=False):
+        job_id = self.get_job_id(stage, filters)
+        self.db_service.set_collection("reprocess_jobs")
+        job = self.db_service.select_one(job_id)
+        if job is not None and job['status'] != "finished" and not restart:
+            self.logging_service.logger.info('reprocess %s: resuming, %s', job_id, job['status'])
+            if job['status'] == "failed":
+                self.update_job(job, {"status": "running"})
+            return job
+        current_datetime = printable_date_time_now()
+        job = {
+            "_id": job_id,
+            "created_at": current_datetime,
+            "updated_at": current_datetime,
+            "stage": stage,
+            "filters": filters,
+            "status": "resetting",
+            "reset": {},
+            "stages_done": [],
+            "processed": {},
+        }
+        self.db_service.upsert_one_what_where({key: value for key, value in job.items() if key != "_id"},
+                                              {"_id": job_id})
+        return job
+
+    def update_job(self, job, what):
+        what["updated_at"] = printable_date_time_now()
+        self.db_service.set_collection("reprocess_jobs")
+        self.db_service.update_one_what_where(what, {"_id": job['_id']})
+        for key, value in what.items():
+            job[key] = value
+
+    def get_email_where(self, filters):
+        where = {"is_spam": False}
+        date_time = {}
+        # date_time is stored as %Y-%m-%dT%H:%M:%SZ, the strings sort like the dates
+        if filters.get("since"):
+            date_time["$gte"] = f"{filters['since']}T00:00:00Z"
+        if filters.get("until"):
+            date_time["$lte"] = f"{filters['until']}T23:59:59Z"
+        if date_time:
+            where["date_time"] = date_time
+        if filters.get("subject"):
+            where["subject"] = {"$regex": filters['subject'], "$options": "i"}
+        return where
+
+    def has_email_filter(self, filters):
+        return any(filters.get(key) for key in ("since", "until", "subject"))
+
+    def get_search_result_where(self, stage, filters):
+        log_message = {"$regex": filters['log_message'], "$options": "i"} if filters.get("log_message") else None
+        match stage:
+            case "search_doi":
+                where = {}
+                if log_message:
+                    # a lookup that ended without a DOI, or one that failed and is waiting for its next attempt
+                    where["$or"] = [{"link.log_message": log_message}, {"retry.last_error": log_message},
+                                    {"log_message": log_message}]
+            case "crossref":
+                where = {"link.is_DOI_success": True}
+                if log_message:
+                    where["link.log_message"] = log_message
+            case _:
+                where = {"is_processed": True, "link.is_DOI_success": False}
+                if log_message:
+                    where["link.log_message"] = log_message
+        return where
+
+    def get_ids(self, collection, where):
+        self.db_service.set_collection(collection)
+        cursor = self.db_service.select_what_where({"_id": 1}, where)
+        for document in cursor:
+            yield document['_id']
+
+    # the _id's of the documents the job resets, in chunks
+    def get_affected_id_chunks(self, stage, filters):
+        if stage == "email_body":
+            where = self.get_email_where(filters)
+            if filters.get("log_message"):
+                where["body.log_message"] = {"$regex": filters['log_message'], "$options": "i"}
+            yield from batched(self.get_ids("emails", where), self.chunk_size)
+            return
+        where = self.get_search_result_where(stage, filters)
+        if not self.has_email_filter(filters):
+            yield from batched(self.get_ids("search_results", where), self.chunk_size)
+            return
+        # the date and the subject are those of the alert email
+        email_ids = list(self.get_ids("emails", self.get_email_where(filters)))
+        for email_id_chunk in batched(email_ids, self.chunk_size):
+            chunk_where = {"$and": [where, {"email": {"$in": list(email_id_chunk)}}]}
+            yield from batched(self.get_ids("search_results", chunk_where), self.chunk_size)
+
+    def count_affected(self, stage, filters):
+        return sum(len(chunk) for chunk in self.get_affected_id_chunks(stage, filters))
+
+    # every update is idempotent, a reset that was interrupted is simply done again
+    def reset(self, job):
+        stage = job['stage']
+        emails = search_results = 0
+        # the _id's are read before the first update, an updated document can otherwise come back in the cursor
+        for chunk in list(self.get_affected_id_chunks(stage, job['filters'])):
+            chunk = list(chunk)
+            if stage == "email_body":
+                emails += self.reset_emails(chunk)
+            else:
+                search_results += self.reset_search_results(stage, chunk)
+        self.logging_service.logger.info('reprocess %s: reset %d emails and %d search results from %s', job['_id'],
+                                         emails, search_results, stage)
+        self.update_job(job, {"status": "running", "reset": {"emails": emails, "search_results": search_results}})
+
+    def reset_emails(self, email_ids):
+        # parsing the body again creates the search results again
+        search_result_ids = list(self.get_ids("search_results", {"email": {"$in": email_ids}}))
+        self.delete_crossref(search_result_ids)
+        self.db_service.set_collection("search_results")
+        self.db_service.delete_many_where({"email": {"$in": email_ids}})
+        self.db_service.set_collection("emails")
+        result = self.db_service.update_many_where({
+            "$set": {"is_processed": False, "updated_at": printable_date_time_now()},
+            "$unset": {"body.is_parsed": "", "body.is_google_scholar_format": "", "body.log_message": ""},
+        }, {"_id": {"$in": email_ids}})
+        return result.matched_count
+
+    def reset_search_results(self, stage, search_result_ids):
+        match stage:
+            case "search_doi":
+                update = {
+                    "$set": {"is_processed": False},
+                    "$unset": {"doi_state": "", "retry": "", **{f"link.{field}": "" for field in LINK_DOI_FIELDS}},
+                }
+                self.delete_crossref(search_result_ids)
+            case "crossref":
+                update = {"$set": {"link.is_processed": False}}
+                self.delete_crossref(search_result_ids)
+            case _:
+                update = {"$set": {"link.is_processed": False, "score": 0}}
+        update["$set"]["updated_at"] = printable_date_time_now()
+        self.db_service.set_collection("search_results")
+        result = self.db_service.update_many_where(update, {"_id": {"$in": search_result_ids}})
+        return result.matched_count
+
+    def delete_crossref(self, search_result_ids):
+        if not search_result_ids:
+            return
+        self.db_service.set_collection("crossref")
+        self.db_service.delete_many_where({"search_result": {"$in": search_result_ids}})
+
+    # what the stage still has to process, the selection of get_unprocessed_ids of the stage
+    def count_remaining(self, stage):
+        match stage:
+            case "email_body":
+                collection, where = "emails", {"is_processed": False, "is_spam": False}
+            case "search_doi":
+                collection, where = "search_results", {
+                    "is_processed": False,
+                    "retry.is_dead_letter": {"$ne": True},
+                    "$or": [
+                        {"retry.next_attempt_at": {"$exists": False}},
+                        {"retry.next_attempt_at": {"$lte": datetime.now(timezone.utc)}},
+                    ],
+                }
+            case "crossref":
+                collection, where = "search_results", {"link.is_DOI_success": True, "link.is_processed": False}
+            case _:
+                collection, where = "search_results", {"is_processed": True, "link.is_DOI_success": False,
+                                                       "link.is_processed": False}
+        self.db_service.set_collection(collection)
+        return self.db_service.count_where(where)
+
+    def finish_stage(self, job, stage, processed):
+        self.update_job(job, {"stages_done": job['stages_done'] + [stage],
+                              "processed": {**job['processed'], stage: processed}})
+
+    # in local mode every semantic search worker loads the embedding model and the index, one process does the
+    # stage, in remote mode the workers share the semantic search server
+    def get_workers(self, stage, workers):
+        if stage == "semantic_search" and self.semantic_search_mode != "remote":
+            return 1
+        return workers
+
+    # the stage that failed and why, running the same reprocess again continues from that stage
+    def fail_job(self, job, stage, error):
+        self.logging_service.logger.error('reprocess %s: %s failed, %r', job['_id'], stage, error)
+        self.update_job(job, {"status": "failed", "failed_stage": stage, "error": repr(error)})
+
+    def finish_job(self, job):
+        self.update_job(job, {"status": "finished"})
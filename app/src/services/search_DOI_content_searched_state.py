@@ -1,28 +1,40 @@
 import os
 from pathlib import Path
 
-from selenium import webdriver
-
 from app.src.services.search_DOI_embedded_searched_state import SearchDOIEmbeddedSearchedState
 from app.src.services.search_DOI_state import SearchDOIState
 from app.src.shared.helper import search_in_pdf_file
+from app.src.shared.metrics import metrics
+from app.src.shared.tracing import tracer
+from app.src.shared.transport import is_replaying, record_download, replay_download
 
 
 class SearchDOIContentSearchedState(SearchDOIState):
-    def __init__(self, search_doi_service):
-        super().__init__(search_doi_service)
+    def __init__(self, search_doi_context):
+        super().__init__(search_doi_context)
 
     def to_string(self):
         return "content searched"
 
     def search_embedded(self, link, logging_service):
+        if self.search_doi_context.search_doi_service.browser == "none":
+            logging_service.logger.debug("no browser, the embedded search is skipped")
+            self.search_doi_context.to_state(SearchDOIEmbeddedSearchedState(self.search_doi_context))
+            return
+
+        # selenium is only loaded when a page has to be opened in the browser
+        from selenium import webdriver
+
         url = link.location_replace_url
 
         options = webdriver.ChromeOptions()
 
-        download_folder = os.path.join(str(Path(__file__).parent.parent.parent.parent), "online_pdf")
+        # every search result gets its own download folder so they can be processed at the same time
+        download_folder = os.path.join(str(Path(__file__).parent.parent.parent.parent), "online_pdf",
+                                       str(self.search_doi_context.search_result_id))
+        os.makedirs(download_folder, exist_ok=True)
 
-        logging_service.logger.debug(f"Download folder: {download_folder}")
+        logging_service.logger.debug("Download folder: %s", download_folder)
 
         profile = {
             "plugins.plugins_list": [{"enabled": False, "name": "Chrome PDF Viewer"}],
@@ -41,25 +53,32 @@ class SearchDOIContentSearchedState(SearchDOIState):
         options.add_argument("--no-sandbox") # Bypass OS security  model
         options.add_argument("--headless")
 
-        logging_service.logger.debug("Downloading file from link: {}".format(link.location_replace_url))
-        print("Downloading file from link: {}".format(link.location_replace_url))
+        logging_service.logger.debug("Downloading file from link: %s", link.location_replace_url)
 
-        driver = webdriver.Chrome(options=options)
-        driver.get(url)
+        if is_replaying():
+            # a browser can't be replayed, use the files that were downloaded while recording
+            replay_download(url, download_folder)
+        else:
+            with metrics.time_step("search_doi", "chrome"), tracer.span("chrome", {"url.full": url}):
+                driver = webdriver.Chrome(options=options)
+                driver.get(url)
+                driver.close()
+            record_download(url, [os.path.join(download_folder, f) for f in os.listdir(download_folder)])
 
         logging_service.logger.debug("Status: Download Complete.")
-        print("Status: Download Complete.")
-
-        driver.close()
 
         link.log_message = "pdf downloaded"
 
         for f in os.listdir(download_folder):
-            search_in_pdf_file(os.path.join(download_folder, f), link)
+            logging_service.logger.debug("search_in_pdf_file %s", f)
+            with metrics.time_step("search_doi", "pdf_extraction"), \
+                    tracer.span("pdf_extraction", {"file.size": os.path.getsize(os.path.join(download_folder, f))}):
+                search_in_pdf_file(os.path.join(download_folder, f), link)
             os.remove(os.path.join(download_folder, f))
+        os.rmdir(download_folder)
 
         if link.doi:
             logging_service.logger.debug("DOI found in embedded")
 
 
-        self.search_doi_service.to_state(SearchDOIEmbeddedSearchedState(self.search_doi_service))
\ No newline at end of file
+        self.search_doi_context.to_state(SearchDOIEmbeddedSearchedState(self.search_doi_context))
\ No newline at end of file
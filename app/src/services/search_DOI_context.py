@@ -0,0 +1,21 @@
+class SearchDOIContext:
+    # everything the DOI state machine knows about one search result, so several can be processed at once
+    def __init__(self, search_doi_service, search_result_id, link, media_type, title):
+        self.search_doi_service = search_doi_service
+        self.search_result_id = search_result_id
+        self.link = link
+        self.media_type = media_type
+        self.title = title
+        self.current_state = None
+
+    def get_link(self):
+        return self.link
+
+    def set_link(self, link):
+        self.link = link
+
+    def to_state(self, search_doi_state):
+        self.current_state = search_doi_state
+
+    def processing_finished(self):
+        return self.current_state.to_string().lower() == "embedded searched"
@@ -1,22 +1,24 @@
-from time import sleep
-
 from app.src.services.search_DOI_content_searched_state import SearchDOIContentSearchedState
 from app.src.services.search_DOI_state import SearchDOIState
 from app.src.shared.helper import do_external_request, search_in_text, search_in_pdf
+from app.src.shared.metrics import metrics
+from app.src.shared.transport import wait_between_requests
 
 
 class SearchDOICrossrefSearchedState(SearchDOIState):
-    def __init__(self, search_doi_service):
-        super().__init__(search_doi_service)
+    def __init__(self, search_doi_context):
+        super().__init__(search_doi_context)
 
     def to_string(self):
         return "crossref searched"
 
     def search_content(self, link, media_type, logging_service):
-        sleep(5) # wait 5 seconds to avoid sending too many requests
-        response = link.do_request(logging_service)
+        # wait to avoid sending too many requests
+        wait_between_requests(self.search_doi_context.search_doi_service.request_wait_seconds)
+        with metrics.time_step("search_doi", "content_fetch"):
+            response = link.do_request(logging_service)
         link.response_code = response.status_code
-        logging_service.logger.debug(f"Response code for online resource: {response.status_code}")
+        logging_service.logger.debug("Response code for online resource: %s", response.status_code)
         if response.status_code == 200:
             header = response.headers
             content_type = header.get('content-type')
@@ -40,7 +42,8 @@ class SearchDOICrossrefSearchedState(SearchDOIState):
                         # ToDo media_type isn't used yet, don't know if we can do something smart with it..
                         logging_service.logger.debug("application/pdf")
                         pdf = response.content
-                        search_in_pdf(pdf, link)
+                        with metrics.time_step("search_doi", "pdf_extraction"):
+                            search_in_pdf(pdf, link)
             else:
                 link.is_accepted_type = False
                 link.log_message = "Response type not supported"
@@ -52,4 +55,4 @@ class SearchDOICrossrefSearchedState(SearchDOIState):
 
         if link.doi:
             logging_service.logger.debug("DOI found in content")
-        self.search_doi_service.to_state(SearchDOIContentSearchedState(self.search_doi_service))
\ No newline at end of file
+        self.search_doi_context.to_state(SearchDOIContentSearchedState(self.search_doi_context))
\ No newline at end of file
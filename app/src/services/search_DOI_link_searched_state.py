@@ -1,56 +1,77 @@
 import json
-import re
-from time import sleep
+import logging
 
-import crossref_commons.sampling
+from httpx import HTTPError
 
 from app.src.services.search_DOI_crossref_searched_state import SearchDOICrossrefSearchedState
 from app.src.services.search_DOI_state import SearchDOIState
-from app.src.shared.helper import do_external_request, search_in_text, search_in_pdf
+from app.src.shared.helper import normalize_title, search_crossref_works, token_sort_ratio
+from app.src.shared.metrics import metrics
+from app.src.shared.transport import wait_between_requests
 
 
 class SearchDOILinkedSearchedState(SearchDOIState):
-    def __init__(self, search_doi_service):
-        super().__init__(search_doi_service)
+    def __init__(self, search_doi_context):
+        super().__init__(search_doi_context)
 
     def to_string(self):
         return "link searched"
 
     def search_crossref(self, link, title, logging_service):
-        sleep(5) # wait 5 seconds to avoid sending too many requests
+        search_doi_service = self.search_doi_context.search_doi_service
         try:
-            filter = {}
-            queries = {'query.title': title}
-            response = crossref_commons.sampling.get_sample(size=2, filter=filter, queries=queries)
-            logging_service.logger.debug(json.dumps(response))
-            crossref_match = False
+            title = self.process_title(title)
+            if not title:
+                # nothing to search or to cache on, every such title would share one cache entry
+                logging_service.logger.debug('title without letters or digits, crossref search skipped')
+                return
+            cached = search_doi_service.get_cached_crossref_title(title)
+            if cached is not None:
+                logging_service.logger.debug('crossref title cache hit: %s', title)
+                if cached['DOI']:
+                    link.doi = cached['DOI']
+                    link.is_doi_success = True
+                    logging_service.logger.debug('DOI: %s', link.doi)
+                else:
+                    logging_service.logger.debug('DOI is None')
+                return
+
+            # wait to avoid sending too many requests
+            wait_between_requests(search_doi_service.request_wait_seconds)
+            with metrics.time_step("search_doi", "crossref_search"):
+                response = search_crossref_works(search_doi_service.crossref_api_url, title, search_doi_service.crossref_rows)
+            if logging_service.logger.isEnabledFor(logging.DEBUG):
+                # the whole response is only serialized when it is logged
+                logging_service.logger.debug(json.dumps(response))
+            best_doi = None
+            best_title = None
+            best_similarity = 0.0
             for record in response:
-                if not crossref_match:
-                    crossref_title = record['title'][0]
-                    crossref_title = self.process_title(crossref_title)
-                    title = self.process_title(title)
-
-                    if crossref_title == title:
-                        link.doi = record['DOI']
-                        link.is_doi_success = True
-                        crossref_match = True
-                        logging_service.logger.debug('DOI: ' + link.doi)
-                        logging_service.logger.debug("DOI found in link")
-                    else:
-                        logging_service.logger.debug('DOI is None')
+                if not record.get('title'):
+                    continue
+                crossref_title = self.process_title(record['title'][0])
+                similarity = token_sort_ratio(title, crossref_title)
+                if similarity > best_similarity:
+                    best_doi = record['DOI']
+                    best_title = crossref_title
+                    best_similarity = similarity
+
+            if best_similarity >= search_doi_service.title_similarity_threshold:
+                link.doi = best_doi
+                link.is_doi_success = True
+                logging_service.logger.debug('DOI: %s', link.doi)
+                logging_service.logger.debug("DOI found in crossref")
+                search_doi_service.cache_crossref_title(title, best_doi, best_title, best_similarity)
+            else:
+                logging_service.logger.debug('DOI is None')
+                search_doi_service.cache_crossref_title(title, None, best_title, best_similarity)
 
         except ValueError as e:
-            logging_service.logger.error('ValueError: ' + str(e))
-        except ConnectionError as e:
-            logging_service.logger.error('ConnectionError: ' + str(e))
-            """
-            self.logging_service.logger.debug(
-                f'crossref for search result: {link_id} parsed and stored in database')
-            """
+            logging_service.logger.error('ValueError: %s', e)
+        except HTTPError as e:
+            logging_service.logger.error('HTTPError: %s', e)
         finally:
-            self.search_doi_service.to_state(SearchDOICrossrefSearchedState(self.search_doi_service))
+            self.search_doi_context.to_state(SearchDOICrossrefSearchedState(self.search_doi_context))
 
     def process_title(self, title):
-        title = title.lower()
-        title = re.sub(r'[^a-zA-Z0-9\s]', '', title)
-        return title
+        return normalize_title(title)
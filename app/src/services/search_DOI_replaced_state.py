@@ -4,8 +4,8 @@ from app.src.shared.helper import search_in_text
 
 
 class SearchDOIReplacedState(SearchDOIState):
-    def __init__(self, search_doi_service):
-        super().__init__(search_doi_service)
+    def __init__(self, search_doi_context):
+        super().__init__(search_doi_context)
 
     def to_string(self):
         return "replaced"
@@ -15,4 +15,4 @@ class SearchDOIReplacedState(SearchDOIState):
         if link.doi:
             logging_service.logger.debug("DOI found in link")
 
-        self.search_doi_service.to_state(SearchDOILinkedSearchedState(self.search_doi_service))
\ No newline at end of file
+        self.search_doi_context.to_state(SearchDOILinkedSearchedState(self.search_doi_context))
\ No newline at end of file
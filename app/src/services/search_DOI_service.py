@@ -1,27 +1,83 @@
+import random
 import re
+from datetime import datetime, timedelta, timezone
+
+from httpx import HTTPError
 
 from app.src.domain.link import Link
 from app.src.domain.sciencedirect_link import ScienceDirectLink
 from app.src.services.db_service import DBService
 from app.src.services.logging_service import LoggingService
+from app.src.services.search_DOI_content_searched_state import SearchDOIContentSearchedState
+from app.src.services.search_DOI_context import SearchDOIContext
+from app.src.services.search_DOI_crossref_searched_state import SearchDOICrossrefSearchedState
+from app.src.services.search_DOI_embedded_searched_state import SearchDOIEmbeddedSearchedState
+from app.src.services.search_DOI_link_searched_state import SearchDOILinkedSearchedState
+from app.src.services.search_DOI_replaced_state import SearchDOIReplacedState
 from app.src.services.search_DOI_unprocessed_state import SearchDOIUnprocessedState
+from app.src.shared.helper import as_utc, printable_date_time_now
+from app.src.shared.tracing import tracer
+
+
+class NegativeCacheHit(ConnectionError):
+    # a url that failed recently, expires_at is when it may be requested again
+    def __init__(self, message, expires_at):
+        super().__init__(message)
+        self.expires_at = expires_at
 
 
 class SearchDOIService:
-    def __init__(self, db_service: DBService, logging_service: LoggingService):
+    def __init__(self, db_service: DBService, logging_service: LoggingService, crossref_api_url: str,
+                 crossref_rows: int, title_similarity_threshold: float, title_miss_ttl_days: int, max_attempts: int,
+                 retry_base_delay_seconds: int, retry_max_delay_seconds: int, negative_cache_ttl_hours: int,
+                 workers: int, lease_seconds: int, request_wait_seconds: float, browser: str):
         self.db_service = db_service
         self.logging_service = logging_service
-        self.current_state = SearchDOIUnprocessedState(self)
-        self.link = None
+        self.crossref_api_url = crossref_api_url
+        self.crossref_rows = crossref_rows
+        self.title_similarity_threshold = title_similarity_threshold
+        self.title_miss_ttl_days = title_miss_ttl_days
+        self.max_attempts = max_attempts
+        self.retry_base_delay_seconds = retry_base_delay_seconds
+        self.retry_max_delay_seconds = retry_max_delay_seconds
+        self.negative_cache_ttl_hours = negative_cache_ttl_hours
+        self.is_negative_cache_indexed = False
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.request_wait_seconds = request_wait_seconds
+        self.browser = browser
+        self.crossref_title_cache = {}
+        self.is_title_cache_indexed = False
+
+    # failed search results are skipped until their next attempt is due
+    def get_unprocessed_where(self):
+        return {
+            "is_processed": False,
+            "retry.is_dead_letter": {"$ne": True},
+            "$or": [
+                {"retry.next_attempt_at": {"$exists": False}},
+                {"retry.next_attempt_at": {"$lte": datetime.now(timezone.utc)}},
+            ],
+        }
 
     # query all the unprocessed _id's
     def get_unprocessed_ids(self):
-        where = {"is_processed": False}
+        where = self.get_unprocessed_where()
         what = {"_id": 1}
         self.db_service.set_collection("search_results")
         unprocessed_ids = self.db_service.select_what_where(what, where)
         return unprocessed_ids
 
+    # take the next unprocessed _id that no other worker is busy with, None when there is nothing left
+    def claim_unprocessed_id(self):
+        where = self.get_unprocessed_where()
+        what = {"_id": 1}
+        self.db_service.set_collection("search_results")
+        search_result = self.db_service.claim_one(what, where, "doi_state.lease_until", self.lease_seconds)
+        if search_result is None:
+            return None
+        return search_result['_id']
+
     # for every _id get the corresponding document link
     def get_link_and_media_type(self, search_result_id):
         where = {"_id": search_result_id}
@@ -36,95 +92,289 @@ class SearchDOIService:
         link_cursor.close()
         return link_and_media_type_object
 
-    def get_link_and_media_type_and_title(self, search_result_id):
+    # build the state machine context of a search result, resuming from the last stored stage
+    def get_context(self, search_result_id):
         where = {"_id": search_result_id}
-        what = {"link": 1, "_id": 0, "media_type": 1, "title": 1}
+        what = {"link": 1, "_id": 0, "media_type": 1, "title": 1, "doi_state": 1}
         self.db_service.set_collection("search_results")
-        link_cursor = self.db_service.select_what_where(what, where)
-        link = link_cursor.next()
-        if 'media_type' in link:
-            link_and_media_type_and_title_object = {"link": Link(url=link['link']['url']), "media_type": link['media_type'], "title": link['title']}
+        search_result_cursor = self.db_service.select_what_where(what, where)
+        search_result = search_result_cursor.next()
+        search_result_cursor.close()
+        stage = search_result.get('doi_state', {}).get('stage', "unprocessed")
+        if stage == "unprocessed":
+            link = Link(url=search_result['link']['url'])
         else:
-            link_and_media_type_and_title_object = {"link": Link(url=link['link']['url']), "media_type": "", "title": link['title']}
-        link_cursor.close()
-        return link_and_media_type_and_title_object
-
-    def get_link(self):
-        return self.link
+            link = Link(url=search_result['link']['url'], location_replace_url=search_result['link']['location_replace_url'],
+                        response_code=search_result['link']['response_code'], response_type=search_result['link']['response_type'],
+                        is_accepted_type=search_result['link']['is_accepted_type'], doi=search_result['link']['DOI'],
+                        log_message=search_result['link']['log_message'], is_doi_success=search_result['link']['is_DOI_success'])
+        media_type = search_result.get('media_type', "")
+        search_doi_context = SearchDOIContext(self, search_result_id, link, media_type, search_result['title'])
+        search_doi_context.to_state(self.get_state(stage, search_doi_context))
+        if stage != "unprocessed":
+            search_doi_context.set_link(self.check_link_template(search_doi_context))
+        return search_doi_context
 
-    def set_link(self, link):
-        self.link = link
-
-    def next_step(self, link_and_media_type_and_title):
-        match(self.current_state.to_string()):
-            case "unprocessed":
-                self.replace()
-                return self.link
+    def get_state(self, stage, search_doi_context):
+        match stage:
             case "replaced":
-                link = self.check_link_template()
-                self.set_link(link)
-                self.search_link()
-                return self.link
+                return SearchDOIReplacedState(search_doi_context)
             case "link searched":
-                title = link_and_media_type_and_title['title']
-                self.search_crossref(title)
-                return self.link
+                return SearchDOILinkedSearchedState(search_doi_context)
             case "crossref searched":
-                media_type = link_and_media_type_and_title['media_type']
-                self.search_content(media_type)
-                return self.link
+                return SearchDOICrossrefSearchedState(search_doi_context)
             case "content searched":
-                self.search_embedded()
-                return self.link
+                return SearchDOIContentSearchedState(search_doi_context)
+            case "embedded searched":
+                return SearchDOIEmbeddedSearchedState(search_doi_context)
+            case _:
+                return SearchDOIUnprocessedState(search_doi_context)
 
+    # the url the current stage requests, it is looked up in and added to the negative cache
+    def get_requested_url(self, search_doi_context):
+        link = search_doi_context.get_link()
+        match search_doi_context.current_state.to_string():
+            case "unprocessed":
+                return link.url
+            case "crossref searched" | "content searched":
+                return link.location_replace_url
+        return None
+
+    def next_step(self, search_doi_context):
+        stage = search_doi_context.current_state.to_string()
+        with tracer.span(f"search_doi {stage}", {"search_doi.stage": stage}) as span:
+            self.check_negative_cache(self.get_requested_url(search_doi_context))
+            match stage:
+                case "unprocessed":
+                    self.replace(search_doi_context)
+                case "replaced":
+                    search_doi_context.set_link(self.check_link_template(search_doi_context))
+                    self.search_link(search_doi_context)
+                case "link searched":
+                    self.search_crossref(search_doi_context)
+                case "crossref searched":
+                    self.search_content(search_doi_context)
+                case "content searched":
+                    self.search_embedded(search_doi_context)
+            self.save_context(search_doi_context)
+            span.set_attribute("search_doi.next_stage", search_doi_context.current_state.to_string())
+            span.set_attribute("search_doi.outcome", search_doi_context.get_link().log_message or "")
+        return search_doi_context.get_link()
 
-    def to_state(self, search_doi_state):
-        self.current_state = search_doi_state
+    def replace(self, search_doi_context):
+        search_doi_context.current_state.replace(search_doi_context.link, self.logging_service)
 
-    def reset_state(self):
-        self.current_state = SearchDOIUnprocessedState(self)
+    def check_link_template(self, search_doi_context):
+        link = search_doi_context.link
+        if link.location_replace_url and re.search("https://www.sciencedirect.com/science/article/pii/", link.location_replace_url):
+            return ScienceDirectLink(link.url, link.location_replace_url, link.response_code, link.response_type,
+                                     link.is_accepted_type, link.doi, link.log_message, link.is_doi_success)
+        return link
 
-    def processing_finished(self):
-        return self.current_state.to_string().lower() == "embedded searched"
+    def search_link(self, search_doi_context):
+        search_doi_context.current_state.search_link(search_doi_context.link, self.logging_service)
 
-    def replace(self):
-        self.current_state.replace(self.link, self.logging_service)
+    def search_crossref(self, search_doi_context):
+        search_doi_context.current_state.search_crossref(search_doi_context.link, search_doi_context.title,
+                                                         self.logging_service)
 
-    def check_link_template(self):
-        if re.search("https://www.sciencedirect.com/science/article/pii/", self.link.location_replace_url):
-            return ScienceDirectLink(self.link.url, self.link.location_replace_url)
-        return self.link
+    def search_content(self, search_doi_context):
+        search_doi_context.current_state.search_content(search_doi_context.link, search_doi_context.media_type,
+                                                        self.logging_service)
 
-    def search_link(self):
-        self.current_state.search_link(self.link, self.logging_service)
+    def search_embedded(self, search_doi_context):
+        search_doi_context.current_state.search_embedded(search_doi_context.link, self.logging_service)
 
-    def search_crossref(self, title):
-        self.current_state.search_crossref(self.link, title, self.logging_service)
+    # crossref title lookups are cached by normalized title, a cached miss is stored with DOI None and expires after
+    # title_miss_ttl_days, Crossref may have indexed the paper by then. A found DOI has no expires_at
+    def get_cached_crossref_title(self, normalized_title):
+        now = datetime.now(timezone.utc)
+        cached = self.crossref_title_cache.get(normalized_title)
+        if cached is not None and not is_expired(cached, now):
+            return cached
+        where = {"title": normalized_title, "$or": [{"expires_at": None}, {"expires_at": {"$gt": now}}]}
+        what = {"_id": 0, "DOI": 1, "expires_at": 1}
+        self.db_service.set_collection("crossref_title_cache")
+        if not self.is_title_cache_indexed:
+            self.db_service.create_index("title", unique=True)
+            # mongo removes the expired misses, expires_at None is never removed
+            self.db_service.create_index("expires_at", expireAfterSeconds=0)
+            self.is_title_cache_indexed = True
+        cache_cursor = self.db_service.select_what_where(what, where)
+        cached = next(cache_cursor, None)
+        cache_cursor.close()
+        if cached is not None:
+            self.crossref_title_cache[normalized_title] = cached
+        return cached
 
-    def search_content(self, media_type):
-        self.current_state.search_content(self.link, media_type, self.logging_service)
+    def cache_crossref_title(self, normalized_title, doi, crossref_title, similarity):
+        expires_at = None
+        if doi is None:
+            expires_at = datetime.now(timezone.utc) + timedelta(days=self.title_miss_ttl_days)
+        cached = {"DOI": doi, "expires_at": expires_at}
+        self.crossref_title_cache[normalized_title] = cached
+        cache_update_where = {
+            "title": normalized_title,
+        }
+        cache_update_what = {
+            "updated_at": printable_date_time_now(),
+            "DOI": doi,
+            "crossref_title": crossref_title,
+            "similarity": similarity,
+            "expires_at": expires_at,
+        }
+        self.db_service.set_collection("crossref_title_cache")
+        self.db_service.upsert_one_what_where(cache_update_what, cache_update_where)
 
-    def search_embedded(self):
-        self.current_state.search_embedded(self.link, self.logging_service)
+    # urls that failed recently are not requested again, whichever search result they belong to
+    def check_negative_cache(self, url):
+        if not url:
+            return
+        where = {"url": url, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+        what = {"_id": 0, "error": 1, "expires_at": 1}
+        self.db_service.set_collection("failed_urls")
+        failed_url_cursor = self.db_service.select_what_where(what, where)
+        failed_url = next(failed_url_cursor, None)
+        failed_url_cursor.close()
+        if failed_url is not None:
+            raise NegativeCacheHit(f"url failed recently: {url}: {failed_url['error']}",
+                                   as_utc(failed_url['expires_at']))
 
-    def update_link_content(self, search_result_id):
+    def add_to_negative_cache(self, url, error):
+        if not self.is_negative_cache_indexed:
+            self.db_service.set_collection("failed_urls")
+            self.db_service.create_index("url", unique=True)
+            self.db_service.create_index("expires_at", expireAfterSeconds=0)
+            self.is_negative_cache_indexed = True
+        failed_url_where = {
+            "url": url,
+        }
+        failed_url_what = {
+            "updated_at": printable_date_time_now(),
+            "error": str(error),
+            "expires_at": datetime.now(timezone.utc) + timedelta(hours=self.negative_cache_ttl_hours),
+        }
+        self.db_service.set_collection("failed_urls")
+        self.db_service.upsert_one_what_where(failed_url_what, failed_url_where)
+
+    # schedule the next attempt with exponential backoff and jitter, give up after max_attempts. The url is the one
+    # the failed stage requested (see get_requested_url), not where a redirect ended, so the next lookup finds it
+    def register_failure(self, search_result_id, error, url=None):
+        if isinstance(error, HTTPError) and url:
+            self.add_to_negative_cache(url, error)
+        where = {"_id": search_result_id}
+        what = {"_id": 0, "retry": 1, "link": 1}
+        self.db_service.set_collection("search_results")
+        retry_cursor = self.db_service.select_what_where(what, where)
+        search_result = next(retry_cursor, {})
+        retry_cursor.close()
+        retry = search_result.get('retry', {})
+        # a url in the negative cache isn't requested, so it isn't an attempt
+        is_attempt = not isinstance(error, NegativeCacheHit)
+        attempts = retry.get('attempts', 0) + is_attempt
         search_result_update_where = {
             "_id": search_result_id,
         }
+        if not is_attempt:
+            # wait until the url may be requested again
+            next_attempt_at = error.expires_at
+            if retry.get('next_attempt_at') is not None:
+                next_attempt_at = max(next_attempt_at, as_utc(retry['next_attempt_at']))
+            search_result_update_what = {
+                "updated_at": printable_date_time_now(),
+                "retry": {
+                    "attempts": attempts,
+                    "last_error": str(error),
+                    "next_attempt_at": next_attempt_at,
+                    "is_dead_letter": False,
+                },
+            }
+            self.logging_service.logger.debug('search result: %s waits for the negative cache until %s',
+                                              search_result_id, next_attempt_at)
+        elif attempts >= self.max_attempts:
+            # a dead letter is done with the DOI stage without a DOI, the semantic search stage takes it from here
+            log_message = f"Dead letter after {attempts} attempts: {error}"
+            stored_link = search_result.get('link', {})
+            search_result_update_what = {
+                "updated_at": printable_date_time_now(),
+                "log_message": log_message,
+                "is_processed": True,
+                "link": {
+                    **self.get_link_content(Link(url=stored_link.get('url', ""))),
+                    **stored_link,
+                    "DOI": None,
+                    "log_message": log_message,
+                    "is_DOI_success": False,
+                    "is_processed": False,
+                },
+                "retry": {
+                    "attempts": attempts,
+                    "last_error": str(error),
+                    "is_dead_letter": True,
+                },
+            }
+            self.logging_service.logger.error('search result: %s is a dead letter: %s', search_result_id, error)
+        else:
+            delay = min(self.retry_max_delay_seconds, self.retry_base_delay_seconds * 2 ** (attempts - 1))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            search_result_update_what = {
+                "updated_at": printable_date_time_now(),
+                "retry": {
+                    "attempts": attempts,
+                    "last_error": str(error),
+                    "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+                    "is_dead_letter": False,
+                },
+            }
+            self.logging_service.logger.debug('search result: %s failed (%d attempts), next attempt in %ds',
+                                              search_result_id, attempts, delay)
+        search_result_update_what["doi_state.lease_until"] = None
+        self.db_service.update_one_what_where(search_result_update_what, search_result_update_where)
+
+    # store the stage reached and the partial link results, so a crash resumes from here, the fields are set one by
+    # one so the doi_state.lease_until of the claim stays
+    def save_context(self, search_doi_context):
+        search_result_update_where = {
+            "_id": search_doi_context.search_result_id,
+        }
         search_result_update_what = {
-            "link": {
-                "url": self.link.url,
-                "location_replace_url": self.link.location_replace_url,
-                "response_code": self.link.response_code,
-                "response_type": self.link.response_type,
-                "is_accepted_type": self.link.is_accepted_type,
-                "DOI": self.link.doi,
-                "log_message": self.link.log_message,
-                "is_DOI_success": self.link.is_doi_success,
-                "is_processed": False
+            **{f"link.{field}": value for field, value in self.get_link_content(search_doi_context.link).items()},
+            "doi_state.stage": search_doi_context.current_state.to_string(),
+            "doi_state.updated_at": printable_date_time_now(),
+        }
+        self.db_service.set_collection("search_results")
+        self.db_service.update_one_what_where(search_result_update_what, search_result_update_where)
+
+    def get_link_content(self, link):
+        return {
+            "url": link.url,
+            "location_replace_url": link.location_replace_url,
+            "response_code": link.response_code,
+            "response_type": link.response_type,
+            "is_accepted_type": link.is_accepted_type,
+            "DOI": link.doi,
+            "log_message": link.log_message,
+            "is_DOI_success": link.is_doi_success,
+            "is_processed": False
+        }
+
+    def update_link_content(self, search_doi_context):
+        search_result_update_where = {
+            "_id": search_doi_context.search_result_id,
+        }
+        search_result_update_what = {
+            "link": self.get_link_content(search_doi_context.link),
+            "doi_state": {
+                "stage": search_doi_context.current_state.to_string(),
+                "updated_at": printable_date_time_now(),
+                "lease_until": None,
             },
         }
         self.db_service.set_collection("search_results")
         result = self.db_service.update_one_what_where(search_result_update_what, search_result_update_where)
-        self.logging_service.logger.debug(f'doi for search result: {search_result_id} parsed and stored in database')
+        self.logging_service.logger.debug('doi for search result: %s parsed and stored in database',
+                                          search_doi_context.search_result_id)
+
 
+def is_expired(cached, now):
+    return cached.get('expires_at') is not None and as_utc(cached['expires_at']) <= now
@@ -3,23 +3,23 @@ def get_all_states():
     return ["unprocessed", "replaced", "link_searched", "content_searched", "embedded_searched"]
 
 class SearchDOIState(ABC):
-    def __init__(self, search_doi_service):
-        self.search_doi_service = search_doi_service
+    def __init__(self, search_doi_context):
+        self.search_doi_context = search_doi_context
 
     def replace(self, link, logging_service):
-        print("You can't replace")
+        logging_service.logger.warning("You can't replace")
 
     def search_link(self, link, logging_service):
-        print("You can't search link")
+        logging_service.logger.warning("You can't search link")
 
     def search_crossref(self, link, title, logging_service):
-        print("You can't search crossref")
+        logging_service.logger.warning("You can't search crossref")
 
     def search_content(self, link, media_type, logging_service):
-        print("You can't search content")
+        logging_service.logger.warning("You can't search content")
 
     def search_embedded(self, link, logging_service):
-        print("You can't search embedded")
+        logging_service.logger.warning("You can't search embedded")
 
     def to_string(self):
         pass
\ No newline at end of file
@@ -1,24 +1,25 @@
 import re
-from time import sleep
-
-from bs4 import BeautifulSoup
 
 from app.src.services.search_DOI_replaced_state import SearchDOIReplacedState
 from app.src.services.search_DOI_state import SearchDOIState
 from app.src.shared.helper import do_external_request
+from app.src.shared.metrics import metrics
+from app.src.shared.transport import wait_between_requests
 
 
 class SearchDOIUnprocessedState(SearchDOIState):
-    def __init__(self, search_doi_service):
-        super().__init__(search_doi_service)
+    def __init__(self, search_doi_context):
+        super().__init__(search_doi_context)
 
     def to_string(self):
         return "unprocessed"
 
     def replace(self, link, logging_service):
         url = link.url
-        sleep(5)    # wait 5 seconds to avoid sending to many requests to Google
-        response = do_external_request(url, True)
+        # wait to avoid sending to many requests to Google
+        wait_between_requests(self.search_doi_context.search_doi_service.request_wait_seconds)
+        with metrics.time_step("search_doi", "scholar_redirect"):
+            response = do_external_request(url, True)
         link.response_code = response.status_code
         link.location_replace_url = None
 
@@ -27,6 +28,7 @@ class SearchDOIUnprocessedState(SearchDOIState):
             content_type = header.get('content-type')
             link.response_type = content_type
             if link.check_accepted_type_html():
+                from bs4 import BeautifulSoup
                 soup = BeautifulSoup(response.text, "html.parser")
                 scripts = soup.find_all('script')
                 if (len(scripts) == 0):
@@ -40,8 +42,8 @@ class SearchDOIUnprocessedState(SearchDOIState):
                         match = re.search(pattern, js_code)
                         if match:
                             link.location_replace_url = match.group(1)
-                            logging_service.logger.debug(
-                                f"Extracted location.replace URL for search result link: {link.location_replace_url}")
+                            logging_service.logger.debug("Extracted location.replace URL for search result link: %s",
+                                                         link.location_replace_url)
                         else:
                             link.log_message = "No location.replace url found for search result link"
                             logging_service.logger.debug("No location.replace url found for search result link")
@@ -55,4 +57,4 @@ class SearchDOIUnprocessedState(SearchDOIState):
             link.log_message = "Bad status code for search result link"
             logging_service.logger.debug("Bad status code for search result link")
 
-        self.search_doi_service.to_state(SearchDOIReplacedState(self.search_doi_service))
+        self.search_doi_context.to_state(SearchDOIReplacedState(self.search_doi_context))
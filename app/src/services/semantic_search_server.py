@@ -0,0 +1,127 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+from app.src.services.db_service import DBService
+from app.src.services.logging_service import LoggingService
+from app.src.services.semantic_search_service import BaseSemanticSearchService, SemanticSearchService
+from app.src.shared.metrics import metrics
+
+from dotenv import load_dotenv
+load_dotenv()
+# both sides of the socket have to know the key, there is no default so a server never accepts a well-known key
+SEMANTIC_SEARCH_AUTHKEY = os.getenv('SEMANTIC_SEARCH_AUTHKEY')
+
+
+def get_authkey():
+    if not SEMANTIC_SEARCH_AUTHKEY:
+        raise RuntimeError("SEMANTIC_SEARCH_AUTHKEY is not set, the semantic search server and the processes with "
+                           "mode=remote need the same secret key")
+    return SEMANTIC_SEARCH_AUTHKEY.encode("utf-8")
+
+
+class SemanticSearchServer:
+    # one process holds the embedding model and the index, the pipeline workers send it batches of titles,
+    # the titles of requests that arrive together are embedded and searched as one batch
+    def __init__(self, semantic_search_service: SemanticSearchService, host: str, port: int, max_batch_size: int):
+        self.authkey = get_authkey()
+        self.semantic_search_service = semantic_search_service
+        self.logging_service = semantic_search_service.logging_service
+        self.address = (host, port)
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue()
+        self.listener = None
+
+    def serve_forever(self):
+        threading.Thread(target=self.search_batches, name="semantic-search-batches", daemon=True).start()
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.logging_service.logger.debug('semantic search server listening on %s:%d', *self.address)
+        try:
+            while True:
+                connection = self.listener.accept()
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+        except OSError:
+            # the listener was closed
+            pass
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+
+    # a request is (method, titles), the answer is ("ok", result) or ("error", message)
+    def handle_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, titles = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    match method:
+                        case "search":
+                            future = Future()
+                            self.requests.put((titles, future))
+                            connection.send(("ok", future.result()))
+                        case "ping":
+                            connection.send(("ok", self.semantic_search_service.similarity_backend.count()))
+                        case _:
+                            connection.send(("error", f"unknown method {method}"))
+                except Exception as error:
+                    connection.send(("error", f"{type(error).__name__}: {error}"))
+
+    def search_batches(self):
+        while True:
+            pending = [self.requests.get()]
+            size = len(pending[0][0])
+            while size < self.max_batch_size:
+                try:
+                    pending.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+                size += len(pending[-1][0])
+            titles = [title for request_titles, future in pending for title in request_titles]
+            try:
+                scores = self.semantic_search_service.do_semantic_search_batch(titles)
+            except Exception as error:
+                for request_titles, future in pending:
+                    future.set_exception(error)
+                continue
+            metrics.increment("semantic_search_server_batches_total")
+            metrics.increment("semantic_search_server_titles_total", len(titles))
+            start = 0
+            for request_titles, future in pending:
+                future.set_result(scores[start:start + len(request_titles)])
+                start += len(request_titles)
+
+
+class RemoteSemanticSearchService(BaseSemanticSearchService):
+    # the database side runs in the worker, embedding and searching are done by the semantic search server
+    def __init__(self, db_service: DBService, logging_service: LoggingService, host: str, port: int, batch_size: int,
+                 memory_budget_mb: int):
+        super().__init__(db_service, logging_service, batch_size, memory_budget_mb)
+        self.authkey = get_authkey()
+        self.address = (host, port)
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def request(self, method, titles):
+        with self.lock:
+            try:
+                if self.connection is None:
+                    self.connection = Client(self.address, authkey=self.authkey)
+                self.connection.send((method, titles))
+                status, result = self.connection.recv()
+            except (EOFError, OSError) as error:
+                # connect again on the next request
+                self.connection = None
+                raise ConnectionError(f"Semantic search server at {self.address[0]}:{self.address[1]} "
+                                      f"is not reachable: {error}")
+        if status != "ok":
+            raise ConnectionError(f"Semantic search server failed: {result}")
+        return result
+
+    def do_semantic_search_batch(self, titles):
+        with metrics.time_step("semantic_search", "remote_query"):
+            return self.request("search", titles)
@@ -1,51 +1,41 @@
+import hashlib
+import json
 import os
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from itertools import batched
+from time import perf_counter
 
 from app.src.domain.link import Link
 from app.src.services.db_service import DBService
 from app.src.services.logging_service import LoggingService
+from app.src.services.similarity_backend import get_similarity_backend
+from app.src.shared.embedding_cache import EmbeddingCache
+from app.src.shared.helper import printable_date_time_now
+from app.src.shared.memory_budget import batch_size_within_budget
+from app.src.shared.metrics import metrics
+from app.src.shared.transport import get_transport
 
-import chromadb
-import requests
+import ijson
+import numpy as np
+from httpx import Client
 
 from dotenv import load_dotenv
 load_dotenv()
 IMIS = os.getenv('IMIS')
 
-class SemanticSearchService:
-    def __init__(self, db_service: DBService, logging_service: LoggingService):
+class BaseSemanticSearchService(ABC):
+    # the search results side of the semantic search stage, the scores come from do_semantic_search_batch: the
+    # local service embeds and searches in the process, the remote one asks the semantic search server
+    def __init__(self, db_service: DBService, logging_service: LoggingService, batch_size: int,
+                 memory_budget_mb: int):
         self.db_service = db_service
         self.logging_service = logging_service
-        chroma_client = chromadb.Client()
-        # https://docs.trychroma.com/docs/collections/configure
-        self.collection = chroma_client.create_collection(
-            name="my_collection",
-            metadata={
-                "hnsw:space": "cosine"
-            }
-        )
-
-        self.initialize_embeddings()
-
-
-    def initialize_embeddings(self):
-        result = requests.get(IMIS)
-        publications = result.json()
-        documents = []
-        ids = []
-        count = 1
-        for publication in publications:
-            #self.logging_service.logger.debug(publication)
-            documents.append(publication['StandardTitle'])
-            ids.append(f"id{count}")
-            count+=1
-
-        self.collection.add(
-            documents=documents,
-            ids=ids
-        )
+        self.batch_size = batch_size_within_budget("semantic_search", batch_size, memory_budget_mb)
 
     def get_unprocessed_ids(self):
-        where = {"link.is_DOI_success": False, "link.is_processed": False}
+        # only search results the DOI stage is done with, otherwise the crossref stage could miss a DOI found later
+        where = {"is_processed": True, "link.is_DOI_success": False, "link.is_processed": False}
         what = {"_id": 1}
         self.db_service.set_collection("search_results")
         unprocessed_ids = self.db_service.select_what_where(what, where)
@@ -66,14 +56,230 @@ class SemanticSearchService:
         title_cursor.close()
         return title['title']
 
+    def get_titles(self, search_result_ids):
+        where = {"_id": {"$in": search_result_ids}}
+        what = {"title": 1}
+        self.db_service.set_collection("search_results")
+        title_cursor = self.db_service.select_what_where(what, where)
+        titles = {title['_id']: title['title'] for title in title_cursor}
+        title_cursor.close()
+        return titles
+
+    def get_sample_titles(self, limit):
+        what = {"title": 1, "_id": 0}
+        self.db_service.set_collection("search_results")
+        title_cursor = self.db_service.select_what_where(what, {}).limit(limit)
+        titles = [title['title'] for title in title_cursor]
+        title_cursor.close()
+        return titles
+
     def do_semantic_search(self, title):
-        results = self.collection.query(
-            query_texts=[title],  # Chroma will embed this for you
-            n_results=2  # how many results to return
+        return self.do_semantic_search_batch([title])[0]
+
+    @abstractmethod
+    def do_semantic_search_batch(self, titles):
+        pass
+
+    # scores is a dict search result _id -> score, written with one bulk write
+    def update_scores(self, scores):
+        updated_at = printable_date_time_now()
+        updates = [
+            ({"updated_at": updated_at, "link.is_processed": True, "score": score}, {"_id": search_result_id})
+            for search_result_id, score in scores.items()
+        ]
+        self.db_service.set_collection("search_results")
+        self.db_service.bulk_update_what_where(updates)
+
+    # a search result the stage can't score is flagged as processed without a score, so the next pass doesn't stop
+    # on it again
+    def fail_search_result(self, search_result_id, error):
+        search_result_update_where = {
+            "_id": search_result_id,
+        }
+        search_result_update_what = {
+            "updated_at": printable_date_time_now(),
+            "link.is_processed": True,
+            "score": None,
+            "log_message": f"Semantic search failed: {type(error).__name__}: {error}",
+        }
+        self.db_service.set_collection("search_results")
+        self.db_service.update_one_what_where(search_result_update_what, search_result_update_where)
+
+
+class SemanticSearchService(BaseSemanticSearchService):
+    def __init__(self, db_service: DBService, logging_service: LoggingService, backend: str, chroma_path: str,
+                 collection_name: str, hnsw_construction_ef: int, hnsw_search_ef: int, hnsw_m: int, n_results: int,
+                 numpy_path: str, numpy_quantization: str, id_field: str,
+                 sync_interval_hours: int, batch_size: int, ingest_batch_size: int, embedding_model: str,
+                 embedding_cache_path: str, embedding_cache_size: int, embedding_cache_dtype: str,
+                 memory_budget_mb: int):
+        super().__init__(db_service, logging_service, batch_size, memory_budget_mb)
+        self.ingest_batch_size = batch_size_within_budget("semantic_search", ingest_batch_size, memory_budget_mb)
+        self.n_results = n_results
+        self.id_field = id_field
+        self.sync_interval_hours = sync_interval_hours
+        self.embedding_model = embedding_model
+        # the sync of one index, several backends, collections or quantizations can share a directory
+        self.sync_key = ":".join((backend, collection_name if backend != "numpy" else numpy_quantization))
+        self.embedding_function = get_embedding_function(embedding_model)
+        self.embedding_cache = EmbeddingCache(embedding_cache_path, embedding_model, embedding_cache_size,
+                                              embedding_cache_dtype)
+        # chroma keeps an HNSW index, numpy does an exact search over the whole matrix
+        self.similarity_backend = get_similarity_backend(
+            backend,
+            numpy_path if backend == "numpy" else chroma_path,
+            collection_name,
+            self.embedding_function,
+            numpy_quantization,
+            hnsw_construction_ef,
+            hnsw_search_ef,
+            hnsw_m
         )
-        score = self.convert_distance_to_score(results['distances'][0][0])
-        return score
+
+        if self.is_sync_due():
+            self.initialize_embeddings()
+
+
+    # the IMIS catalogue is only synced again once sync_interval_hours have passed, or when the index was embedded
+    # by another model
+    def is_sync_due(self):
+        sync = self.load_syncs().get(self.sync_key)
+        if sync is None or sync.get('embedding_model') != self.embedding_model:
+            return True
+        synced_at = datetime.fromisoformat(sync['synced_at'])
+        return datetime.now(timezone.utc) - synced_at >= timedelta(hours=self.sync_interval_hours)
+
+    # imis_sync.json holds the last sync of every index in the directory, by sync_key
+    def load_syncs(self):
+        sync_filename = os.path.join(self.similarity_backend.path, "imis_sync.json")
+        if not os.path.exists(sync_filename):
+            return {}
+        with open(sync_filename, encoding="utf-8") as sync_file:
+            syncs = json.load(sync_file)
+        # the file of a version that kept a single synced_at for the whole directory
+        return {} if 'synced_at' in syncs else syncs
+
+    def store_sync(self):
+        syncs = self.load_syncs()
+        syncs[self.sync_key] = {"synced_at": datetime.now(timezone.utc).isoformat(),
+                                "embedding_model": self.embedding_model}
+        sync_filename = os.path.join(self.similarity_backend.path, "imis_sync.json")
+        os.makedirs(self.similarity_backend.path, exist_ok=True)
+        with open(sync_filename + ".tmp", "w", encoding="utf-8") as sync_file:
+            json.dump(syncs, sync_file)
+        os.replace(sync_filename + ".tmp", sync_filename)
+
+    # only new or changed titles are embedded, publications that left the catalogue are deleted,
+    # the catalogue is read as a stream and embedded in chunks so the memory doesn't grow with its size
+    def initialize_embeddings(self):
+        chunk_size = min(self.ingest_batch_size, self.similarity_backend.max_batch_size or self.ingest_batch_size)
+        synced_model = self.load_syncs().get(self.sync_key, {}).get('embedding_model')
+        if synced_model is not None and synced_model != self.embedding_model:
+            # the vectors of two models can't be compared, the whole catalogue is embedded again
+            self.logging_service.logger.info('IMIS sync: embedding model changed from %s to %s, embedding all titles',
+                                             synced_model, self.embedding_model)
+            self.similarity_backend.clear()
+        existing_hashes = self.similarity_backend.get_title_hashes()
+        chunk = []
+        seen_ids = set()
+        embedded = 0
+        start = perf_counter()
+        for publication in get_imis_publications():
+            #self.logging_service.logger.debug(publication)
+            title = publication.get('StandardTitle')
+            if not title:
+                continue
+            title_hash = hashlib.sha1(title.encode("utf-8")).hexdigest()
+            # publications without an id are keyed by their title
+            publication_id = str(publication.get(self.id_field) or title_hash)
+            if publication_id in seen_ids:
+                continue
+            seen_ids.add(publication_id)
+            if existing_hashes.get(publication_id) != title_hash:
+                chunk.append((publication_id, title, title_hash))
+            if len(chunk) == chunk_size:
+                embedded += self.embed_publications(chunk)
+                chunk = []
+                self.logging_service.logger.debug('IMIS sync: %d publications read, %d embedded, %.1f titles/s',
+                                                  len(seen_ids), embedded, embedded / (perf_counter() - start))
+        if chunk:
+            embedded += self.embed_publications(chunk)
+        with metrics.time_step("imis_sync", "flush"):
+            self.similarity_backend.flush()
+
+        removed_ids = [publication_id for publication_id in existing_hashes if publication_id not in seen_ids]
+        for removed_chunk in batched(removed_ids, chunk_size):
+            self.similarity_backend.delete(list(removed_chunk))
+        self.store_sync()
+        self.logging_service.logger.debug('IMIS sync: %d publications, %d embedded, %d removed in %.1fs',
+                                          len(seen_ids), embedded, len(removed_ids), perf_counter() - start)
+
+    # chunk is a list of (publication id, title, title hash)
+    def embed_publications(self, chunk):
+        ids, documents, title_hashes = (list(column) for column in zip(*chunk))
+        with metrics.time_step("imis_sync", "embed"):
+            embeddings = self.embedding_function(documents)
+        with metrics.time_step("imis_sync", "upsert"):
+            self.similarity_backend.upsert(ids, documents, embeddings, title_hashes)
+        metrics.count_item("imis_sync", "embedded", amount=len(ids))
+        return len(ids)
+
+    # all titles are embedded and searched in one query, the score is None when the index has no title to compare with
+    def do_semantic_search_batch(self, titles):
+        embeddings = self.embed_titles(titles)
+        with metrics.time_step("semantic_search", "query"):
+            # only the nearest title is scored
+            ids, distances = self.similarity_backend.query(embeddings, self.n_results)
+        scores = [self.convert_distance_to_score(title_distances[0]) if title_distances else None
+                  for title_distances in distances]
+        if None in scores:
+            self.logging_service.logger.warning('semantic search: the index is empty, %d titles without a score',
+                                                scores.count(None))
+        return scores
+
+    # only the titles that aren't in the embedding cache are embedded
+    def embed_titles(self, titles):
+        embeddings = self.embedding_cache.get_many(titles)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            missing_titles = [titles[i] for i in missing]
+            with metrics.time_step("semantic_search", "embed"):
+                missing_embeddings = self.embedding_function(missing_titles)
+            # put_many stores the index, with the recency of the hits
+            self.embedding_cache.put_many(missing_titles, missing_embeddings)
+            for i, embedding in zip(missing, missing_embeddings):
+                embeddings[i] = np.asarray(embedding, dtype=np.float32)
+        else:
+            self.embedding_cache.flush()
+        metrics.increment("embedding_cache_requests_total", len(titles) - len(missing), result="hit")
+        metrics.increment("embedding_cache_requests_total", len(missing), result="miss")
+        return embeddings
 
     def convert_distance_to_score(self, distance):
         score = distance
-        return score
\ No newline at end of file
+        return score
+
+
+# the publications are parsed one by one from the response stream, the catalogue is never in memory as a whole
+def get_imis_publications():
+    client = Client(timeout=120, transport=get_transport())
+    try:
+        with client.stream("GET", IMIS) as response:
+            publications = ijson.sendable_list()
+            parser = ijson.items_coro(publications, "item")
+            for data in response.iter_bytes():
+                parser.send(data)
+                yield from publications
+                publications.clear()
+            parser.close()
+            yield from publications
+    finally:
+        client.close()
+
+def get_embedding_function(embedding_model):
+    from chromadb.utils import embedding_functions
+
+    # all-MiniLM-L6-v2 is the ONNX model chroma ships with, other models go through sentence-transformers
+    if embedding_model == "all-MiniLM-L6-v2":
+        return embedding_functions.DefaultEmbeddingFunction()
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=embedding_model)
@@ -0,0 +1,298 @@
+import json
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+QUERY_CHUNK_ROWS = 8192
+
+
+class SimilarityBackend(ABC):
+    # query returns, per query embedding, the ids and cosine distances (1 - cosine similarity) of the nearest titles
+    def __init__(self, path):
+        self.path = path
+        # the most ids one upsert or delete may hold, None when there is no limit
+        self.max_batch_size = None
+
+    @abstractmethod
+    def get_title_hashes(self):
+        pass
+
+    @abstractmethod
+    def upsert(self, ids, documents, embeddings, title_hashes):
+        pass
+
+    @abstractmethod
+    def delete(self, ids):
+        pass
+
+    # removes every title, before the catalogue is embedded again by another model
+    @abstractmethod
+    def clear(self):
+        pass
+
+    # writes what the upserts left pending, the backends that write every upsert right away have nothing to do
+    def flush(self):
+        pass
+
+    @abstractmethod
+    def query(self, embeddings, n_results):
+        pass
+
+    @abstractmethod
+    def count(self):
+        pass
+
+
+class ChromaSimilarityBackend(SimilarityBackend):
+    def __init__(self, path, collection_name, embedding_function, construction_ef=100, search_ef=100, m=16):
+        super().__init__(path)
+        # chromadb is only imported when the chroma backend is used
+        import chromadb
+        self.chroma_client = chromadb.PersistentClient(path=path)
+        self.max_batch_size = self.chroma_client.get_max_batch_size()
+        self.collection_name = collection_name
+        self.embedding_function = embedding_function
+        self.construction_ef = construction_ef
+        self.search_ef = search_ef
+        self.m = m
+        self.collection = self.get_collection()
+
+    def get_collection(self):
+        # https://docs.trychroma.com/docs/collections/configure
+        # construction_ef and M only apply when the collection is created, search_ef can change later
+        collection = self.chroma_client.get_or_create_collection(
+            name=self.collection_name,
+            metadata={
+                "hnsw:space": "cosine",
+                "hnsw:construction_ef": self.construction_ef,
+                "hnsw:search_ef": self.search_ef,
+                "hnsw:M": self.m
+            },
+            embedding_function=self.embedding_function
+        )
+        if (collection.configuration.get('hnsw') or {}).get('ef_search') != self.search_ef:
+            collection.modify(configuration={"hnsw": {"ef_search": self.search_ef}})
+        return collection
+
+    def get_title_hashes(self):
+        existing = self.collection.get(include=["metadatas"])
+        return {publication_id: metadata.get('title_hash') if metadata else None
+                for publication_id, metadata in zip(existing['ids'], existing['metadatas'])}
+
+    def upsert(self, ids, documents, embeddings, title_hashes):
+        self.collection.upsert(
+            documents=documents,
+            embeddings=embeddings,
+            ids=ids,
+            metadatas=[{"title_hash": title_hash} for title_hash in title_hashes]
+        )
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    # the collection is created again, the embeddings of another model can have another dimension
+    def clear(self):
+        self.chroma_client.delete_collection(self.collection_name)
+        self.collection = self.get_collection()
+
+    def query(self, embeddings, n_results):
+        results = self.collection.query(
+            query_embeddings=embeddings,
+            n_results=n_results  # how many results to return
+        )
+        return results['ids'], results['distances']
+
+    def count(self):
+        return self.collection.count()
+
+
+class NumpySimilarityBackend(SimilarityBackend):
+    # exact search: one matrix multiplication over a memory-mapped matrix of L2-normalized embeddings,
+    # with int8 quantization every row is stored with its own scale. Upserted rows are appended to a pending file
+    # and merged into the matrix once, by flush, a delete or the next query, so a sync writes the matrix once
+    # instead of once per chunk
+    def __init__(self, path, quantization="none"):
+        super().__init__(path)
+        self.quantization = quantization
+        self.dtype = np.int8 if quantization == "int8" else np.float32
+        self.vectors_filename = os.path.join(path, f"vectors_{quantization}.npy")
+        self.scales_filename = os.path.join(path, f"scales_{quantization}.npy")
+        self.ids_filename = os.path.join(path, f"ids_{quantization}.json")
+        self.pending_filename = os.path.join(path, f"vectors_{quantization}.pending")
+        self.ids = []
+        self.title_hashes = []
+        self.positions = {}
+        self.vectors = None
+        self.scales = None
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.ids_filename):
+            with open(self.ids_filename, encoding="utf-8") as ids_file:
+                index = json.load(ids_file)
+            self.ids = index['ids']
+            self.title_hashes = index['title_hashes']
+            self.positions = {publication_id: position for position, publication_id in enumerate(self.ids)}
+            self.vectors = np.load(self.vectors_filename, mmap_mode="r")
+            if self.quantization == "int8":
+                self.scales = np.load(self.scales_filename)
+        # the rows of an upsert that was never merged are lost, the next sync embeds their titles again
+        self.reset_pending()
+
+    def reset_pending(self):
+        if os.path.exists(self.pending_filename):
+            os.remove(self.pending_filename)
+        # the ids up to stored_count have a row in the matrix, appended holds the pending row of every later id,
+        # updates the pending row that replaces a stored row
+        self.stored_count = len(self.ids)
+        self.pending_rows = 0
+        self.pending_dimension = None
+        self.pending_scales = []
+        self.appended = []
+        self.updates = {}
+
+    def get_title_hashes(self):
+        return dict(zip(self.ids, self.title_hashes))
+
+    def upsert(self, ids, documents, embeddings, title_hashes):
+        rows, row_scales = self.quantize(normalize(np.asarray(embeddings, dtype=np.float32)))
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.pending_filename, "ab") as pending_file:
+            pending_file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        for i, (publication_id, title_hash) in enumerate(zip(ids, title_hashes)):
+            pending_row = self.pending_rows + i
+            position = self.positions.get(publication_id)
+            if position is None:
+                self.positions[publication_id] = len(self.ids)
+                self.ids.append(publication_id)
+                self.title_hashes.append(title_hash)
+                self.appended.append(pending_row)
+                continue
+            if position < self.stored_count:
+                self.updates[position] = pending_row
+            else:
+                self.appended[position - self.stored_count] = pending_row
+            self.title_hashes[position] = title_hash
+        self.pending_rows += len(rows)
+        self.pending_dimension = rows.shape[1]
+        if row_scales is not None:
+            self.pending_scales.append(row_scales)
+
+    def flush(self):
+        if self.pending_rows:
+            self.store(np.arange(self.stored_count))
+
+    def delete(self, ids):
+        self.flush()
+        removed = set(ids)
+        kept = np.array([position for position, publication_id in enumerate(self.ids) if publication_id not in removed],
+                        dtype=np.int64)
+        self.ids = [self.ids[position] for position in kept]
+        self.title_hashes = [self.title_hashes[position] for position in kept]
+        self.store(kept)
+
+    def clear(self):
+        for filename in (self.vectors_filename, self.scales_filename, self.ids_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.ids = []
+        self.title_hashes = []
+        self.positions = {}
+        self.vectors = None
+        self.scales = None
+        self.reset_pending()
+
+    def query(self, embeddings, n_results):
+        self.flush()
+        if self.vectors is None or len(self.ids) == 0:
+            return [[] for _ in embeddings], [[] for _ in embeddings]
+        queries = normalize(np.asarray(embeddings, dtype=np.float32))
+        if self.quantization == "int8":
+            # dequantize a chunk of rows at a time so a query never holds a float copy of the whole matrix
+            similarities = np.empty((len(queries), len(self.ids)), dtype=np.float32)
+            for start in range(0, len(self.ids), QUERY_CHUNK_ROWS):
+                chunk = self.vectors[start:start + QUERY_CHUNK_ROWS].astype(np.float32)
+                similarities[:, start:start + QUERY_CHUNK_ROWS] = queries @ chunk.T
+            similarities *= self.scales
+        else:
+            similarities = queries @ self.vectors.T
+        n_results = min(n_results, len(self.ids))
+        top = np.argpartition(-similarities, n_results - 1, axis=1)[:, :n_results]
+        all_ids = []
+        all_distances = []
+        for row, candidates in zip(similarities, top):
+            candidates = candidates[np.argsort(-row[candidates])]
+            all_ids.append([self.ids[candidate] for candidate in candidates])
+            all_distances.append([max(0.0, float(1 - row[candidate])) for candidate in candidates])
+        return all_ids, all_distances
+
+    def count(self):
+        return len(self.ids)
+
+    def quantize(self, vectors):
+        if self.quantization != "int8":
+            return vectors, None
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(vectors / scales[:, np.newaxis]).astype(np.int8), scales.astype(np.float32)
+
+    # the new matrix is written row chunk by row chunk next to the old one, so neither has to fit in memory:
+    # the kept rows of the old matrix, then the pending appended rows, then the pending rows that replace stored
+    # ones. Rows are only kept out (kept is not every stored row) by a delete, after flush has merged the pending rows
+    def store(self, kept):
+        if self.vectors is None and not self.pending_rows:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        dimension = self.vectors.shape[1] if self.vectors is not None else self.pending_dimension
+        pending = None
+        if self.pending_rows:
+            pending = np.memmap(self.pending_filename, dtype=self.dtype, mode="r",
+                                shape=(self.pending_rows, dimension))
+        temporary_filename = self.vectors_filename + ".tmp"
+        vectors = np.lib.format.open_memmap(temporary_filename, mode="w+", dtype=self.dtype,
+                                            shape=(len(kept) + len(self.appended), dimension))
+        for start in range(0, len(kept), QUERY_CHUNK_ROWS):
+            chunk = kept[start:start + QUERY_CHUNK_ROWS]
+            vectors[start:start + len(chunk)] = self.vectors[chunk]
+        for start in range(0, len(self.appended), QUERY_CHUNK_ROWS):
+            chunk = self.appended[start:start + QUERY_CHUNK_ROWS]
+            vectors[len(kept) + start:len(kept) + start + len(chunk)] = pending[chunk]
+        for position, pending_row in self.updates.items():
+            vectors[position] = pending[pending_row]
+        vectors.flush()
+        del vectors
+        del pending
+        if self.quantization == "int8":
+            scales = self.scales[kept] if self.scales is not None else np.empty(0, dtype=np.float32)
+            if self.pending_scales:
+                pending_scales = np.concatenate(self.pending_scales)
+                scales = np.concatenate([scales, pending_scales[self.appended]])
+                for position, pending_row in self.updates.items():
+                    scales[position] = pending_scales[pending_row]
+            save_replace(self.scales_filename, scales)
+        # a new file is swapped in, so a matrix that is still memory-mapped keeps its old file
+        os.replace(temporary_filename, self.vectors_filename)
+        with open(self.ids_filename + ".tmp", "w", encoding="utf-8") as ids_file:
+            json.dump({"ids": self.ids, "title_hashes": self.title_hashes}, ids_file)
+        os.replace(self.ids_filename + ".tmp", self.ids_filename)
+        self.load()
+
+
+def save_replace(filename, array):
+    with open(filename + ".tmp", "wb") as array_file:
+        np.save(array_file, array)
+    os.replace(filename + ".tmp", filename)
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def get_similarity_backend(backend, path, collection_name, embedding_function, quantization, construction_ef=100,
+                           search_ef=100, m=16):
+    match backend:
+        case "numpy":
+            return NumpySimilarityBackend(path, quantization)
+        case _:
+            return ChromaSimilarityBackend(path, collection_name, embedding_function, construction_ef, search_ef, m)
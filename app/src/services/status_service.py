@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta, timezone
+
+from app.src.services.db_service import DBService
+from app.src.services.logging_service import LoggingService
+
+STAGES = ("email_body", "search_doi", "crossref", "semantic_search")
+CROSSREF_SUCCESS = "Crossref retrieved successfully."
+
+
+class StatusService:
+    # the backlog of every stage with one $facet aggregation per collection. Only the documents that are pending,
+    # in progress, failed or were updated in the last hour reach the $facet, an indexed $match selects them: the
+    # done items, most of a collection, are counted on their index without being read
+    def __init__(self, db_service: DBService, logging_service: LoggingService):
+        self.db_service = db_service
+        self.logging_service = logging_service
+
+    def create_indexes(self):
+        self.db_service.set_collection("emails")
+        self.db_service.create_index([("is_spam", 1), ("is_processed", 1)])
+        self.db_service.create_index("body.is_parsed")
+        self.db_service.create_index("updated_at")
+        self.db_service.set_collection("search_results")
+        self.db_service.create_index("is_processed")
+        self.db_service.create_index([("link.is_processed", 1), ("link.is_DOI_success", 1)])
+        self.db_service.create_index("retry.is_dead_letter", sparse=True)
+        self.db_service.create_index("updated_at")
+        self.db_service.create_index("doi_state.updated_at", sparse=True)
+        self.db_service.set_collection("crossref")
+        self.db_service.create_index("log_message")
+        self.db_service.create_index("search_result")
+
+    # per stage: pending, in_progress, failed, done (None when the stage has no such state), the age of the oldest
+    # pending item in seconds and the items done in the last hour
+    def get_status(self):
+        now = datetime.now(timezone.utc)
+        hour_ago = (now - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.db_service.set_collection("emails")
+        emails = next(self.db_service.aggregate([
+            {"$match": {"is_spam": False, "$or": [{"is_processed": False}, {"body.is_parsed": False},
+                                                  {"updated_at": {"$gte": hour_ago}}]}},
+            {"$project": {"created_at": 1, "updated_at": 1, "is_processed": 1, "body.is_parsed": 1}},
+            {"$facet": {
+                "email_body_pending": pending_facet({"is_processed": False}),
+                "email_body_failed": count_facet({"is_processed": True, "body.is_parsed": False}),
+                "email_body_done_last_hour": count_facet({"is_processed": True, "body.is_parsed": {"$ne": False},
+                                                          "updated_at": {"$gte": hour_ago}}),
+            }},
+        ]))
+        emails_processed = self.db_service.count_where({"is_spam": False, "is_processed": True})
+        self.db_service.set_collection("search_results")
+        search_results = next(self.db_service.aggregate([
+            {"$match": {"$or": [{"is_processed": False}, {"link.is_processed": False},
+                                {"retry.is_dead_letter": True}, {"updated_at": {"$gte": hour_ago}},
+                                {"doi_state.updated_at": {"$gte": hour_ago}}]}},
+            {"$project": {"created_at": 1, "updated_at": 1, "is_processed": 1, "link.is_DOI_success": 1,
+                          "link.is_processed": 1, "doi_state.lease_until": 1, "doi_state.updated_at": 1,
+                          "retry.is_dead_letter": 1, "retry.next_attempt_at": 1}},
+            {"$facet": {
+                "search_doi_pending": pending_facet({"is_processed": False, "retry.is_dead_letter": {"$ne": True},
+                                                     "doi_state.lease_until": {"$not": {"$gt": now}}}),
+                "search_doi_in_progress": count_facet({"is_processed": False, "doi_state.lease_until": {"$gt": now}}),
+                "search_doi_waiting_retry": count_facet({"is_processed": False, "retry.is_dead_letter": {"$ne": True},
+                                                         "retry.next_attempt_at": {"$gt": now}}),
+                "search_doi_failed": count_facet({"retry.is_dead_letter": True}),
+                "search_doi_done_last_hour": count_facet({"is_processed": True, "retry.is_dead_letter": {"$ne": True},
+                                                          "doi_state.updated_at": {"$gte": hour_ago}}),
+                "crossref_pending": pending_facet({"link.is_DOI_success": True, "link.is_processed": False}),
+                "crossref_done_last_hour": count_facet({"link.is_DOI_success": True, "link.is_processed": True,
+                                                        "updated_at": {"$gte": hour_ago}}),
+                "semantic_search_pending": pending_facet({"is_processed": True, "link.is_DOI_success": False,
+                                                          "link.is_processed": False}),
+                "semantic_search_done_last_hour": count_facet({"link.is_DOI_success": False,
+                                                               "link.is_processed": True,
+                                                               "updated_at": {"$gte": hour_ago}}),
+            }},
+        ]))
+        facets = {**emails, **search_results}
+        # the dead letters are processed as well
+        search_results_processed = self.db_service.count_where({"is_processed": True})
+        done = {
+            "email_body": emails_processed - first(facets, "email_body_failed").get("count", 0),
+            "search_doi": search_results_processed - first(facets, "search_doi_failed").get("count", 0),
+            "crossref": self.db_service.count_where({"link.is_processed": True, "link.is_DOI_success": True}),
+            "semantic_search": self.db_service.count_where({"link.is_processed": True,
+                                                            "link.is_DOI_success": False}),
+        }
+        stages = {}
+        for stage in STAGES:
+            pending = first(facets, f"{stage}_pending")
+            oldest = pending.get("oldest")
+            stages[stage] = {
+                "pending": pending.get("count", 0),
+                "in_progress": first(facets, f"{stage}_in_progress").get("count", 0)
+                if f"{stage}_in_progress" in facets else None,
+                "failed": first(facets, f"{stage}_failed").get("count", 0) if f"{stage}_failed" in facets else None,
+                "done": done[stage],
+                "oldest_pending_age_seconds": get_age_seconds(oldest, now) if oldest else None,
+                "done_last_hour": first(facets, f"{stage}_done_last_hour").get("count", 0),
+            }
+        stages["search_doi"]["waiting_retry"] = first(facets, "search_doi_waiting_retry").get("count", 0)
+        stages["crossref"]["failed"] = self.count_crossref_failed()
+        return {"generated_at": now.strftime("%Y-%m-%dT%H:%M:%SZ"), "stages": stages}
+
+    # the failed Crossref lookups are in the crossref collection, with their log message. A search result whose
+    # latest crossref document is a success, after a reprocess or a retry, doesn't count
+    def count_crossref_failed(self):
+        self.db_service.set_collection("crossref")
+        failed_ids = [document['_id'] for document in self.db_service.aggregate([
+            {"$match": {"log_message": {"$ne": CROSSREF_SUCCESS}}},
+            {"$group": {"_id": "$search_result"}},
+        ])]
+        if not failed_ids:
+            return 0
+        counts = list(self.db_service.aggregate([
+            {"$match": {"search_result": {"$in": failed_ids}}},
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": "$search_result", "log_message": {"$last": "$log_message"}}},
+            {"$match": {"log_message": {"$ne": CROSSREF_SUCCESS}}},
+            {"$count": "count"},
+        ]))
+        return counts[0]['count'] if counts else 0
+
+
+def count_facet(where):
+    return [{"$match": where}, {"$count": "count"}]
+
+def pending_facet(where):
+    return [{"$match": where}, {"$group": {"_id": None, "count": {"$sum": 1}, "oldest": {"$min": "$created_at"}}}]
+
+# the only document of a facet, an empty dict when nothing matched
+def first(facets, name):
+    documents = facets.get(name) or [{}]
+    return documents[0]
+
+def get_age_seconds(date_time, now):
+    created_at = datetime.strptime(date_time, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    return max(0, int((now - created_at).total_seconds()))
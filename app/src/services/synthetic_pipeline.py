@@ -0,0 +1,226 @@
+import json
+import random
+import threading
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, quote, urlsplit
+
+from app.src.services.db_service import DBService
+from app.src.services.email_service import EmailService
+from app.src.services.logging_service import LoggingService
+from app.src.shared.helper import normalize_title
+
+DOI_PREFIX = "10.5555/synthetic."
+WORDS = ("seed", "structure", "coral", "reef", "plankton", "sediment", "microscopy", "phenotyping", "salinity",
+         "estuary", "benthic", "diversity", "acoustic", "tracking", "fisheries", "genome", "climate", "nutrient",
+         "assessment", "modelling", "larval", "dispersal", "seagrass", "oxygen", "trawl", "survey", "isotope")
+PUBLISHERS = ("Scientific Reports", "Marine Biology", "Estuarine, Coastal and Shelf Science", "PLoS One")
+# how the DOI of a search result is found: in the publisher url, by the Crossref title search,
+# in the publisher page, or not at all (the search result goes on to the semantic search)
+KINDS = ("url", "crossref", "content", "none")
+
+
+class SyntheticPublication:
+    __slots__ = ("number", "title", "kind", "doi")
+
+    def __init__(self, number, title, kind):
+        self.number = number
+        self.title = title
+        self.kind = kind
+        self.doi = f"{DOI_PREFIX}{number}"
+
+
+class SyntheticWebServer:
+    # answers the Scholar redirects, the publisher pages, the Crossref API and the IMIS catalogue on localhost,
+    # every answer waits latency seconds (+-50%), error_rate of them fail: the Scholar and publisher connections
+    # are dropped, the Crossref API answers 503
+    def __init__(self, publications, catalogue, latency, error_rate, seed=0):
+        self.publications = {publication.number: publication for publication in publications}
+        self.titles = {normalize_title(publication.title): publication for publication in publications}
+        self.catalogue = catalogue
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        synthetic = self
+
+        class SyntheticHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                synthetic.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SyntheticHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="synthetic-web-server", daemon=True).start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        url = urlsplit(request.path)
+        query = parse_qs(url.query)
+        if self.latency:
+            sleep(self.latency * self.random.uniform(0.5, 1.5))
+        failed = self.random.random() < self.error_rate
+        parts = url.path.strip("/").split("/")
+        match parts[0]:
+            case "scholar_url" | "article" if failed:
+                # the client sees a connection that was closed without an answer
+                request.close_connection = True
+            case "scholar_url":
+                target = escape(query["url"][0], quote=True)
+                self.send(request, 200, "text/html",
+                          f"<html><head><script>window.location.replace('{target}')</script></head></html>")
+            case "article":
+                publication = self.publications.get(int(parts[-1].rsplit(".", 1)[-1]))
+                text = f"doi: {publication.doi}" if publication.kind != "none" else "no identifier"
+                self.send(request, 200, "text/html", f"<html><body><p>{escape(publication.title)}</p>"
+                                                     f"<p>{text}</p></body></html>")
+            case "works" if failed:
+                self.send(request, 503, "application/json", json.dumps({"status": "error"}))
+            case "works" if len(parts) == 1:
+                publication = self.titles.get(normalize_title(query.get("query.bibliographic", [""])[0]))
+                if publication is not None and publication.kind == "crossref":
+                    items = [{"DOI": publication.doi, "title": [publication.title]}]
+                else:
+                    items = [{"DOI": f"{DOI_PREFIX}unrelated", "title": ["An unrelated publication"]}]
+                self.send(request, 200, "application/json", json.dumps({"message": {"items": items}}))
+            case "works":
+                number = int(parts[-1].rsplit(".", 1)[-1])
+                publication = self.publications[number]
+                self.send(request, 200, "application/json", json.dumps({"message": {
+                    "title": [publication.title],
+                    "author": [{"given": "A", "family": f"Author{number}"}],
+                    "published": {"date-parts": [[2025, 1, 1]]},
+                    "publisher": PUBLISHERS[number % len(PUBLISHERS)],
+                }}))
+            case "imis":
+                self.send(request, 200, "application/json", json.dumps(self.catalogue))
+            case _:
+                self.send(request, 404, "text/plain", "not found")
+
+    def send(self, request, status, content_type, body):
+        body = body.encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+class SyntheticMailbox:
+    # the part of imaplib.IMAP4 the email service uses, with every message unread
+    def __init__(self, messages):
+        self.messages = {str(number).encode("ascii"): message for number, message in enumerate(messages, start=1)}
+        self.moved = {}
+
+    def select(self, mailbox="INBOX"):
+        return "OK", [str(len(self.messages)).encode("ascii")]
+
+    def search(self, charset, criteria):
+        return "OK", [b" ".join(self.messages)]
+
+    def fetch(self, email_id, message_parts):
+        message = self.messages[email_id]
+        return "OK", [(email_id + b" (RFC822 {" + str(len(message)).encode("ascii") + b"}", message), b")"]
+
+    def copy(self, email_id, mailbox):
+        self.moved[email_id] = mailbox
+        return "OK", [None]
+
+    def store(self, email_id, command, flags):
+        return "OK", [None]
+
+    def expunge(self):
+        for email_id in self.moved:
+            self.messages.pop(email_id, None)
+        return "OK", [None]
+
+    def close(self):
+        return "OK", [None]
+
+    def logout(self):
+        return "BYE", [None]
+
+
+class SyntheticEmailService(EmailService):
+    # reads the alerts from a SyntheticMailbox instead of the IMAP server
+    def __init__(self, db_service: DBService, logging_service: LoggingService, mailbox: SyntheticMailbox):
+        super().__init__(db_service, logging_service)
+        self.mailbox = mailbox
+
+    def connect_and_login(self):
+        return self.mailbox
+
+
+def generate_publications(count, seed=0):
+    generator = random.Random(seed)
+    publications = []
+    for number in range(count):
+        words = generator.sample(WORDS, 6)
+        title = f"{words[0].capitalize()} {words[1]} of {words[2]} {words[3]} in {words[4]} {words[5]} {number}"
+        publications.append(SyntheticPublication(number, title, KINDS[number % len(KINDS)]))
+    return publications
+
+# the IMIS catalogue holds the titles nobody found a DOI for and catalogue_size unrelated ones
+def generate_catalogue(publications, catalogue_size, id_field, seed=0):
+    generator = random.Random(seed + 1)
+    catalogue = [{id_field: f"imis-{publication.number}", "StandardTitle": publication.title}
+                 for publication in publications if publication.kind == "none"]
+    for number in range(catalogue_size):
+        catalogue.append({id_field: f"imis-other-{number}",
+                          "StandardTitle": " ".join(generator.sample(WORDS, 8)).capitalize()})
+    return catalogue
+
+# Google Scholar alerts in the html shape ParseService documents, results_per_email search results each
+def generate_alert_emails(publications, results_per_email, base_url, sender):
+    messages = []
+    sent_at = datetime(2025, 1, 6, 8, 0, tzinfo=timezone.utc)
+    for start in range(0, len(publications), results_per_email):
+        results = []
+        for publication in publications[start:start + results_per_email]:
+            if publication.kind == "url":
+                publisher_url = f"{base_url}/article/{publication.doi}"
+            else:
+                publisher_url = f"{base_url}/article/{publication.number}"
+            scholar_url = (f"{base_url}/scholar_url?url={quote(publisher_url, safe=':/')}"
+                           f"&amp;hl=nl&amp;sa=X&amp;oi=scholaralrt&amp;pos={publication.number}")
+            results.append(f"""
+<h3 style="font-weight:normal;margin:0;font-size:17px;line-height:20px;">
+    <span style="font-size:11px;font-weight:bold;color:#1a0dab;vertical-align:2px">[HTML]</span>
+    <a href="{scholar_url}" class="gse_alrt_title" style="font-size:17px;color:#1a0dab;line-height:22px">
+        {escape(publication.title)}
+    </a>
+</h3>
+<div style="color:#006621;line-height:18px">
+    A Author{publication.number}, B Author&nbsp;- {PUBLISHERS[publication.number % len(PUBLISHERS)]}, 2025
+</div>
+<div class="gse_alrt_sni" style="line-height:17px">A synthetic snippet of search result {publication.number} <br>
+    for the throughput benchmark&nbsp;…
+</div>""")
+        message = EmailMessage()
+        message["From"] = sender
+        message["To"] = "alerts@example.org"
+        message["Subject"] = f'Scholar Alert: "synthetic {start // results_per_email}"'
+        message["Date"] = format_datetime(sent_at + timedelta(minutes=start))
+        message.set_content("This alert is only readable as html.")
+        message.add_alternative(f"<html><body>{''.join(results)}</body></html>", subtype="html")
+        messages.append(message.as_bytes())
+    return messages
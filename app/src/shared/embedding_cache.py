@@ -0,0 +1,152 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class EmbeddingCache:
+    # title embeddings in a memory-mapped (capacity, dimension) array, the index maps the content hash of a title
+    # to its row and the model that produced it, the least recently used rows are reused when the cache is full.
+    # Several processes can share a path: every read and write holds an flock on cache.lock and first loads the
+    # index again when another process has replaced it
+    def __init__(self, path, model_name, capacity, dtype="float32"):
+        self.path = path
+        self.model_name = model_name
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.vectors_filename = os.path.join(path, "embeddings.npy")
+        self.index_filename = os.path.join(path, "index.json")
+        self.lock_filename = os.path.join(path, "cache.lock")
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.entries = OrderedDict()
+        self.free_slots = []
+        # (inode, mtime, size) of the index and the inode of the matrix that were loaded
+        self.index_stamp = None
+        self.vectors_inode = None
+        with self.locked():
+            self.load()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.lock_filename, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        self.entries = OrderedDict()
+        self.free_slots = list(range(self.capacity - 1, -1, -1))
+        self.index_stamp = get_stamp(self.index_filename)
+        if not (os.path.exists(self.index_filename) and os.path.exists(self.vectors_filename)):
+            self.vectors = None
+            return
+        with open(self.index_filename, encoding="utf-8") as index_file:
+            index = json.load(index_file)
+        if index['dtype'] != self.dtype.name or index['capacity'] != self.capacity:
+            # a differently shaped cache is rebuilt from scratch
+            self.vectors = None
+            return
+        vectors_inode = os.stat(self.vectors_filename).st_ino
+        if self.vectors is None or vectors_inode != self.vectors_inode:
+            self.vectors = np.load(self.vectors_filename, mmap_mode="r+")
+            self.vectors_inode = vectors_inode
+        self.entries = OrderedDict((key, entry) for key, entry in index['entries'])
+        used_slots = {slot for slot, model_name in self.entries.values()}
+        self.free_slots = [slot for slot in self.free_slots if slot not in used_slots]
+
+    # called with the lock held: the slots of this process are the slots another process may have written since
+    def load_if_changed(self):
+        if get_stamp(self.index_filename) != self.index_stamp:
+            self.load()
+
+    def get_many(self, titles):
+        # None for every title that isn't cached or was embedded by another model
+        vectors = []
+        with self.locked():
+            self.load_if_changed()
+            for title in titles:
+                key = title_hash(title)
+                entry = self.entries.get(key)
+                if entry is None or entry[1] != self.model_name or self.vectors is None:
+                    vectors.append(None)
+                    continue
+                self.entries.move_to_end(key)
+                vectors.append(np.asarray(self.vectors[entry[0]], dtype=np.float32))
+        return vectors
+
+    # the rows and the index are written before the lock is released, so the next process sees them
+    def put_many(self, titles, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.locked():
+            self.load_if_changed()
+            if self.vectors is None or self.vectors.shape[1] != vectors.shape[1]:
+                self.create(vectors.shape[1])
+            for title, vector in zip(titles, vectors):
+                key = title_hash(title)
+                entry = self.entries.get(key)
+                if entry is not None:
+                    slot = entry[0]
+                elif self.free_slots:
+                    slot = self.free_slots.pop()
+                else:
+                    # evict the least recently used title
+                    slot = self.entries.popitem(last=False)[1][0]
+                self.vectors[slot] = vector.astype(self.dtype)
+                self.entries[key] = [slot, self.model_name]
+                self.entries.move_to_end(key)
+            self.store()
+
+    # a new matrix is swapped in, a process that still maps the old one keeps reading its own file until it
+    # loads the new index
+    def create(self, dimension):
+        temporary_filename = self.vectors_filename + ".tmp"
+        vectors = np.lib.format.open_memmap(temporary_filename, mode="w+", dtype=self.dtype,
+                                            shape=(self.capacity, dimension))
+        del vectors
+        os.replace(temporary_filename, self.vectors_filename)
+        self.vectors = np.load(self.vectors_filename, mmap_mode="r+")
+        self.vectors_inode = os.stat(self.vectors_filename).st_ino
+        self.entries = OrderedDict()
+        self.free_slots = list(range(self.capacity - 1, -1, -1))
+
+    # keeps the recency of the titles get_many found, unless another process has written the index since
+    def flush(self):
+        with self.locked():
+            if self.vectors is None or get_stamp(self.index_filename) != self.index_stamp:
+                return
+            self.store()
+
+    def store(self):
+        self.vectors.flush()
+        index = {
+            "dtype": self.dtype.name,
+            "capacity": self.capacity,
+            "entries": list(self.entries.items()),
+        }
+        # write the index next to the old one and swap, a crash never leaves half an index
+        temporary_filename = self.index_filename + ".tmp"
+        with open(temporary_filename, "w", encoding="utf-8") as index_file:
+            json.dump(index, index_file)
+        os.replace(temporary_filename, self.index_filename)
+        self.index_stamp = get_stamp(self.index_filename)
+
+
+def title_hash(title):
+    return hashlib.sha256(title.encode("utf-8")).hexdigest()
+
+def get_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
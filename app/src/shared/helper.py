@@ -1,9 +1,15 @@
 import re
 from datetime import datetime, timezone
+from difflib import SequenceMatcher
 
-from httpx import Client
-from pymupdf import pymupdf
 
+# httpx is only imported by the stages that go to the network
+def get_http_client(**kwargs):
+    from httpx import Client
+
+    from app.src.shared.transport import get_transport
+    transport_kwargs = {key: kwargs[key] for key in ("limits",) if key in kwargs}
+    return Client(transport=get_transport(**transport_kwargs), **kwargs)
 
 def escape_double_quotes(string):
     string = string.replace('"', '\"')
@@ -20,10 +26,67 @@ def do_external_request(url, follow_redirect):
         "Accept-Encoding": "gzip, deflate, br",
         "Accept-Language": "en-US,en;q=0.9,lt;q=0.8,et;q=0.7,de;q=0.6",
     }
-    client = Client(headers=headers, follow_redirects=follow_redirect)
+    client = get_http_client(headers=headers, follow_redirects=follow_redirect)
     response = client.get(url)
     return response
 
+def search_crossref_works(api_url, title, rows):
+    # https://api.crossref.org/swagger-ui/index.html#/Works/get_works
+    # only ask for the fields we compare on, the full records are fetched later by the crossref stage
+    params = {
+        "query.bibliographic": title,
+        "select": "DOI,title",
+        "rows": rows,
+    }
+    with get_http_client(timeout=30) as client:
+        response = client.get(f"{api_url}/works", params=params)
+        response.raise_for_status()
+        return response.json()['message']['items']
+
+def get_crossref_client(mailto, max_connections):
+    # https://api.crossref.org/swagger-ui/index.html#/ (etiquette: identify yourself to use the polite pool)
+    # without CROSSREF_MAILTO the requests go to the public pool, with no mailto at all
+    headers = {
+        "User-Agent": f"google-scholar-alert/0.1 (mailto:{mailto})" if mailto else "google-scholar-alert/0.1",
+    }
+    params = {"mailto": mailto} if mailto else {}
+    from httpx import Limits
+    limits = Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    return get_http_client(headers=headers, params=params, limits=limits, timeout=30)
+
+# an answer of the Crossref API other than 200 or 404, the status code decides whether the DOI is looked up again
+class CrossrefStatusError(ConnectionError):
+    def __init__(self, status_code, doi):
+        super().__init__(f"Crossref API returned status code {status_code} for DOI {doi}")
+        self.status_code = status_code
+
+def get_crossref_work(client, api_url, doi):
+    # same errors as crossref_commons.retrieval.get_publication_as_json
+    response = client.get(f"{api_url}/works/{doi}")
+    if response.status_code == 404:
+        raise ValueError(f"DOI {doi} does not exist")
+    if response.status_code != 200:
+        raise CrossrefStatusError(response.status_code, doi)
+    return response.json()['message']
+
+def normalize_doi(doi):
+    return doi.strip().lower()
+
+# letters and digits of any script are kept, a title without any normalizes to ""
+def normalize_title(title):
+    title = title.casefold()
+    title = re.sub(r'[^\w\s]|_', '', title)
+    title = re.sub(r'\s+', ' ', title).strip()
+    return title
+
+def token_sort_ratio(title, other_title):
+    # compare the sorted tokens so word order and spacing differences don't count as a mismatch
+    if not title or not other_title:
+        return 0.0
+    tokens = " ".join(sorted(title.split()))
+    other_tokens = " ".join(sorted(other_title.split()))
+    return SequenceMatcher(None, tokens, other_tokens).ratio()
+
 def search_in_text(text, link):
     # find using regex
     patterns = get_patterns()
@@ -39,6 +102,8 @@ def search_in_text(text, link):
         link.log_message = "DOI successfully retrieved"
 
 def search_in_pdf(pdf, link):
+    from pymupdf import pymupdf
+
     doc = pymupdf.Document(stream=pdf)
     # Extract all Document Text
     text = chr(12).join([page.get_text() for page in doc])
@@ -56,7 +121,8 @@ def search_in_pdf(pdf, link):
         link.log_message = "DOI successfully retrieved"
 
 def search_in_pdf_file(pdf, link):
-    print("search_in_pdf_file " + pdf)
+    from pymupdf import pymupdf
+
     doc = pymupdf.open(pdf, filetype="pdf")
     # Extract all Document Text
     text = chr(12).join([page.get_text() for page in doc])
@@ -88,4 +154,10 @@ def get_patterns():
 
 def printable_date_time_now():
     current_datetime = datetime.now(timezone.utc)
-    return current_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
\ No newline at end of file
+    return current_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# mongo returns naive datetimes, they are UTC
+def as_utc(date_time):
+    if date_time.tzinfo is None:
+        return date_time.replace(tzinfo=timezone.utc)
+    return date_time
@@ -0,0 +1,14 @@
+import importlib
+
+
+# a callable that imports the module of a class on the first call, the container uses it so a command
+# only imports the services (and their dependencies) it actually gets injected
+def lazy_class(path):
+    module_name, class_name = path.rsplit(".", 1)
+
+    def create(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), class_name)(*args, **kwargs)
+
+    create.__qualname__ = class_name
+    create.module_name = module_name
+    return create
@@ -0,0 +1,49 @@
+# what one item of a batch keeps alive at most, in bytes: a parsed Crossref work with its references,
+# a search result title with its embedding and scores; benchmark-memory measures the domain objects themselves
+ITEM_BYTES = {
+    "crossref": 64 * 1024,
+    "semantic_search": 8 * 1024,
+}
+
+
+# the batch size of a stage, lowered so a batch fits in the memory budget, at least one item
+def batch_size_within_budget(stage, batch_size, budget_mb):
+    return max(1, min(batch_size, budget_mb * 1024 * 1024 // ITEM_BYTES[stage]))
+
+
+# the domain objects a stage creates for every item, by class name, the strings they point to are created once and
+# shared so only the objects themselves are measured
+def get_domain_object_factories():
+    from datetime import datetime, timezone
+
+    from app.src.domain.crossref import Crossref
+    from app.src.domain.email import Email
+    from app.src.domain.email_body import EmailBody
+    from app.src.domain.search_result import SearchResult
+
+    date_sent = datetime.now(timezone.utc)
+    text = "x" * 200
+    return {
+        "Email": lambda: Email("scholaralerts-noreply@google.com", date_sent, text, None),
+        "EmailBody": lambda: EmailBody(text),
+        "SearchResult": lambda: SearchResult(text, text, text, "2025", text, text, "PDF"),
+        "Crossref": lambda: Crossref(200, True, text, text, 2025, text, text, text, text),
+    }
+
+# the peak memory tracemalloc sees while items objects are created, in KiB per 1000 objects
+def peak_kb_per_1000(create, items):
+    import tracemalloc
+
+    is_tracing = tracemalloc.is_tracing()
+    if not is_tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [create() for _ in range(items)]
+        peak_kb = (tracemalloc.get_traced_memory()[1] - before) / 1024 * 1000 / items
+        del objects
+    finally:
+        if not is_tracing:
+            tracemalloc.stop()
+    return peak_kb
@@ -0,0 +1,150 @@
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# upper bounds in seconds, from a mongo call up to a chrome download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STEP_DURATION = "pipeline_step_duration_seconds"
+ITEMS_TOTAL = "pipeline_items_total"
+MONGO_DURATION = "mongo_operation_duration_seconds"
+WORKER_RESTARTS = "pipeline_worker_restarts_total"
+
+HELP = {
+    STEP_DURATION: "Duration of a pipeline stage step.",
+    ITEMS_TOTAL: "Items handled by a pipeline stage by outcome.",
+    MONGO_DURATION: "Duration of a MongoDB operation.",
+    WORKER_RESTARTS: "Pipeline worker processes started again after they exited.",
+}
+
+
+class Metrics:
+    # counters and histograms in the Prometheus text format, without a client library
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+                self.histograms[key] = histogram
+            histogram["buckets"][bisect_left(self.buckets, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def time_step(self, stage, step):
+        return self.time(STEP_DURATION, stage=stage, step=step)
+
+    def count_item(self, stage, outcome, reason="", amount=1):
+        self.increment(ITEMS_TOTAL, amount, stage=stage, outcome=outcome, reason=reason)
+
+    # estimated like histogram_quantile in Prometheus, by interpolating inside the bucket the quantile falls in
+    def quantile(self, name, q, **labels):
+        with self.lock:
+            histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+            counts = list(histogram["buckets"]) if histogram is not None else []
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        # in the +Inf bucket
+        return lower
+
+    def histogram_labels(self, name):
+        with self.lock:
+            return [dict(labels) for histogram_name, labels in self.histograms if histogram_name == name]
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                described.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in described:
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                described.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(self.render())
+
+    def serve(self, port, host="0.0.0.0"):
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+        thread.start()
+        return server
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# one registry per process
+metrics = Metrics()
@@ -0,0 +1,110 @@
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+# cprofile: every call of every thread (pstats file), sampling: the stacks of every thread every interval
+# (collapsed stacks, the input of flamegraph.pl and speedscope), much cheaper on a busy process
+PROFILE_MODES = ("cprofile", "sampling")
+
+
+class StackSampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, filename):
+        with open(filename, "w", encoding="utf-8") as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    # profiles the whole command, or only until max_items items went through a stage
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.profile = None
+        self.sampler = None
+        self.filename_prefix = None
+        self.max_items = None
+        self.items = 0
+        # the last profile written
+        self.filename = None
+
+    @property
+    def running(self):
+        return self.profile is not None or self.sampler is not None
+
+    def start(self, mode, filename_prefix, max_items=None, sampling_interval=0.005):
+        self.mode = mode
+        self.filename_prefix = filename_prefix
+        self.max_items = max_items
+        self.items = 0
+        os.makedirs(os.path.dirname(filename_prefix) or ".", exist_ok=True)
+        if mode == "cprofile":
+            import cProfile
+
+            # since python 3.12 the calls of every thread are recorded
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.sampler = StackSampler(sampling_interval)
+            self.sampler.start()
+
+    def count_items(self, amount=1):
+        if self.max_items is None or not self.running:
+            return
+        with self.lock:
+            self.items += amount
+            reached = self.items >= self.max_items
+        if reached:
+            self.stop()
+
+    # writes the profile, returns its filename, None when nothing was profiled
+    def stop(self):
+        with self.lock:
+            profile, sampler = self.profile, self.sampler
+            self.profile = self.sampler = None
+        if profile is None and sampler is None:
+            return None
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        if profile is not None:
+            profile.disable()
+            filename = f"{self.filename_prefix}-{timestamp}.pstats"
+            profile.dump_stats(filename)
+        else:
+            sampler.stop()
+            filename = f"{self.filename_prefix}-{timestamp}.collapsed"
+            sampler.dump(filename)
+        self.filename = filename
+        return filename
+
+
+# one profiler per process
+profiler = Profiler()
@@ -0,0 +1,190 @@
+import atexit
+import json
+import logging
+import os
+import queue
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from time import time_ns
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# a trace file is rotated at TRACE_MAX_BYTES, TRACE_BACKUP_COUNT rotated files are kept
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', 50 * 1024 * 1024))
+TRACE_BACKUP_COUNT = int(os.getenv('TRACE_BACKUP_COUNT', 5))
+
+SERVICE_NAME = "google-scholar-alert"
+# https://opentelemetry.io/docs/specs/otel/trace/api/#spankind
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+# the span the code runs in, every thread starts without one
+current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("tracer", "name", "kind", "trace_id", "span_id", "parent_span_id", "attributes", "start_time",
+                 "end_time", "status_code", "status_message")
+
+    def __init__(self, tracer, name, kind, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent is not None else ""
+        self.attributes = dict(attributes or {})
+        self.start_time = time_ns()
+        self.end_time = None
+        self.status_code = STATUS_CODE_OK
+        self.status_message = ""
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.status_code = STATUS_CODE_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_time is not None:
+            return
+        self.end_time = time_ns()
+        self.tracer.export(self)
+
+    # one line of the OTLP/JSON file format, a collector can read the file with the otlpjsonfile receiver
+    def to_otlp(self):
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": to_otlp_attributes({"service.name": SERVICE_NAME,
+                                                               "process.pid": os.getpid()})},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [{
+                        "traceId": self.trace_id,
+                        "spanId": self.span_id,
+                        "parentSpanId": self.parent_span_id,
+                        "name": self.name,
+                        "kind": self.kind,
+                        "startTimeUnixNano": str(self.start_time),
+                        "endTimeUnixNano": str(self.end_time),
+                        "attributes": to_otlp_attributes(self.attributes),
+                        "status": {"code": self.status_code, "message": self.status_message},
+                    }],
+                }],
+            }]
+        }
+
+
+class NoSpan:
+    # what a span is when tracing is off
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    # the finished spans are written by a background thread, like the log records
+    def __init__(self):
+        self.logger = None
+
+    @property
+    def enabled(self):
+        return self.logger is not None
+
+    def configure(self, filename, max_bytes=TRACE_MAX_BYTES, backup_count=TRACE_BACKUP_COUNT):
+        if self.enabled:
+            return
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        file_handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8',
+                                           delay=True)
+        spans = queue.SimpleQueue()
+        logger = logging.getLogger(__name__)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.handlers = [QueueHandler(spans)]
+        listener = QueueListener(spans, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        self.logger = logger
+
+    # a span that isn't the current one, it has to be ended by the caller
+    def start_span(self, name, attributes=None, kind=SPAN_KIND_INTERNAL):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, kind, current_span.get(), attributes)
+
+    @contextmanager
+    def span(self, name, attributes=None, kind=SPAN_KIND_INTERNAL):
+        if not self.enabled:
+            yield NO_SPAN
+            return
+        span = Span(self, name, kind, current_span.get(), attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except Exception as error:
+            span.set_error(error)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def export(self, span):
+        self.logger.info(json.dumps(span.to_otlp()))
+
+
+def to_otlp_attributes(attributes):
+    return [{"key": key, "value": to_otlp_value(value)} for key, value in attributes.items()]
+
+def to_otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 is a string in OTLP/JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def from_otlp_value(value):
+    for key, convert in (("stringValue", str), ("intValue", int), ("doubleValue", float), ("boolValue", bool)):
+        if key in value:
+            return convert(value[key])
+    return None
+
+# every span in the trace files, rotated files included, as (name, duration in seconds, attributes, status code)
+def read_spans(filenames):
+    for filename in filenames:
+        with open(filename, encoding="utf-8") as trace_file:
+            for line in trace_file:
+                if not line.strip():
+                    continue
+                for resource_spans in json.loads(line)["resourceSpans"]:
+                    for scope_spans in resource_spans["scopeSpans"]:
+                        for span in scope_spans["spans"]:
+                            duration = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9
+                            attributes = {attribute["key"]: from_otlp_value(attribute["value"])
+                                          for attribute in span.get("attributes", [])}
+                            yield span["name"], duration, attributes, span.get("status", {}).get("code")
+
+def get_trace_filenames(trace_dir):
+    if not os.path.isdir(trace_dir):
+        return []
+    return sorted(os.path.join(trace_dir, f) for f in os.listdir(trace_dir) if ".jsonl" in f)
+
+
+# one tracer per process
+tracer = Tracer()
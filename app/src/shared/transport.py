@@ -0,0 +1,166 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from time import perf_counter, sleep
+
+from dotenv import load_dotenv
+from httpx import BaseTransport, ByteStream, ConnectError, HTTPTransport, Response, SyncByteStream
+
+from app.src.shared.tracing import SPAN_KIND_CLIENT, tracer
+
+load_dotenv()
+# live: go to the network, record: go to the network and store every exchange, replay: only use stored exchanges
+HTTP_TRANSPORT_MODE = os.getenv('HTTP_TRANSPORT_MODE', 'live')
+HTTP_CASSETTE_DIR = os.getenv('HTTP_CASSETTE_DIR', os.path.join(str(Path(__file__).parent.parent.parent.parent), 'cassettes'))
+# empty: no latency, "recorded": the latency measured while recording, a number: a fixed latency in seconds
+HTTP_REPLAY_LATENCY = os.getenv('HTTP_REPLAY_LATENCY', '')
+
+
+class RecordReplayTransport(BaseTransport):
+    def __init__(self, mode, cassette_dir, replay_latency="", transport=None):
+        self.mode = mode
+        self.cassette_dir = cassette_dir
+        self.replay_latency = replay_latency
+        self.transport = transport or HTTPTransport()
+
+    def handle_request(self, request):
+        request.read()
+        cassette = os.path.join(self.cassette_dir, "http", cassette_key(request.method, str(request.url), request.content) + ".json")
+        if self.mode == "replay":
+            return self.replay(request, cassette)
+        return self.record(request, cassette)
+
+    def record(self, request, cassette):
+        start = perf_counter()
+        response = self.transport.handle_request(request)
+        try:
+            # keep the raw (still encoded) body so the headers stay valid on replay
+            content = b"".join(response.iter_raw())
+        finally:
+            response.close()
+        elapsed = perf_counter() - start
+        exchange = {
+            "method": request.method,
+            "url": str(request.url),
+            "status_code": response.status_code,
+            "headers": response.headers.multi_items(),
+            "content": base64.b64encode(content).decode("ascii"),
+            "elapsed": elapsed,
+        }
+        os.makedirs(os.path.dirname(cassette), exist_ok=True)
+        with open(cassette, "w", encoding="utf-8") as cassette_file:
+            json.dump(exchange, cassette_file)
+        return Response(response.status_code, headers=response.headers, stream=ByteStream(content),
+                        extensions=response.extensions, request=request)
+
+    def replay(self, request, cassette):
+        if not os.path.exists(cassette):
+            raise ConnectError(f"No cassette for {request.method} {request.url}", request=request)
+        with open(cassette, encoding="utf-8") as cassette_file:
+            exchange = json.load(cassette_file)
+        simulate_latency(self.replay_latency, exchange["elapsed"])
+        content = base64.b64decode(exchange["content"])
+        return Response(exchange["status_code"], headers=exchange["headers"], stream=ByteStream(content),
+                        request=request)
+
+    def close(self):
+        self.transport.close()
+
+
+class TracingTransport(BaseTransport):
+    # a span per request, from sending it until the body is read or the response is closed
+    def __init__(self, transport):
+        self.transport = transport
+
+    def handle_request(self, request):
+        span = tracer.start_span(f"http {request.method}", {
+            "http.request.method": request.method,
+            "server.address": request.url.host,
+            "url.full": str(request.url),
+        }, SPAN_KIND_CLIENT)
+        try:
+            response = self.transport.handle_request(request)
+        except Exception as error:
+            span.set_error(error)
+            span.end()
+            raise
+        span.set_attribute("http.response.status_code", response.status_code)
+        if response.status_code >= 400:
+            span.set_attribute("error.type", str(response.status_code))
+        return Response(response.status_code, headers=response.headers, stream=TracedStream(response.stream, span),
+                        extensions=response.extensions, request=request)
+
+    def close(self):
+        self.transport.close()
+
+
+class TracedStream(SyncByteStream):
+    def __init__(self, stream, span):
+        self.stream = stream
+        self.span = span
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.span.set_attribute("http.response.body.size", self.size)
+            self.span.end()
+
+
+def cassette_key(method, url, content=b""):
+    key = hashlib.sha256()
+    key.update(method.encode("utf-8"))
+    key.update(url.encode("utf-8"))
+    key.update(content)
+    return key.hexdigest()
+
+def simulate_latency(replay_latency, recorded_latency):
+    if replay_latency == "recorded":
+        sleep(recorded_latency)
+    elif replay_latency:
+        sleep(float(replay_latency))
+
+def get_transport(**kwargs):
+    # None lets httpx use its default transport, kwargs (limits) are passed to the transport that goes to the network
+    transport = None
+    if HTTP_TRANSPORT_MODE in ("record", "replay"):
+        transport = RecordReplayTransport(HTTP_TRANSPORT_MODE, HTTP_CASSETTE_DIR, HTTP_REPLAY_LATENCY,
+                                          HTTPTransport(**kwargs))
+    if tracer.enabled:
+        transport = TracingTransport(transport or HTTPTransport(**kwargs))
+    return transport
+
+def is_replaying():
+    return HTTP_TRANSPORT_MODE == "replay"
+
+def wait_between_requests(seconds):
+    # the waits only protect remote servers, a replay doesn't need them
+    if not is_replaying():
+        with tracer.span("wait", {"wait.seconds": seconds}):
+            sleep(seconds)
+
+# files downloaded by the browser are stored in the cassette directory under the url they were downloaded from
+def record_download(url, file_paths):
+    if HTTP_TRANSPORT_MODE != "record":
+        return
+    download_dir = os.path.join(HTTP_CASSETTE_DIR, "download", cassette_key("GET", url))
+    os.makedirs(download_dir, exist_ok=True)
+    for file_path in file_paths:
+        shutil.copy(file_path, download_dir)
+
+def replay_download(url, download_folder):
+    download_dir = os.path.join(HTTP_CASSETTE_DIR, "download", cassette_key("GET", url))
+    if not os.path.isdir(download_dir):
+        return
+    simulate_latency(HTTP_REPLAY_LATENCY, 0)
+    for f in os.listdir(download_dir):
+        shutil.copy(os.path.join(download_dir, f), download_folder)
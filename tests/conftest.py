@@ -0,0 +1,28 @@
+import logging
+import os
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+
+# the services read the database and collection names, the content types and the alert sender from the environment
+# at import
+os.environ.setdefault("DATABASE", "google_scholar_alert_test")
+os.environ.setdefault("COLLECTION_EMAILS", "emails")
+os.environ.setdefault("COLLECTION_SEARCH_RESULTS", "search_results")
+os.environ.setdefault("COLLECTION_CROSSREF", "crossref")
+os.environ.setdefault("CONTENT_TYPE_HTML", "text/html")
+os.environ.setdefault("CONTENT_TYPE_PDF", "application/pdf")
+os.environ.setdefault("SENDER", "scholaralerts-noreply@google.com")
+
+
+@pytest.fixture
+def db_service():
+    from app.src.services.db_service import DBService
+    return DBService(mongomock.MongoClient())
+
+
+@pytest.fixture
+def logging_service():
+    # the LoggingService writes to log/, the tests log to pytest's capture instead
+    return SimpleNamespace(logger=logging.getLogger("tests"))
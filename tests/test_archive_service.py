@@ -0,0 +1,65 @@
+import mailbox
+from email import message_from_bytes
+
+import pytest
+
+from app.src.main import import_archive_worker
+from app.src.services.archive_service import ArchiveService
+from app.src.services.email_service import EmailService
+
+ALERT = (b"From: Google Scholar Alerts <scholaralerts-noreply@google.com>\r\n"
+         b"Subject: Ocean acidification - new results\r\n"
+         b"Date: Mon, 19 Oct 2026 12:30:00 +0200\r\n"
+         b"Message-ID: <alert-1@google.com>\r\n"
+         b"Content-Type: text/html; charset=utf-8\r\n"
+         b"\r\n"
+         b"<html><body>alert</body></html>\r\n")
+
+
+@pytest.fixture
+def archive_service(db_service, logging_service):
+    return ArchiveService(db_service, logging_service, workers=1, batch_size=10)
+
+
+@pytest.fixture
+def email_service(db_service, logging_service):
+    return EmailService(db_service, logging_service)
+
+
+def import_items(items, archive_service, email_service):
+    return [import_archive_worker(item, archive_service=archive_service, email_service=email_service)
+            for item in items]
+
+
+def test_messages_of_a_directory_are_read_as_msg_files(tmp_path, archive_service):
+    (tmp_path / "b.msg").write_bytes(b"")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a.MSG").write_bytes(b"")
+    (tmp_path / "notes.txt").write_bytes(b"")
+    assert list(archive_service.iter_archive(str(tmp_path))) == [
+        ("msg", str(tmp_path / "b.msg")), ("msg", str(tmp_path / "sub" / "a.MSG"))]
+
+
+def test_damaged_msg_file_is_unreadable_and_the_import_goes_on(tmp_path, archive_service, email_service, caplog):
+    (tmp_path / "damaged.msg").write_bytes(b"\xd0\xcf\x11\xe0 not an Outlook message")
+    archive = mailbox.mbox(str(tmp_path / "alerts.mbox"))
+    archive.add(message_from_bytes(ALERT))
+    archive.close()
+    items = [("msg", str(tmp_path / "damaged.msg")), *archive_service.iter_archive(str(tmp_path / "alerts.mbox"))]
+    damaged, alert = import_items(items, archive_service, email_service)
+    assert damaged is None
+    assert f"unreadable message {tmp_path / 'damaged.msg'}" in caplog.text
+    assert alert["message_id"] == "<alert-1@google.com>"
+    assert archive_service.store_emails([alert]) == (1, 0)
+
+
+def test_message_without_alert_headers_is_unreadable(archive_service, email_service):
+    assert import_items([("bytes", b"Subject: no sender or date\r\n\r\nbody")], archive_service, email_service) == [None]
+
+
+def test_stored_email_is_skipped(archive_service, email_service):
+    [post] = import_items([("bytes", ALERT)], archive_service, email_service)
+    email_service.create_message_id_index()
+    assert archive_service.store_emails([post]) == (1, 0)
+    [post] = import_items([("bytes", ALERT)], archive_service, email_service)
+    assert archive_service.store_emails([post]) == (0, 1)
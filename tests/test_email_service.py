@@ -0,0 +1,55 @@
+import mailbox
+from datetime import datetime, timedelta, timezone
+from email import message_from_bytes
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import extract_msg
+
+from app.src.services.archive_service import ArchiveService, read_msg_file
+from app.src.services.email_service import get_message_id
+
+# as the IMAP server returns it: the subject is encoded, the date is local time
+INBOX_ALERT = (b"From: Google Scholar Alerts <scholaralerts-noreply@google.com>\r\n"
+               b"To: alerts@example.org\r\n"
+               b"Subject: =?UTF-8?B?T2NlYW4gYWNpZGlmaWNhdGlvbiAtIG5ldyByZXN1bHRz?=\r\n"
+               b"Date: Mon, 19 Oct 2026 12:30:00 +0200\r\n"
+               b"Content-Type: text/html; charset=utf-8\r\n"
+               b"\r\n"
+               b"<html><body>alert</body></html>\r\n")
+
+
+def test_message_id_is_kept():
+    email_message = message_from_bytes(INBOX_ALERT)
+    email_message["Message-ID"] = " <alert-1@google.com> "
+    assert get_message_id(email_message) == "<alert-1@google.com>"
+
+
+def test_fallback_message_id_is_the_same_for_the_inbox_and_an_mbox_archive(tmp_path, db_service, logging_service):
+    archive = mailbox.mbox(str(tmp_path / "alerts.mbox"))
+    archive.add(message_from_bytes(INBOX_ALERT))
+    archive.close()
+    archive_service = ArchiveService(db_service, logging_service, workers=1, batch_size=10)
+    [(kind, value)] = list(archive_service.iter_archive(str(tmp_path / "alerts.mbox")))
+    archived_message = archive_service.read_message(kind, value)
+    message_id = get_message_id(message_from_bytes(INBOX_ALERT))
+    assert message_id.endswith("@google-scholar-alert>")
+    assert get_message_id(archived_message) == message_id
+
+
+def test_fallback_message_id_is_the_same_for_the_inbox_and_an_outlook_message(monkeypatch):
+    # an Outlook .msg has the decoded subject and the date in another time zone
+    outlook_message = SimpleNamespace(sender="Google Scholar Alerts <ScholarAlerts-NoReply@google.com>",
+                                      subject="Ocean acidification - new results",
+                                      date=datetime(2026, 10, 19, 10, 30, tzinfo=timezone.utc), messageId=None,
+                                      htmlBody=b"<html><body>alert</body></html>", close=lambda: None)
+    monkeypatch.setattr(extract_msg, "openMsg", lambda filename: outlook_message)
+    archived_message = read_msg_file("alert.msg")
+    assert get_message_id(archived_message) == get_message_id(message_from_bytes(INBOX_ALERT))
+
+
+def test_fallback_message_id_differs_for_another_alert():
+    other_alert = message_from_bytes(INBOX_ALERT)
+    other_alert.replace_header("Date", format_datetime(datetime(2026, 10, 19, 12, 30,
+                                                                tzinfo=timezone(timedelta(hours=1)))))
+    assert get_message_id(other_alert) != get_message_id(message_from_bytes(INBOX_ALERT))
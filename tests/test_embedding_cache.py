@@ -0,0 +1,99 @@
+import multiprocessing
+
+import numpy as np
+
+from app.src.shared.embedding_cache import EmbeddingCache
+
+
+def vector(seed, dimension=4):
+    return np.random.default_rng(seed).random(dimension, dtype=np.float32)
+
+
+def put_titles(path, titles):
+    cache = EmbeddingCache(path, "model-a", 64)
+    for title in titles:
+        cache.put_many([title], [vector(int(title.split()[-1]))])
+
+
+def test_cached_titles_are_returned(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model-a", 4)
+    cache.put_many(["coral reefs", "sea grass"], [vector(1), vector(2)])
+    coral_reefs, sea_grass, kelp = cache.get_many(["coral reefs", "sea grass", "kelp"])
+    np.testing.assert_array_equal(coral_reefs, vector(1))
+    np.testing.assert_array_equal(sea_grass, vector(2))
+    assert kelp is None
+
+
+def test_least_recently_used_title_is_evicted(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model-a", 2)
+    cache.put_many(["coral reefs", "sea grass"], [vector(1), vector(2)])
+    # coral reefs is used again, sea grass is now the least recently used
+    cache.get_many(["coral reefs"])
+    cache.put_many(["kelp"], [vector(3)])
+    coral_reefs, sea_grass, kelp = cache.get_many(["coral reefs", "sea grass", "kelp"])
+    np.testing.assert_array_equal(coral_reefs, vector(1))
+    assert sea_grass is None
+    np.testing.assert_array_equal(kelp, vector(3))
+
+
+def test_recency_of_hits_is_kept_by_flush(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model-a", 2)
+    cache.put_many(["coral reefs", "sea grass"], [vector(1), vector(2)])
+    cache.get_many(["coral reefs"])
+    cache.flush()
+    reopened = EmbeddingCache(str(tmp_path), "model-a", 2)
+    reopened.put_many(["kelp"], [vector(3)])
+    assert reopened.get_many(["sea grass"]) == [None]
+    assert reopened.get_many(["coral reefs"])[0] is not None
+
+
+def test_titles_of_another_model_are_not_returned(tmp_path):
+    EmbeddingCache(str(tmp_path), "model-a", 4).put_many(["coral reefs"], [vector(1)])
+    cache = EmbeddingCache(str(tmp_path), "model-b", 4)
+    assert cache.get_many(["coral reefs"]) == [None]
+    # the embedding of the new model replaces the old one
+    cache.put_many(["coral reefs"], [vector(2)])
+    np.testing.assert_array_equal(cache.get_many(["coral reefs"])[0], vector(2))
+    assert EmbeddingCache(str(tmp_path), "model-a", 4).get_many(["coral reefs"]) == [None]
+
+
+def test_cache_is_cleared_when_the_dimension_changes(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model-a", 4)
+    cache.put_many(["coral reefs", "sea grass"], [vector(1), vector(2)])
+    cache = EmbeddingCache(str(tmp_path), "model-b", 4)
+    cache.put_many(["kelp"], [vector(3, dimension=8)])
+    assert cache.get_many(["coral reefs", "sea grass"]) == [None, None]
+    np.testing.assert_array_equal(cache.get_many(["kelp"])[0], vector(3, dimension=8))
+
+
+def test_cache_is_rebuilt_when_the_capacity_changes(tmp_path):
+    EmbeddingCache(str(tmp_path), "model-a", 4).put_many(["coral reefs"], [vector(1)])
+    assert EmbeddingCache(str(tmp_path), "model-a", 8).get_many(["coral reefs"]) == [None]
+
+
+def test_cache_sees_the_titles_another_instance_stored(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model-a", 4)
+    other_cache = EmbeddingCache(str(tmp_path), "model-a", 4)
+    cache.put_many(["coral reefs"], [vector(1)])
+    other_cache.put_many(["sea grass"], [vector(2)])
+    coral_reefs, sea_grass = cache.get_many(["coral reefs", "sea grass"])
+    np.testing.assert_array_equal(coral_reefs, vector(1))
+    np.testing.assert_array_equal(sea_grass, vector(2))
+
+
+def test_processes_sharing_the_cache_do_not_lose_titles(tmp_path):
+    # every process writes its own titles one by one, without the flock the index of one process would overwrite
+    # the titles of another
+    titles = [[f"title {process * 10 + i}" for i in range(10)] for process in range(4)]
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=put_titles, args=(str(tmp_path), process_titles))
+                 for process_titles in titles]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    cache = EmbeddingCache(str(tmp_path), "model-a", 64)
+    all_titles = [title for process_titles in titles for title in process_titles]
+    for title, cached in zip(all_titles, cache.get_many(all_titles)):
+        np.testing.assert_array_equal(cached, vector(int(title.split()[-1])))
@@ -0,0 +1,52 @@
+import pytest
+
+from app.src.shared.helper import normalize_title, token_sort_ratio
+
+
+@pytest.mark.parametrize("title, expected", [
+    ("Coral Reefs: A Review.", "coral reefs a review"),
+    ("  Coral   reefs\ta\nreview ", "coral reefs a review"),
+    ("Sea-level rise & the North_Sea", "sealevel rise the northsea"),
+    ("STRASSE und Straße", "strasse und strasse"),
+    ("", ""),
+])
+def test_normalize_title(title, expected):
+    assert normalize_title(title) == expected
+
+
+@pytest.mark.parametrize("title, expected", [
+    ("Морские Экосистемы: Обзор", "морские экосистемы обзор"),
+    ("Θαλάσσια Οικοσυστήματα!", "θαλάσσια οικοσυστήματα"),
+    ("海洋生态系统：综述", "海洋生态系统综述"),
+    ("Écologie marine, côtière", "écologie marine côtière"),
+])
+def test_normalize_title_keeps_non_latin_letters(title, expected):
+    assert normalize_title(title) == expected
+
+
+def test_normalize_title_of_punctuation_only_is_empty():
+    assert normalize_title("?!… — ()") == ""
+
+
+def test_token_sort_ratio_ignores_word_order():
+    assert token_sort_ratio("coral reefs a review", "a review coral reefs") == 1.0
+
+
+def test_token_sort_ratio_of_different_titles_is_low():
+    assert token_sort_ratio("coral reefs a review", "deep sea mining impacts") < 0.5
+
+
+def test_token_sort_ratio_of_near_match_is_above_threshold():
+    ratio = token_sort_ratio(normalize_title("Coral reefs: a review"), normalize_title("Coral reef - a review"))
+    assert 0.9 <= ratio < 1.0
+
+
+@pytest.mark.parametrize("title, other_title", [("", "coral reefs"), ("coral reefs", ""), ("", "")])
+def test_token_sort_ratio_of_empty_title_is_zero(title, other_title):
+    assert token_sort_ratio(title, other_title) == 0.0
+
+
+def test_token_sort_ratio_of_non_latin_titles():
+    title = normalize_title("Морские экосистемы: обзор")
+    assert token_sort_ratio(title, normalize_title("Обзор — морские экосистемы")) == 1.0
+    assert token_sort_ratio(title, normalize_title("Marine ecosystems: a review")) < 0.5
@@ -0,0 +1,18 @@
+import pytest
+
+from app.src.shared.memory_budget import get_domain_object_factories, peak_kb_per_1000
+
+# KiB per 1000 objects, with __slots__ they measure about Email 165, EmailBody 134, SearchResult 345 and
+# Crossref 173 (Email 467 and SearchResult 535 without)
+MAX_KB_PER_1000 = {
+    "Email": 200,
+    "EmailBody": 160,
+    "SearchResult": 400,
+    "Crossref": 210,
+}
+
+
+@pytest.mark.parametrize("name", MAX_KB_PER_1000)
+def test_peak_memory_per_1000_objects(name):
+    create = get_domain_object_factories()[name]
+    assert peak_kb_per_1000(create, 10000) <= MAX_KB_PER_1000[name]
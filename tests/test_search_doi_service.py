@@ -0,0 +1,261 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from app.src.domain import link as link_module
+from app.src.services import search_DOI_link_searched_state, search_DOI_unprocessed_state
+from app.src.services.db_service import DBService
+from app.src.services.search_DOI_service import NegativeCacheHit, SearchDOIService
+
+SCHOLAR_URL = "https://scholar.google.com/scholar_url?url=https://publisher.org/article/1"
+
+
+def create_search_doi_service(db_service, logging_service):
+    return SearchDOIService(db_service, logging_service, crossref_api_url="https://api.crossref.org/works",
+                            crossref_rows=5, title_similarity_threshold=0.9, title_miss_ttl_days=7, max_attempts=3,
+                            retry_base_delay_seconds=300, retry_max_delay_seconds=86400, negative_cache_ttl_hours=24,
+                            workers=2, lease_seconds=900, request_wait_seconds=0, browser="none")
+
+
+@pytest.fixture
+def search_doi_service(db_service, logging_service):
+    return create_search_doi_service(db_service, logging_service)
+
+
+def insert_search_result(db_service, search_result_id, url=SCHOLAR_URL):
+    db_service.set_collection("search_results")
+    db_service.collection.insert_one({"_id": search_result_id, "title": "Coral reefs: a review", "link": {"url": url},
+                                      "is_processed": False})
+
+
+def get_search_result(db_service, search_result_id):
+    db_service.set_collection("search_results")
+    return db_service.collection.find_one({"_id": search_result_id})
+
+
+def get_failed_urls(db_service):
+    db_service.set_collection("failed_urls")
+    return [failed_url["url"] for failed_url in db_service.collection.find()]
+
+
+def get_title_cache_entry(db_service, title):
+    db_service.set_collection("crossref_title_cache")
+    return db_service.collection.find_one({"title": title})
+
+
+def test_found_title_is_cached_without_expiry(search_doi_service, db_service):
+    search_doi_service.cache_crossref_title("coral reefs a review", "10.1/coral", "Coral reefs: a review", 1.0)
+    assert get_title_cache_entry(db_service, "coral reefs a review")["expires_at"] is None
+    search_doi_service.crossref_title_cache.clear()
+    assert search_doi_service.get_cached_crossref_title("coral reefs a review")["DOI"] == "10.1/coral"
+
+
+def test_title_miss_expires_after_ttl(search_doi_service, db_service):
+    before = datetime.now(timezone.utc)
+    search_doi_service.cache_crossref_title("coral reefs a review", None, None, None)
+    expires_at = get_title_cache_entry(db_service, "coral reefs a review")["expires_at"]
+    # mongo keeps milliseconds
+    ttl = expires_at.replace(tzinfo=timezone.utc) - before
+    assert timedelta(days=7, seconds=-1) <= ttl <= timedelta(days=7, minutes=1)
+    assert search_doi_service.get_cached_crossref_title("coral reefs a review")["DOI"] is None
+
+
+def test_expired_title_miss_is_searched_again(search_doi_service, db_service):
+    search_doi_service.cache_crossref_title("coral reefs a review", None, None, None)
+    expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+    search_doi_service.crossref_title_cache["coral reefs a review"]["expires_at"] = expired
+    db_service.set_collection("crossref_title_cache")
+    db_service.collection.update_one({"title": "coral reefs a review"}, {"$set": {"expires_at": expired}})
+    assert search_doi_service.get_cached_crossref_title("coral reefs a review") is None
+
+
+def test_title_cache_expires_only_misses(search_doi_service, db_service):
+    search_doi_service.get_cached_crossref_title("coral reefs a review")
+    db_service.set_collection("crossref_title_cache")
+    indexes = db_service.collection.index_information()
+    assert indexes["expires_at_1"]["expireAfterSeconds"] == 0
+    assert indexes["title_1"]["unique"]
+
+
+def test_retry_backoff_doubles_up_to_the_max_delay(search_doi_service, db_service, monkeypatch):
+    # without jitter the delay is the upper bound, half of it is the lower bound
+    monkeypatch.setattr("random.uniform", lambda low, high: high)
+    search_doi_service.max_attempts = 10
+    insert_search_result(db_service, 1)
+    delays = []
+    for _ in range(6):
+        before = datetime.now(timezone.utc)
+        search_doi_service.register_failure(1, ConnectionError("timeout"))
+        retry = get_search_result(db_service, 1)["retry"]
+        delays.append(round((retry["next_attempt_at"].replace(tzinfo=timezone.utc) - before).total_seconds()))
+    assert delays == [300, 600, 1200, 2400, 4800, 9600]
+    assert retry["attempts"] == 6
+    assert not retry["is_dead_letter"]
+
+
+def test_retry_backoff_jitter_stays_within_half_of_the_delay(search_doi_service, db_service, monkeypatch):
+    monkeypatch.setattr("random.uniform", lambda low, high: low)
+    search_doi_service.retry_max_delay_seconds = 1000
+    search_doi_service.max_attempts = 10
+    insert_search_result(db_service, 1)
+    for _ in range(5):
+        before = datetime.now(timezone.utc)
+        search_doi_service.register_failure(1, ConnectionError("timeout"))
+    retry = get_search_result(db_service, 1)["retry"]
+    # 300 * 2 ** 4 is capped at 1000, half of it without jitter
+    assert round((retry["next_attempt_at"].replace(tzinfo=timezone.utc) - before).total_seconds()) == 500
+
+
+def test_failed_search_result_is_not_claimed_before_its_next_attempt(search_doi_service, db_service):
+    insert_search_result(db_service, 1)
+    search_doi_service.register_failure(1, ConnectionError("timeout"))
+    assert get_search_result(db_service, 1)["doi_state"]["lease_until"] is None
+    assert search_doi_service.claim_unprocessed_id() is None
+
+
+def test_search_result_is_a_dead_letter_after_max_attempts(search_doi_service, db_service):
+    insert_search_result(db_service, 1)
+    for _ in range(3):
+        search_doi_service.register_failure(1, ConnectionError("timeout"))
+    search_result = get_search_result(db_service, 1)
+    assert search_result["retry"] == {"attempts": 3, "last_error": "timeout", "is_dead_letter": True}
+    assert search_result["is_processed"]
+    assert search_result["link"]["url"] == SCHOLAR_URL
+    assert search_result["link"]["DOI"] is None
+    assert not search_result["link"]["is_DOI_success"]
+    assert search_result["log_message"] == "Dead letter after 3 attempts: timeout"
+    assert search_doi_service.claim_unprocessed_id() is None
+
+
+def test_failed_request_is_negative_cached_by_the_requested_url(search_doi_service, db_service, monkeypatch):
+    # the request was redirected, the error carries the url it ended on
+    error = httpx.ConnectError("connection refused", request=httpx.Request("GET", "https://publisher.org/article/1"))
+
+    def do_external_request(url, follow_redirects):
+        raise error
+
+    monkeypatch.setattr(search_DOI_unprocessed_state, "do_external_request", do_external_request)
+    insert_search_result(db_service, 1)
+    search_doi_context = search_doi_service.get_context(1)
+    with pytest.raises(httpx.ConnectError):
+        search_doi_service.next_step(search_doi_context)
+    search_doi_service.register_failure(1, error, search_doi_service.get_requested_url(search_doi_context))
+    assert get_failed_urls(db_service) == [SCHOLAR_URL]
+    assert get_search_result(db_service, 1)["retry"]["attempts"] == 1
+
+
+def test_negative_cache_hit_skips_the_request(search_doi_service, db_service, monkeypatch):
+    def do_external_request(url, follow_redirects):
+        raise AssertionError(f"{url} is in the negative cache and should not be requested")
+
+    monkeypatch.setattr(search_DOI_unprocessed_state, "do_external_request", do_external_request)
+    search_doi_service.add_to_negative_cache(SCHOLAR_URL, ConnectionError("connection refused"))
+    insert_search_result(db_service, 2)
+    search_doi_context = search_doi_service.get_context(2)
+    with pytest.raises(NegativeCacheHit) as negative_cache_hit:
+        search_doi_service.next_step(search_doi_context)
+    assert search_doi_context.current_state.to_string() == "unprocessed"
+    search_doi_service.register_failure(2, negative_cache_hit.value)
+    retry = get_search_result(db_service, 2)["retry"]
+    # a negative cache hit isn't an attempt, the search result waits until the url may be requested again
+    assert retry["attempts"] == 0
+    assert retry["next_attempt_at"].replace(tzinfo=timezone.utc) >= negative_cache_hit.value.expires_at - timedelta(
+        milliseconds=1)
+    assert search_doi_service.claim_unprocessed_id() is None
+
+
+def html_response(text):
+    return SimpleNamespace(status_code=200, headers={"content-type": "text/html; charset=utf-8"}, text=text,
+                           content=text.encode())
+
+
+def run_until_doi(search_doi_service, search_doi_context):
+    # the loop of process_search_result_doi
+    link = search_doi_context.get_link()
+    while not link.doi and not search_doi_context.processing_finished():
+        link = search_doi_service.next_step(search_doi_context)
+    return link
+
+
+def test_search_result_resumes_from_the_saved_stage_after_a_failure(search_doi_service, db_service, monkeypatch):
+    requests = []
+
+    def scholar_request(url, follow_redirects):
+        requests.append(url)
+        return html_response("<script>location.replace('https://publisher.org/article/1')</script>")
+
+    def crossref_request(crossref_api_url, title, rows):
+        requests.append(crossref_api_url)
+        return []
+
+    def failing_publisher_request(url, follow_redirects):
+        requests.append(url)
+        raise ValueError("malformed response")
+
+    monkeypatch.setattr(search_DOI_unprocessed_state, "do_external_request", scholar_request)
+    monkeypatch.setattr(search_DOI_link_searched_state, "search_crossref_works", crossref_request)
+    monkeypatch.setattr(link_module, "do_external_request", failing_publisher_request)
+    insert_search_result(db_service, 1)
+    search_doi_context = search_doi_service.get_context(1)
+    with pytest.raises(ValueError):
+        run_until_doi(search_doi_service, search_doi_context)
+    search_doi_service.register_failure(1, ValueError("malformed response"))
+    assert requests == [SCHOLAR_URL, "https://api.crossref.org/works", "https://publisher.org/article/1"]
+    assert get_search_result(db_service, 1)["doi_state"]["stage"] == "crossref searched"
+
+    # the next attempt only requests the publisher again
+    def publisher_request(url, follow_redirects):
+        requests.append(url)
+        return html_response('<meta name="citation_doi" content="10.1234/coral.5678">')
+
+    requests.clear()
+    monkeypatch.setattr(link_module, "do_external_request", publisher_request)
+    search_doi_context = search_doi_service.get_context(1)
+    assert search_doi_context.current_state.to_string() == "crossref searched"
+    assert search_doi_context.get_link().location_replace_url == "https://publisher.org/article/1"
+    assert search_doi_context.get_link().response_code == 200
+    link = run_until_doi(search_doi_service, search_doi_context)
+    assert requests == ["https://publisher.org/article/1"]
+    assert link.doi == "10.1234/coral.5678"
+    search_doi_service.update_link_content(search_doi_context)
+    search_result = get_search_result(db_service, 1)
+    assert search_result["link"]["DOI"] == "10.1234/coral.5678"
+    assert search_result["doi_state"]["stage"] == "content searched"
+
+
+def test_saved_context_keeps_the_partial_link_results(search_doi_service, db_service, monkeypatch):
+    monkeypatch.setattr(search_DOI_unprocessed_state, "do_external_request", lambda url, follow_redirects: html_response(
+        "<script>location.replace('https://publisher.org/article/1')</script>"))
+    insert_search_result(db_service, 1)
+    search_doi_service.next_step(search_doi_service.get_context(1))
+    search_result = get_search_result(db_service, 1)
+    assert search_result["doi_state"]["stage"] == "replaced"
+    assert search_result["link"]["url"] == SCHOLAR_URL
+    assert search_result["link"]["location_replace_url"] == "https://publisher.org/article/1"
+    assert search_result["link"]["response_type"] == "text/html"
+    assert search_result["title"] == "Coral reefs: a review"
+
+
+def test_a_leased_search_result_is_not_claimed_by_a_second_worker(search_doi_service, db_service, logging_service):
+    second_worker = create_search_doi_service(DBService(db_service.client), logging_service)
+    insert_search_result(db_service, 1)
+    insert_search_result(db_service, 2)
+    first_claim = search_doi_service.claim_unprocessed_id()
+    second_claim = second_worker.claim_unprocessed_id()
+    assert {first_claim, second_claim} == {1, 2}
+    assert search_doi_service.claim_unprocessed_id() is None
+    assert second_worker.claim_unprocessed_id() is None
+
+
+def test_an_expired_lease_is_claimed_again(search_doi_service, db_service, logging_service):
+    second_worker = create_search_doi_service(DBService(db_service.client), logging_service)
+    insert_search_result(db_service, 1)
+    assert search_doi_service.claim_unprocessed_id() == 1
+    assert second_worker.claim_unprocessed_id() is None
+    # the first worker died without releasing its lease
+    db_service.set_collection("search_results")
+    db_service.collection.update_one({"_id": 1}, {"$set": {
+        "doi_state.lease_until": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+    assert second_worker.claim_unprocessed_id() == 1
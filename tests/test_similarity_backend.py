@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+from app.src.services import similarity_backend
+from app.src.services.similarity_backend import NumpySimilarityBackend
+
+DIMENSION = 16
+# int8 keeps about two decimals of every component
+DISTANCE_TOLERANCE = {"none": 1e-5, "int8": 0.02}
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # the matrix is written and queried in several chunks
+    monkeypatch.setattr(similarity_backend, "QUERY_CHUNK_ROWS", 7)
+
+
+@pytest.fixture(params=["none", "int8"])
+def quantization(request):
+    return request.param
+
+
+def embeddings(seed, count):
+    return np.random.default_rng(seed).normal(size=(count, DIMENSION)).astype(np.float32)
+
+
+def upsert(backend, reference, ids, vectors):
+    backend.upsert(ids, [f"title {publication_id}" for publication_id in ids], vectors,
+                   [f"hash {publication_id}" for publication_id in ids])
+    reference.update(zip(ids, vectors))
+
+
+def exact_search(reference, queries, n_results):
+    ids = list(reference)
+    vectors = np.array([reference[publication_id] for publication_id in ids])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    distances = 1 - queries @ vectors.T
+    nearest = np.argsort(distances, axis=1)[:, :n_results]
+    return ([[ids[i] for i in row] for row in nearest],
+            [[float(distances[query, i]) for i in row] for query, row in enumerate(nearest)],
+            [dict(zip(ids, row)) for row in distances])
+
+
+def assert_exact(backend, reference, quantization, n_results=5):
+    queries = embeddings(99, 8)
+    ids, distances = backend.query(queries, n_results)
+    expected_ids, expected_distances, all_distances = exact_search(reference, queries, n_results)
+    tolerance = DISTANCE_TOLERANCE[quantization]
+    if quantization == "none":
+        assert ids == expected_ids
+    for query in range(len(queries)):
+        np.testing.assert_allclose(distances[query], expected_distances[query], atol=tolerance)
+        # with int8 two nearly equal neighbours may swap, the neighbours found are as near as the exact ones
+        found_distances = [all_distances[query][publication_id] for publication_id in ids[query]]
+        np.testing.assert_allclose(found_distances, expected_distances[query], atol=tolerance)
+    assert backend.count() == len(reference)
+    assert backend.get_title_hashes() == {publication_id: f"hash {publication_id}" for publication_id in reference}
+
+
+def test_upserts_in_chunks_match_exact_search(tmp_path, quantization):
+    backend = NumpySimilarityBackend(str(tmp_path), quantization)
+    reference = {}
+    for chunk in range(4):
+        ids = [f"publication {chunk * 10 + i}" for i in range(10)]
+        upsert(backend, reference, ids, embeddings(chunk, 10))
+    assert_exact(backend, reference, quantization)
+
+
+def test_replaced_embeddings_match_exact_search(tmp_path, quantization):
+    backend = NumpySimilarityBackend(str(tmp_path), quantization)
+    reference = {}
+    ids = [f"publication {i}" for i in range(20)]
+    upsert(backend, reference, ids, embeddings(1, 20))
+    # a pending row replaces another pending row
+    upsert(backend, reference, ids[:5], embeddings(2, 5))
+    backend.flush()
+    # a pending row replaces a stored row, next to new ones
+    upsert(backend, reference, ids[10:15] + ["publication 20", "publication 21"], embeddings(3, 7))
+    assert_exact(backend, reference, quantization)
+
+
+def test_deletes_match_exact_search(tmp_path, quantization):
+    backend = NumpySimilarityBackend(str(tmp_path), quantization)
+    reference = {}
+    ids = [f"publication {i}" for i in range(30)]
+    upsert(backend, reference, ids[:20], embeddings(1, 20))
+    backend.flush()
+    upsert(backend, reference, ids[20:] + ids[:3], embeddings(2, 13))
+    # the delete merges the pending rows first, a deleted id may still have a pending row
+    deleted = ids[1:4] + ids[18:23]
+    backend.delete(deleted)
+    for publication_id in deleted:
+        del reference[publication_id]
+    assert_exact(backend, reference, quantization)
+
+
+def test_flushed_embeddings_are_loaded_again(tmp_path, quantization):
+    backend = NumpySimilarityBackend(str(tmp_path), quantization)
+    reference = {}
+    upsert(backend, reference, [f"publication {i}" for i in range(25)], embeddings(1, 25))
+    upsert(backend, reference, ["publication 3", "publication 30"], embeddings(2, 2))
+    backend.flush()
+    assert_exact(NumpySimilarityBackend(str(tmp_path), quantization), reference, quantization)
+
+
+def test_pending_embeddings_are_not_kept_without_flush(tmp_path, quantization):
+    backend = NumpySimilarityBackend(str(tmp_path), quantization)
+    reference = {}
+    upsert(backend, reference, [f"publication {i}" for i in range(10)], embeddings(1, 10))
+    backend.flush()
+    backend.upsert(["publication 10"], ["title publication 10"], embeddings(2, 1), ["hash publication 10"])
+    reopened = NumpySimilarityBackend(str(tmp_path), quantization)
+    assert reopened.count() == 10
+    assert_exact(reopened, reference, quantization)
+
+
+def test_query_returns_every_title_when_there_are_fewer_than_asked(tmp_path, quantization):
+    backend = NumpySimilarityBackend(str(tmp_path), quantization)
+    reference = {}
+    upsert(backend, reference, [f"publication {i}" for i in range(3)], embeddings(1, 3))
+    assert_exact(backend, reference, quantization, n_results=10)
+
+
+def test_empty_backend_returns_no_neighbours(tmp_path, quantization):
+    backend = NumpySimilarityBackend(str(tmp_path), quantization)
+    assert backend.query(embeddings(1, 2), 5) == ([[], []], [[], []])
+    upsert(backend, {}, ["publication 1"], embeddings(1, 1))
+    backend.clear()
+    assert backend.count() == 0
+    assert backend.query(embeddings(1, 2), 5) == ([[], []], [[], []])